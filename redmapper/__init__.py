@@ -6,12 +6,12 @@ version = __version__
 
 from .configuration import Configuration
 from .runcat import RunCatalog
-from .solver_nfw import Solver
-from .catalog import DataObject, Entry, Catalog
+from .solver_nfw import Solver, solve_nfw_batch
+from .catalog import DataObject, Entry, Catalog, FitsTableWriter
 from .redsequence import RedSequenceColorPar
-from .chisq_dist import compute_chisq
+from .chisq_dist import compute_chisq, ChisqContext
 from .background import Background, ZredBackground, BackgroundGenerator
-from .cluster import Cluster, ClusterCatalog
+from .cluster import Cluster, ClusterCatalog, ClusterNeighbors
 from .galaxy import Galaxy, GalaxyCatalog
 from .mask import Mask, HPMask, get_mask
 from .zlambda import Zlambda, ZlambdaCorrectionPar
@@ -244,6 +244,9 @@ class BackgroundGenerator(object):
         self.config = copy.deepcopy(config)
         self.config.cosmo = None
 
+        # The galaxy columns needed to compute the background
+        self.galaxy_columns = ['refmag', 'refmag_err', 'mag', 'mag_err']
+
     def run(self, clobber=False, natatime=100000, deepmode=False):
         """
         """
@@ -364,38 +367,21 @@ class BackgroundGenerator(object):
         zrange_use = np.array([zbins_use[0], zbins_use[-1] + self.config.bkg_zbinsize])
 
         # We need to load in the red sequence structure -- just in the specific redshift range
-        zredstr = RedSequenceColorPar(self.config.parfile, zrange=zrange_use)
+        zredstr = RedSequenceColorPar(self.config.parfile, zrange=zrange_use,
+                                      cachepath=self.config.parfile_cachepath)
 
         zredstrbinsize = zredstr.z[1] - zredstr.z[0]
         zpos = np.searchsorted(zredstr.z, zbins_use)
 
-        # How many galaxies total?
-        if self.config.galfile_pixelized:
-            master = Entry.from_fits_file(self.config.galfile)
-
-            if (self.config.hpix > 0):
-                # We need to take a sub-region
-                theta, phi = hp.pix2ang(master.nside, master.hpix)
-                ipring_big = hp.ang2pix(self.config.nside, theta, phi)
-                subreg_indices, = np.where(ipring_big == self.config.hpix)
-            else:
-                subreg_indices = np.arange(master.hpix.size)
-
-            ngal = np.sum(master.ngals[subreg_indices])
-            npix = subreg_indices.size
+        # The galaxies in the sub-region (if any) are read in blocks
+        if self.config.hpix > 0:
+            region = (self.config.nside, self.config.hpix, 0.0)
         else:
-            hdr = fitsio.read_header(self.config.galfile, ext=1)
-
-            ngal = hdr['NAXIS2']
-            npix = 0
+            region = None
 
         nmag = self.config.nmag
         ncol = nmag - 1
 
-        # default values are all guaranteed to be out of range
-        chisqs = np.zeros((ngal, zbins_use.size), dtype=np.float32) + np.exp(np.max(self.lnchisqbins)) + 100.0
-        refmags = np.zeros(ngal, dtype=np.float32)
-
         if (self.deepmode):
             zlimmag = zredstr.mstar(zbins_use + self.config.bkg_zbinsize) - 2.5 * np.log10(0.01)
         else:
@@ -408,79 +394,59 @@ class BackgroundGenerator(object):
 
         zbinmid = np.median(np.arange(zredstr.z.size - 1))
 
-        # And the main loop
-        ctr = 0
-        p = 0
-        # This covers both loops
-        while ((ctr < ngal) and (p < npix)):
-            # Read in a section of the galaxies, or the pixel
-            if not self.config.galfile_pixelized:
-                lo = ctr
-                hi = np.clip(ctr + self.natatime, None, ngal)
-
-                gals = GalaxyCatalog.from_fits_file(self.config.galfile, rows=np.arange(lo, hi))
-                ctr = hi + 1
-            else:
-                if master.ngals[subreg_indices[p]] == 0:
-                    p += 1
-                    continue
-
-                gals = GalaxyCatalog.from_galfile(self.config.galfile, nside=master.nside,
-                                                  hpix=master.hpix[subreg_indices[p]], border=0.0)
-
-                lo = ctr
-                hi = ctr + gals.size
-
-                ctr += master.ngals[subreg_indices[p]]
-                p += 1
-
-            inds = np.arange(lo, hi)
-
-            refmags[inds] = gals.refmag
-
-            for i, zbin in enumerate(zbins_use):
-                use, = np.where((gals.refmag > self.refmagrange[0]) &
-                                (gals.refmag < zlimmag[i]))
-
-                if (use.size > 0):
-                    # Compute chisq at the redshift zbin
-                    chisqs[inds[use], i] = zredstr.calculate_chisq(gals[use], zbin)
-
         binsizes = self.config.bkg_refmagbinsize  * self.config.bkg_chisqbinsize
         lnbinsizes = self.config.bkg_refmagbinsize * self.lnchisqbinsize
 
         sigma_g_sub = np.zeros((self.nrefmagbins, self.nchisqbins, zbins_use.size))
         sigma_lng_sub = np.zeros((self.nrefmagbins, self.nlnchisqbins, zbins_use.size))
 
-        for i, zbin in enumerate(zbins_use):
-            use, = np.where((chisqs[:, i] >= self.chisqrange[0]) &
-                            (chisqs[:, i] < self.chisqrange[1]) &
-                            (refmags >= self.refmagrange[0]) &
-                            (refmags < self.refmagrange[1]))
-            chisqpos = (chisqs[use, i] - self.chisqrange[0]) * self.nchisqbins / (self.chisqrange[1] - self.chisqrange[0])
-            refmagpos = (refmags[use] - self.refmagrange[0]) * self.nrefmagbins / (self.refmagrange[1] - self.refmagrange[0])
+        # And the main loop.  The cic histograms are additive, so these
+        # are accumulated block by block.
+        for gals in GalaxyCatalog.iter_chunks(self.config.galfile, chunksize=self.natatime,
+                                              columns=self.galaxy_columns, region=region):
+            # default values are all guaranteed to be out of range
+            chisqs = np.zeros((gals.size, zbins_use.size), dtype=np.float32) + np.exp(np.max(self.lnchisqbins)) + 100.0
+            refmags = gals.refmag.astype(np.float32)
+
+            # Compute chisq at all the redshift bins in one pass, and keep
+            # the values where the galaxy is within the limiting magnitude
+            use, = np.where((gals.refmag > self.refmagrange[0]) &
+                            (gals.refmag < np.max(zlimmag)))
+
+            if (use.size > 0):
+                chisqs_use = zredstr.calculate_chisq_grid(gals[use], zbins_use)
+                inlim = (gals.refmag[use, np.newaxis] < zlimmag[np.newaxis, :])
+                chisqs[use, :] = np.where(inlim, chisqs_use, chisqs[use, :])
+
+            for i, zbin in enumerate(zbins_use):
+                use, = np.where((chisqs[:, i] >= self.chisqrange[0]) &
+                                (chisqs[:, i] < self.chisqrange[1]) &
+                                (refmags >= self.refmagrange[0]) &
+                                (refmags < self.refmagrange[1]))
+                chisqpos = (chisqs[use, i] - self.chisqrange[0]) * self.nchisqbins / (self.chisqrange[1] - self.chisqrange[0])
+                refmagpos = (refmags[use] - self.refmagrange[0]) * self.nrefmagbins / (self.refmagrange[1] - self.refmagrange[0])
 
-            value = np.ones(use.size)
+                value = np.ones(use.size)
 
-            field = cic(value, chisqpos, self.nchisqbins, refmagpos, self.nrefmagbins, isolated=True)
-            for j in xrange(self.nchisqbins):
-                sigma_g_sub[:, j, i] = field[:, j] / (self.areas * binsizes)
+                field = cic(value, chisqpos, self.nchisqbins, refmagpos, self.nrefmagbins, isolated=True)
+                sigma_g_sub[:, :, i] += field
 
-            lnchisqs = np.log(chisqs[:, i])
+                lnchisqs = np.log(chisqs[:, i])
 
-            use, = np.where((lnchisqs >= self.lnchisqrange[0]) &
-                            (lnchisqs < self.lnchisqrange[1]) &
-                            (refmags >= self.refmagrange[0]) &
-                            (refmags < self.refmagrange[1]))
-            lnchisqpos = (lnchisqs[use] - self.lnchisqrange[0]) * self.nlnchisqbins / (self.lnchisqrange[1] - self.lnchisqrange[0])
-            refmagpos = (refmags[use] - self.refmagrange[0]) * self.nrefmagbins / (self.refmagrange[1] - self.refmagrange[0])
+                use, = np.where((lnchisqs >= self.lnchisqrange[0]) &
+                                (lnchisqs < self.lnchisqrange[1]) &
+                                (refmags >= self.refmagrange[0]) &
+                                (refmags < self.refmagrange[1]))
+                lnchisqpos = (lnchisqs[use] - self.lnchisqrange[0]) * self.nlnchisqbins / (self.lnchisqrange[1] - self.lnchisqrange[0])
+                refmagpos = (refmags[use] - self.refmagrange[0]) * self.nrefmagbins / (self.refmagrange[1] - self.refmagrange[0])
 
-            value = np.ones(use.size)
+                value = np.ones(use.size)
 
-            field2 = cic(value, lnchisqpos, self.nlnchisqbins, refmagpos, self.nrefmagbins, isolated=True)
+                field2 = cic(value, lnchisqpos, self.nlnchisqbins, refmagpos, self.nrefmagbins, isolated=True)
+                sigma_lng_sub[:, :, i] += field2
 
-            for j in xrange(self.nlnchisqbins):
-                sigma_lng_sub[:, j, i] = field2[:, j] / (self.areas * lnbinsizes)
+        sigma_g_sub /= (self.areas * binsizes)[:, np.newaxis, np.newaxis]
+        sigma_lng_sub /= (self.areas * lnbinsizes)[:, np.newaxis, np.newaxis]
 
         print("Finished %.2f < z < %.2f in %.1f seconds" % (zbins_use[0], zbins_use[-1],
                                                             time.time() - starttime))
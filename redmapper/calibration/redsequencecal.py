@@ -27,11 +27,17 @@ class RedSequenceCalibrator(object):
 
         self._galfile = galfile
 
+        # The galaxy columns needed for the calibration (and zreds)
+        self.galaxy_columns = ['z', 'pcol', 'pmem', 'refmag', 'refmag_err',
+                               'mag', 'mag_err', 'zred', 'zred_e', 'zred_uncorr',
+                               'zred_uncorr_e', 'lkhd', 'chisq']
+
     def run(self, doRaise=True):
         """
         """
 
-        gals = GalaxyCatalog.from_galfile(self._galfile)
+        gals = GalaxyCatalog.from_galfile(self._galfile, columns=self.galaxy_columns,
+                                          nthreads=self.config.galfile_read_nthreads)
 
         if self.config.calib_use_pcol:
             use, = np.where((gals.z > self.config.zrange[0]) &
@@ -32,28 +32,41 @@ class SelectSpecRedGalaxies(object):
             raise IOError("Could not find calib_redgal_template file %s in resource or path" % (self.config.calib_redgal_template))
 
 
-    def run(self):
+    def run(self, natatime=100000):
         """
         """
 
-        # first, we read the galaxies
-        gals = GalaxyCatalog.from_galfile(self.config.galfile,
-                                          nside=self.config.nside,
-                                          hpix=self.config.hpix,
-                                          border=self.config.border)
-
-        # and we need the spectra
+        # first, we need the spectra
         spec = Catalog.from_fits_file(self.config.specfile_train)
 
         # select good spectra
         use, = np.where(spec.z_err < 0.001)
         spec = spec[use]
 
-        # Match spectra to galaxies
-        i0, i1, dists = gals.match_many(spec.ra, spec.dec, 3./3600.0, maxmatch=1)
+        # Match spectra to galaxies, reading the galaxies in blocks
+        i0s = []
+        distss = []
+        matched = []
+        for gals in GalaxyCatalog.iter_chunks(self.config.galfile, chunksize=natatime,
+                                              region=(self.config.nside,
+                                                      self.config.hpix,
+                                                      self.config.border)):
+            i0, i1, dists = gals.match_many(spec.ra, spec.dec, 3./3600.0, maxmatch=1)
+            i0s.append(i0)
+            distss.append(dists)
+            matched.append(gals._ndarray[i1])
+
+        i0 = np.concatenate(i0s)
+        dists = np.concatenate(distss)
+
+        # A spectrum may match in more than one block; keep the closest
+        st = np.argsort(dists, kind='mergesort')
+        _, first = np.unique(i0[st], return_index=True)
+        keep = st[first]
+        i0 = i0[keep]
 
         # Make a specific galaxy table
-        gals = gals[i1]
+        gals = GalaxyCatalog(np.concatenate(matched)[keep])
         gals.add_fields([('z', 'f4')])
         gals.z = spec[i0].z
 
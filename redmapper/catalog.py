@@ -1,3 +1,4 @@
+import os
 import fitsio
 import esutil as eu
 import numpy as np
@@ -42,7 +43,7 @@ class DataObject(object):
 
 
     @classmethod
-    def from_fits_file(cls, filename, ext=1, rows=None):
+    def from_fits_file(cls, filename, ext=1, rows=None, columns=None):
         """
         Constructs DataObject directly from FITS file.
 
@@ -52,11 +53,13 @@ class DataObject(object):
         Args:
             filename (string): the file path and name.
             ext: optional extension (default == 1)
+            rows: optional rows to read (default is all)
+            columns: optional list of columns to read (default is all)
 
         Returns:
             DataObject, properly constructed.
         """
-        array = fitsio.read(filename, ext=ext, rows=rows, upper=True)
+        array = fitsio.read(filename, ext=ext, rows=rows, columns=columns, upper=True)
         return cls(array)
 
     @classmethod
@@ -196,3 +199,50 @@ class Catalog(DataObject):
     def __setitem__(self, key, val):
         self._ndarray.__setitem__(key, val)
 
+
+class FitsTableWriter(object):
+    """Writes a FITS binary table incrementally.
+
+    Rows are appended to a temporary file (filename + '.partial') which
+    is renamed to filename when the writer is closed, so that filename
+    only ever holds a complete table.  If the writer is aborted the
+    partial file is left with the rows written so far.
+    """
+
+    def __init__(self, filename, dtype, clobber=False, extname=None):
+        """Creates an empty table.
+
+        Args:
+            filename (string): the final file path and name.
+            dtype: numpy dtype of the table rows.
+            clobber (bool): overwrite filename when closed (default False)
+            extname (string): optional extension name
+        """
+        if os.path.exists(filename) and not clobber:
+            raise IOError("%s already exists and clobber is False" % (filename))
+
+        self.filename = filename
+        self.tempfilename = filename + '.partial'
+        self.nrows = 0
+
+        self._fits = fitsio.FITS(self.tempfilename, mode='rw', clobber=True)
+        self._fits.write(np.zeros(0, dtype=dtype), extname=extname)
+
+    def append(self, rows):
+        """Appends rows (an ndarray or DataObject) to the table."""
+        if isinstance(rows, DataObject):
+            rows = rows._ndarray
+        if rows.size == 0:
+            return
+
+        self._fits[-1].append(rows)
+        self.nrows += rows.size
+
+    def close(self):
+        """Finishes the table and moves it to filename."""
+        self._fits.close()
+        os.rename(self.tempfilename, self.filename)
+
+    def abort(self):
+        """Closes the table, leaving the partial file."""
+        self._fits.close()
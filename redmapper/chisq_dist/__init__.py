@@ -1,3 +1,4 @@
 from . import chisq_dist_lib
 from .chisq_dist_lib import ChisqDist
 from .chisq_dist_lib import compute_chisq
+from .chisq_dist_lib import ChisqContext
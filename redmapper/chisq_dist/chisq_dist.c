@@ -10,431 +10,336 @@
 
 #include "chisq_dist.h"
 
-int chisq_dist(int mode, int do_chisq, int nophotoerr, int ncalc, int ncol, 
-	       double *covmat, double *c, double *slope,
-	       double *pivotmag, double *refmag, double *refmagerr, double *magerr, 
-	       double *color, double *lupcorr, double *dist, double sigint) {
-
-  //int i,j,k;
-  int i,j,k;
-  int nmag = ncol+1;
-
-  //gsl_matrix *mcovmat;
-  gsl_matrix_view mvcovmat;
+// Thread-local workspace for chisq_dist_one()
+struct chisq_workspace {
+  gsl_matrix *mrotmat;
   gsl_matrix *cobs;
-  gsl_matrix *cimat;
   gsl_matrix *cobsmat;
   gsl_matrix *cobstemp;
+  gsl_matrix *cimat;
   gsl_matrix *mmetric;
-  gsl_matrix *mrotmat;
-  gsl_vector *vdcm;
+  gsl_matrix *covmat;
   gsl_permutation *pp;
   gsl_vector *vdc;
-  int s;
-  double *covmat_temp = NULL;
+  gsl_vector *vdcm;
+  int cobsmat_ind;
+};
+
+static void chisq_workspace_alloc(struct chisq_workspace *ws, int ncol) {
+  int i;
+  int nmag = ncol+1;
+
+  ws->mrotmat = gsl_matrix_alloc(ncol,nmag);
+  gsl_matrix_set_zero(ws->mrotmat);  // important!
+  for (i=0;i<ncol;i++) {
+    gsl_matrix_set(ws->mrotmat, i, i, 1.0);
+    gsl_matrix_set(ws->mrotmat, i, i+1, -1.0);
+  }
+  ws->cobs = gsl_matrix_alloc(nmag, nmag);
+  ws->cobsmat = gsl_matrix_alloc(ncol,ncol);
+  ws->cobstemp = gsl_matrix_alloc(ncol,nmag);
+  ws->cimat = gsl_matrix_alloc(ncol,ncol);
+  ws->mmetric = gsl_matrix_alloc(ncol,ncol);
+  ws->covmat = gsl_matrix_alloc(ncol,ncol);
+  ws->pp = gsl_permutation_alloc(ncol);
+  ws->vdc = gsl_vector_alloc(ncol);
+  ws->vdcm = gsl_vector_alloc(ncol);
+  ws->cobsmat_ind = -1;
+}
+
+static void chisq_workspace_free(struct chisq_workspace *ws) {
+  gsl_matrix_free(ws->mrotmat);
+  gsl_matrix_free(ws->cobs);
+  gsl_matrix_free(ws->cobsmat);
+  gsl_matrix_free(ws->cobstemp);
+  gsl_matrix_free(ws->cimat);
+  gsl_matrix_free(ws->mmetric);
+  gsl_matrix_free(ws->covmat);
+  gsl_permutation_free(ws->pp);
+  gsl_vector_free(ws->vdc);
+  gsl_vector_free(ws->vdcm);
+}
 
-  int covmat_stride;
+// Compute the chisq (or likelihood) for calculation i.  See chisq_dist()
+// for the modes and array layouts.
+static void chisq_dist_one(int mode, int do_chisq, int nophotoerr, int i, int nz, int ncol,
+			   double *covmat, double *c, double *slope,
+			   double *pivotmag, double *refmag, double *refmagerr, double *magerr,
+			   double *color, double *lupcorr, double *dist, double sigint,
+			   int *covmat_posdef, struct chisq_workspace *ws) {
+  int j,k;
+  int nmag = ncol+1;
+  int s;
+  int igal,iz,icov;
   int test;
   double val;
-
   double chisq,norm;
 
-  int use_refmagerr=0;
+  double *covmat_i, *c_i, *slope_i, *slope_ci, *magerr_i, *color_i;
+  double pivotmag_i, refmag_i, refmagerr_i;
 
   norm = 1.0;
-  
-  covmat_stride = ncol*ncol; //*sizeof(double);
 
-  mrotmat = gsl_matrix_alloc(ncol,nmag);
-  gsl_matrix_set_zero(mrotmat);  // important!
-  for (i=0;i<ncol;i++) {
-    gsl_matrix_set(mrotmat, i, i, 1.0);
-    gsl_matrix_set(mrotmat, i, i+1, -1.0);
-  }
-  cobs = gsl_matrix_alloc(nmag, nmag);
-  cobsmat = gsl_matrix_alloc(ncol,ncol);
-  cobstemp = gsl_matrix_alloc(ncol,nmag);
-  pp=gsl_permutation_alloc(ncol);
-  mmetric=gsl_matrix_alloc(ncol,ncol);
-  vdc = gsl_vector_alloc(ncol);
-  vdcm=gsl_vector_alloc(ncol);
-
-  cimat = NULL;
-  if (refmagerr != NULL) {
-      use_refmagerr = 1;
-      cimat = gsl_matrix_alloc(ncol,ncol);
+  if (mode == 3) {
+    igal = i / nz;
+    iz = i % nz;
+    icov = iz;
+  } else if (mode == 1) {
+    igal = 0;
+    iz = i;
+    icov = i;
+  } else {
+    igal = i;
+    iz = i;
+    icov = (mode == 0) ? 0 : i;
   }
 
   if (mode == 0) {
-    // mode = 0
-    //   Many galaxies, one redshift
-    //     - refmag/refmagerr is an array with ncalc (==ngal)
-    //     - color is a matrix with ncol x ncalc (==ngal)
-    //     - magerr is a matrix with nmag x ncalc (==ngal)
-    //     - c is an array with ncol
-    //     - slope is an array with ncol
-    //     - pivotmag is a single value
-    //     - lupcorr is a matrix with ncol x ncalc (==ngal)
-    //     //- covmat is a matrix with ncol x ncol x ncalc (==ngal)
-    //     - covmat is a matrix with ncol x ncol
-    //
-    // // covmat[ncol,ncol,ncalc]: (k*ncol+j)*ncol + i
-    // covmat[ncol,ncol]: k*ncol + j
-    // c[ncol]: j  
-    // slope[ncol]: j
-    // pivotmag[0]
-    // refmag[ncalc]: i
-    // refmagerr[ncalc]: i
-    // magerr[nmag,ncalc]: i*nmag + j
-    // color[ncol,ncalc]: i*ncol + j
-    // lupcorr[ncol,ncalc]: i*ncol + j
-
-    // first make a buffer for the local copy of the covmat (which gets overwritten)
-    if ((covmat_temp = (double *)calloc(ncol*ncol, sizeof(double))) == NULL) {
-	return -1;
-    }
-    
-    for (i=0;i<ncalc;i++) {
-
-      memcpy(covmat_temp,covmat,sizeof(double)*ncol*ncol);
-	
-      gsl_matrix_set_identity(cobs);
-      for (j=0;j<nmag;j++) {
-	gsl_matrix_set(cobs, j, j, magerr[i*nmag+j]*magerr[i*nmag+j]);
-      }
-
-      gsl_matrix_set_zero(cobstemp);
-      
-      gsl_blas_dgemm(CblasNoTrans, CblasTrans,
-		     1.0, mrotmat, cobs,
-		     0.0, cobstemp);
-      gsl_blas_dgemm(CblasNoTrans, CblasTrans,
-		     1.0, mrotmat, cobstemp,
-		     0.0, cobsmat);
-
-
-      //mvcovmat = gsl_matrix_view_array(&covmat[covmat_stride*i], ncol, ncol);
-      mvcovmat = gsl_matrix_view_array(covmat_temp, ncol, ncol);
-
-      // and the ci matrix
-      if (use_refmagerr) {
-	  // make the C_i matrix for the refmag err
-	  //  this is a matrix with ncol x ncol size
-	  gsl_matrix_set_zero(cimat);
-	  for (j=0;j<ncol;j++) {
-	      for (k=j;k<ncol;k++) {
-		  val = slope[j] * slope[k] * refmagerr[i] * refmagerr[i];
-		  gsl_matrix_set(cimat, j, k, val);
-		  if (k != j) {
-		      gsl_matrix_set(cimat, k, j, val);
-		  }
-	      }
-	  }
-      }
-
-      // check sigint
-      test = 1;
-      for (j=0;j<ncol;j++) {
-	if (gsl_matrix_get(&mvcovmat.matrix, j, j) < sigint*sigint) {
-	  test = 0;
-	}
-      }
-
-      if (test == 0) {
-	if (do_chisq) {
-	  dist[i] = 1e11;
-	} else {
-	  dist[i] = -1e11;
-	}
-      } else {
-	if (!nophotoerr) {
-	  gsl_matrix_add(&mvcovmat.matrix, cobsmat);
-	}
-
-	if (use_refmagerr) {
-	    gsl_matrix_add(&mvcovmat.matrix, cimat);
-	}
-
+    // Many galaxies, one redshift
+    covmat_i = covmat;
+    c_i = c;
+    slope_i = slope;
+    slope_ci = slope;
+    pivotmag_i = pivotmag[0];
+    refmag_i = refmag[i];
+    magerr_i = &magerr[i*nmag];
+    color_i = &color[i*ncol];
+  } else if (mode == 1) {
+    // One galaxy, many redshifts
+    covmat_i = &covmat[ncol*ncol*i];
+    c_i = &c[i*ncol];
+    slope_i = &slope[i*ncol];
+    slope_ci = &slope[i*ncol];
+    pivotmag_i = pivotmag[i];
+    refmag_i = refmag[0];
+    magerr_i = magerr;
+    color_i = color;
+  } else if (mode == 2) {
+    // Many galaxies, many redshifts
+    //  (note the C_i matrix uses the first slope, as it always has)
+    covmat_i = &covmat[ncol*ncol*i];
+    c_i = &c[i*ncol];
+    slope_i = &slope[i*ncol];
+    slope_ci = slope;
+    pivotmag_i = pivotmag[i];
+    refmag_i = refmag[i];
+    magerr_i = &magerr[i*nmag];
+    color_i = &color[i*ncol];
+  } else {
+    // Grid of galaxies x redshifts
+    covmat_i = &covmat[ncol*ncol*iz];
+    c_i = &c[iz*ncol];
+    slope_i = &slope[iz*ncol];
+    slope_ci = &slope[iz*ncol];
+    pivotmag_i = pivotmag[iz];
+    refmag_i = refmag[igal];
+    magerr_i = &magerr[igal*nmag];
+    color_i = &color[igal*ncol];
+  }
 
-	// check and fix the matrix if necessary
-	check_and_fix_covmat(&mvcovmat.matrix);
+  if (refmagerr != NULL) {
+    refmagerr_i = refmagerr[igal];
+  } else {
+    refmagerr_i = 0.0;
+  }
 
+  // local copy of the covmat (which gets overwritten)
+  memcpy(ws->covmat->data, covmat_i, sizeof(double)*ncol*ncol);
 
-	gsl_linalg_LU_decomp(&mvcovmat.matrix, pp, &s);
-	gsl_linalg_LU_invert(&mvcovmat.matrix, pp, mmetric);
-	
-	if (!do_chisq) {
-	  // need the determinant
-	  norm = gsl_linalg_LU_det(&mvcovmat.matrix, s);
-	}
-	
-	// now need the slope, etc.
-	for (j=0;j<ncol;j++) {
-	  gsl_vector_set(vdc,j,
-			 (c[j]+slope[j]*(refmag[i]-pivotmag[0])) + lupcorr[i*ncol+j] -
-			 color[i*ncol+j]);
-	}
-	
-	gsl_blas_dgemv(CblasNoTrans, 1.0, mmetric, vdc, 0.0, vdcm);
-	gsl_blas_ddot(vdcm, vdc, &chisq);
-	
-	if (do_chisq) {
-	  dist[i] = chisq;
-	} else {
-	  dist[i]=-0.5*chisq-0.5*log(norm);
-	}
-      }
-    
-    }
-    free(covmat_temp);
-
-  } else if (mode==1) {
-    // mode = 1
-    //   One galaxy, many redshifts
-    //     - refmag/refmagerr is a single value
-    //     - color is an array with ncol values
-    //     - magerr is an array with nmag=ncol+1 values
-    //     - c is a matrix with ncol x ncalc (==nz)
-    //     - slope is a matrix with ncol x ncalc (==nz)
-    //     - pivotmag is an array with ncalc (==nz)
-    //     - lupcorr is a matrix with ncol x ncalc (==nz)
-    //     - covmat is a matrix with ncol x ncol x ncalc (==nz)
-    //
-    // covmat[ncol,ncol,ncalc] : (k*ncol+j)*ncol+i
-    // c[ncol,ncalc]: i*ncol+j
-    // slope[ncol,ncalc]: i*ncol+j
-    // pivotmag[ncalc]: i
-    // magerr[nmag]: j
-    // color[ncol]: j
-    // lupcorr[ncol,ncalc]: i*ncol + j
-    // refmag[0]
-    // refmagerr[0]
-
-    // first make a buffer for the local copy of the covmat (which gets overwritten)
-    if ((covmat_temp = (double *)calloc(ncol*ncol*ncalc, sizeof(double))) == NULL) {
-	return -1;
-    }
-    memcpy(covmat_temp,covmat,sizeof(double)*ncol*ncol*ncalc);
-      
-    // We can generate the C_obs matrix (cobsmat) just once
-    gsl_matrix_set_identity(cobs);
+  // The C_obs matrix (cobsmat) only depends on the galaxy, so it is
+  //  reused across redshifts in modes 1 and 3.
+  if (igal != ws->cobsmat_ind) {
+    gsl_matrix_set_identity(ws->cobs);
     for (j=0;j<nmag;j++) {
-      gsl_matrix_set(cobs,j,j,magerr[j]*magerr[j]);
+      gsl_matrix_set(ws->cobs, j, j, magerr_i[j]*magerr_i[j]);
     }
 
-    gsl_matrix_set_zero(cobstemp);
+    gsl_matrix_set_zero(ws->cobstemp);
 
     gsl_blas_dgemm(CblasNoTrans, CblasTrans,
-		   1.0, mrotmat, cobs,
-		   0.0, cobstemp);
+		   1.0, ws->mrotmat, ws->cobs,
+		   0.0, ws->cobstemp);
     gsl_blas_dgemm(CblasNoTrans, CblasTrans,
-		   1.0, mrotmat, cobstemp,
-		   0.0, cobsmat);
+		   1.0, ws->mrotmat, ws->cobstemp,
+		   0.0, ws->cobsmat);
+    ws->cobsmat_ind = igal;
+  }
 
-    for (i=0;i<ncalc;i++) {
-      mvcovmat = gsl_matrix_view_array(&covmat_temp[covmat_stride*i], ncol, ncol);
-
-      if (use_refmagerr) {
-	  // make the C_i matrix for the refmag err
-	  //  this is a matrix with ncol x ncol size...
-	  gsl_matrix_set_zero(cimat);
-	  for (j=0;j<ncol;j++) {
-	      for (k=j;k<ncol;k++) {
-		  val = slope[i*ncol+j] * slope[i*ncol+k] * refmagerr[0] * refmagerr[0];
-		  gsl_matrix_set(cimat, j, k, val);
-		  if (k != j) {
-		      gsl_matrix_set(cimat, k, j, val);
-		  }
-	      }
-	  }
-      }
-      
-      // check sigint
-      test = 1;
-      for (j=0;j<ncol;j++) {
-	if (gsl_matrix_get(&mvcovmat.matrix, j, j) < sigint*sigint) {
-	  test = 0;
+  // and the ci matrix
+  if (refmagerr != NULL) {
+    // make the C_i matrix for the refmag err
+    //  this is a matrix with ncol x ncol size
+    gsl_matrix_set_zero(ws->cimat);
+    for (j=0;j<ncol;j++) {
+      for (k=j;k<ncol;k++) {
+	val = slope_ci[j] * slope_ci[k] * refmagerr_i * refmagerr_i;
+	gsl_matrix_set(ws->cimat, j, k, val);
+	if (k != j) {
+	  gsl_matrix_set(ws->cimat, k, j, val);
 	}
       }
+    }
+  }
 
-      if (test == 0) {
-	if (do_chisq) {
-	  dist[i] = 1e11;
-	} else {
-	  dist[i] = -1e11;
-	}
-      } else {
-	if (!nophotoerr) {
-	  gsl_matrix_add(&mvcovmat.matrix, cobsmat);
-	}
+  // check sigint
+  test = 1;
+  for (j=0;j<ncol;j++) {
+    if (gsl_matrix_get(ws->covmat, j, j) < sigint*sigint) {
+      test = 0;
+    }
+  }
 
-	if (use_refmagerr) {
-	    gsl_matrix_add(&mvcovmat.matrix, cimat);
-	}
+  if (test == 0) {
+    if (do_chisq) {
+      dist[i] = 1e11;
+    } else {
+      dist[i] = -1e11;
+    }
+    return;
+  }
 
-	// check and fix the matrix if necessary
-	check_and_fix_covmat(&mvcovmat.matrix);
-	
-	gsl_linalg_LU_decomp(&mvcovmat.matrix, pp, &s);
-	gsl_linalg_LU_invert(&mvcovmat.matrix, pp, mmetric);
+  if (!nophotoerr) {
+    gsl_matrix_add(ws->covmat, ws->cobsmat);
+  }
 
-	if (!do_chisq) {
-	  norm = gsl_linalg_LU_det(&mvcovmat.matrix, s);
-	}
+  if (refmagerr != NULL) {
+    gsl_matrix_add(ws->covmat, ws->cimat);
+  }
 
-	for (j=0;j<ncol;j++) {
-	  gsl_vector_set(vdc,j,
-			 (c[i*ncol+j] + slope[i*ncol+j]*(refmag[0] - pivotmag[i])) + lupcorr[i*ncol+j] -
-			 color[j]);
-	}
+  // check and fix the matrix if necessary.  The photometric and refmag
+  //  terms are positive semi-definite, so this is not needed if the
+  //  intrinsic covmat is known to be safely positive definite.
+  if (covmat_posdef == NULL || !covmat_posdef[icov]) {
+    check_and_fix_covmat(ws->covmat);
+  }
 
-	gsl_blas_dgemv(CblasNoTrans, 1.0, mmetric, vdc, 0.0, vdcm);
-	gsl_blas_ddot(vdcm,vdc, &chisq);
-	
-	if (do_chisq) {
-	  dist[i] = chisq;
-	} else {
-	  dist[i]=-0.5*chisq-0.5*log(norm);
-	}
+  gsl_linalg_LU_decomp(ws->covmat, ws->pp, &s);
+  gsl_linalg_LU_invert(ws->covmat, ws->pp, ws->mmetric);
 
-      }
-    }
-    free(covmat_temp);
+  if (!do_chisq) {
+    // need the determinant
+    norm = gsl_linalg_LU_det(ws->covmat, s);
+  }
+
+  // now need the slope, etc.
+  for (j=0;j<ncol;j++) {
+    gsl_vector_set(ws->vdc,j,
+		   (c_i[j]+slope_i[j]*(refmag_i-pivotmag_i)) + lupcorr[i*ncol+j] -
+		   color_i[j]);
+  }
+
+  gsl_blas_dgemv(CblasNoTrans, 1.0, ws->mmetric, ws->vdc, 0.0, ws->vdcm);
+  gsl_blas_ddot(ws->vdcm, ws->vdc, &chisq);
+
+  if (do_chisq) {
+    dist[i] = chisq;
   } else {
-      // mode = 2
-      //  Many galaxies, many redshifts
-      //     - refmag/refmagerr is an array with ncalc (==ngal)
-      //     - color is a matrix with ncol x ncalc (==ngal)
-      //     - magerr is a matrix with nmag x ncalc (==ngal)
-      //     - c is a matrix with ncol x ncalc (==ngal)
-      //     - slope is a matrix with ncol x ncalc (==ngal)
-      //     - pivotmag is an array with ncalc (==ngal)
-      //     - lupcorr is a matrix with ncol x ncalc (==ngal)
-      //     - covmat is a matrix with ncol x ncol x ncalc (==ngal)
-      //
-      // covmat[ncol,ncol,ncalc] : (k*ncol+j)*ncol+i   -> mode 0    
-      // c[ncol,ncalc]: i*ncol+j                       -> mode 1
-      // slope[ncol,ncalc]: i*ncol+j                   -> mode 1
-      // pivotmag[ncalc]: i                              -> mode 1
-      // refmag[ncalc]: i                                -> mode 0
-      // refmagerr[ncalc]: i                             -> mode 0
-      // magerr[nmag,ncalc]: i*nmag + j                -> mode 0
-      // color[ncol,ncalc]: i*ncol + j                 -> mode 0
-      // lupcorr[ncol,ncalc]: i*ncol + j               -> mode 0, 1
-
-      if ((covmat_temp = (double *)calloc(ncol*ncol*ncalc, sizeof(double))) == NULL) {
-	  return -1;
-      }
-      memcpy(covmat_temp,covmat,sizeof(double)*ncol*ncol*ncalc);
-
-      
-      for (i=0;i<ncalc;i++) {
-	  // copy from mode 0
-	  gsl_matrix_set_identity(cobs);
-	  for (j=0;j<nmag;j++) {
-	      // okay
-	      gsl_matrix_set(cobs, j, j, magerr[i*nmag+j]*magerr[i*nmag+j]);
-	  }
-
-	  gsl_matrix_set_zero(cobstemp);
-      
-	  gsl_blas_dgemm(CblasNoTrans, CblasTrans,
-			 1.0, mrotmat, cobs,
-			 0.0, cobstemp);
-	  gsl_blas_dgemm(CblasNoTrans, CblasTrans,
-			 1.0, mrotmat, cobstemp,
-			 0.0, cobsmat);
-
-	  mvcovmat = gsl_matrix_view_array(&covmat_temp[covmat_stride*i], ncol, ncol);
-
-	  // and the ci matrix
-	  // copy from mode 0
-	  if (use_refmagerr) {
-	      // make the C_i matrix for the refmag err
-	      //  this is a matrix with ncol x ncol size
-	      gsl_matrix_set_zero(cimat);
-	      for (j=0;j<ncol;j++) {
-		  for (k=j;k<ncol;k++) {
-		      val = slope[j] * slope[k] * refmagerr[i] * refmagerr[i];
-		      gsl_matrix_set(cimat, j, k, val);
-		      if (k != j) {
-			  gsl_matrix_set(cimat, k, j, val);
-		      }
-		  }
-	      }
-	  }
-
-	  // check sigint
-	  // copy from mode 0
-	  test = 1;
-	  for (j=0;j<ncol;j++) {
-	      if (gsl_matrix_get(&mvcovmat.matrix, j, j) < sigint*sigint) {
-		  test = 0;
-	      }
-	  }
-
-	  if (test == 0) {
-	      if (do_chisq) {
-		  dist[i] = 1e11;
-	      } else {
-		  dist[i] = -1e11;
-	      }
-	  } else {
-	      // copy from mode 0
-	      if (!nophotoerr) {
-		  gsl_matrix_add(&mvcovmat.matrix, cobsmat);
-	      }
-
-	      // copy from mode 0
-	      if (use_refmagerr) {
-		  gsl_matrix_add(&mvcovmat.matrix, cimat);
-	      }
-
-	      // check and fix the matrix if necessary
-	      // copy from mode 0
-	      check_and_fix_covmat(&mvcovmat.matrix);
-
-	      gsl_linalg_LU_decomp(&mvcovmat.matrix, pp, &s);
-	      gsl_linalg_LU_invert(&mvcovmat.matrix, pp, mmetric);
-	      
-	      if (!do_chisq) {
-		  // need the determinant
-		  norm = gsl_linalg_LU_det(&mvcovmat.matrix, s);
-	      }
-
-	      // vdc is a vector with ncol...
-	      // copy from mode 1
-	      for (j=0;j<ncol;j++) {
-		  gsl_vector_set(vdc,j,
-				 (c[i*ncol+j] + slope[i*ncol+j]*(refmag[i] - pivotmag[i])) + lupcorr[i*ncol+j] -
-				 color[i*ncol+j]);
-	      }
-
-	      gsl_blas_dgemv(CblasNoTrans, 1.0, mmetric, vdc, 0.0, vdcm);
-	      gsl_blas_ddot(vdcm,vdc, &chisq);
-
-	      if (do_chisq) {
-		  dist[i] = chisq;
-	      } else {
-		  dist[i]=-0.5*chisq-0.5*log(norm);
-	      }
-	  }
-	  
-	  
-      }
-      free(covmat_temp);
+    dist[i]=-0.5*chisq-0.5*log(norm);
+  }
+}
+
+int chisq_dist(int mode, int do_chisq, int nophotoerr, int ncalc, int nz, int ncol,
+	       double *covmat, double *c, double *slope,
+	       double *pivotmag, double *refmag, double *refmagerr, double *magerr,
+	       double *color, double *lupcorr, double *dist, double sigint,
+	       int *covmat_posdef, int nthreads) {
+
+  // mode = 0
+  //   Many galaxies, one redshift
+  //     - refmag/refmagerr is an array with ncalc (==ngal)
+  //     - color is a matrix with ncol x ncalc (==ngal)
+  //     - magerr is a matrix with nmag x ncalc (==ngal)
+  //     - c is an array with ncol
+  //     - slope is an array with ncol
+  //     - pivotmag is a single value
+  //     - lupcorr is a matrix with ncol x ncalc (==ngal)
+  //     - covmat is a matrix with ncol x ncol
+  //
+  // covmat[ncol,ncol]: k*ncol + j
+  // c[ncol]: j
+  // slope[ncol]: j
+  // pivotmag[0]
+  // refmag[ncalc]: i
+  // refmagerr[ncalc]: i
+  // magerr[nmag,ncalc]: i*nmag + j
+  // color[ncol,ncalc]: i*ncol + j
+  // lupcorr[ncol,ncalc]: i*ncol + j
+  //
+  // mode = 1
+  //   One galaxy, many redshifts
+  //     - refmag/refmagerr is a single value
+  //     - color is an array with ncol values
+  //     - magerr is an array with nmag=ncol+1 values
+  //     - c is a matrix with ncol x ncalc (==nz)
+  //     - slope is a matrix with ncol x ncalc (==nz)
+  //     - pivotmag is an array with ncalc (==nz)
+  //     - lupcorr is a matrix with ncol x ncalc (==nz)
+  //     - covmat is a matrix with ncol x ncol x ncalc (==nz)
+  //
+  // covmat[ncol,ncol,ncalc] : (k*ncol+j)*ncol+i
+  // c[ncol,ncalc]: i*ncol+j
+  // slope[ncol,ncalc]: i*ncol+j
+  // pivotmag[ncalc]: i
+  // magerr[nmag]: j
+  // color[ncol]: j
+  // lupcorr[ncol,ncalc]: i*ncol + j
+  // refmag[0]
+  // refmagerr[0]
+  //
+  // mode = 2
+  //  Many galaxies, many redshifts
+  //     - refmag/refmagerr is an array with ncalc (==ngal)
+  //     - color is a matrix with ncol x ncalc (==ngal)
+  //     - magerr is a matrix with nmag x ncalc (==ngal)
+  //     - c is a matrix with ncol x ncalc (==ngal)
+  //     - slope is a matrix with ncol x ncalc (==ngal)
+  //     - pivotmag is an array with ncalc (==ngal)
+  //     - lupcorr is a matrix with ncol x ncalc (==ngal)
+  //     - covmat is a matrix with ncol x ncol x ncalc (==ngal)
+  //
+  // mode = 3
+  //  Grid of many galaxies x many redshifts (ncalc == ngal*nz)
+  //     - refmag/refmagerr is an array with ngal
+  //     - color is a matrix with ncol x ngal
+  //     - magerr is a matrix with nmag x ngal
+  //     - c is a matrix with ncol x nz
+  //     - slope is a matrix with ncol x nz
+  //     - pivotmag is an array with nz
+  //     - lupcorr is a matrix with ncol x nz x ngal
+  //     - covmat is a matrix with ncol x ncol x nz
+  //
+  // lupcorr[ncol,nz,ngal]: (igal*nz + iz)*ncol + j
+  // dist[nz,ngal]: igal*nz + iz
+  //
+  // covmat_posdef (may be NULL) flags each covmat (one for mode 0, ncalc
+  // for modes 1 and 2, nz for mode 3) whose smallest eigenvalue is known
+  // to be well above MIN_EIGENVAL, so that check_and_fix_covmat() can be
+  // skipped.
+  //
+  // The calculations are split over nthreads threads (if compiled with
+  // OpenMP), each with its own workspace.
+
+  int i;
+
+  if (nthreads < 1) {
+    nthreads = 1;
   }
 
-  gsl_matrix_free(mrotmat);
-  gsl_matrix_free(cobs);
-  gsl_matrix_free(cobsmat);
-  gsl_matrix_free(cobstemp);
-  if (use_refmagerr) gsl_matrix_free(cimat);
-  gsl_permutation_free(pp);
-  gsl_matrix_free(mmetric);
-  gsl_vector_free(vdcm);
-  gsl_vector_free(vdc);
+#pragma omp parallel num_threads(nthreads) private(i)
+  {
+    struct chisq_workspace ws;
 
+    chisq_workspace_alloc(&ws, ncol);
+
+#pragma omp for schedule(static)
+    for (i=0;i<ncalc;i++) {
+      chisq_dist_one(mode, do_chisq, nophotoerr, i, nz, ncol, covmat, c, slope,
+		     pivotmag, refmag, refmagerr, magerr, color, lupcorr, dist,
+		     sigint, covmat_posdef, &ws);
+    }
+
+    chisq_workspace_free(&ws);
+  }
 
   return 0;
 }
@@ -19,6 +19,7 @@ struct chisq_dist {
     double *magerr;
     double *color;
     double *lupcorr;
+    int *covmat_posdef;
     int ncalc;
     int ngal;
     int nz;
@@ -30,7 +31,7 @@ struct chisq_dist {
 };
 
 
-int chisq_dist(int mode, int do_chisq, int nophotoerr, int ncalc, int ncol, double *covmat, double *c, double *slope, double *pivotmag, double *refmag, double *refmagerr, double *magerr, double *color, double *lupcorr, double *dist, double sigint);
+int chisq_dist(int mode, int do_chisq, int nophotoerr, int ncalc, int nz, int ncol, double *covmat, double *c, double *slope, double *pivotmag, double *refmag, double *refmagerr, double *magerr, double *color, double *lupcorr, double *dist, double sigint, int *covmat_posdef, int nthreads);
 
 
 int check_and_fix_covmat(gsl_matrix *covmat);
@@ -4,27 +4,70 @@ from past.builtins import xrange
 import numpy as np
 from . import _chisq_dist_pywrap
 
+# These match chisq_dist.h
+MIN_EIGENVAL = 1e-6
+SIGINT_DEFAULT = 0.001
+
 class ChisqDist(object):
     pass
 
 
-def compute_chisq(covmat, c, slope, pivotmag, refmag, magerr, color, refmagerr=None, lupcorr=None, calc_chisq=True, calc_lkhd=False, nophotoerr=False):
-
-    _covmat = covmat.astype('f8')
-    _c = c.astype('f8')
-    _slope = slope.astype('f8')
-    _pivotmag = np.atleast_1d(pivotmag.astype('f8'))
-    _refmag = np.atleast_1d(refmag.astype('f8'))
-    _magerr = magerr.astype('f8')
-    _color = color.astype('f8')
+def compute_chisq(covmat, c, slope, pivotmag, refmag, magerr, color, refmagerr=None, lupcorr=None, calc_chisq=True, calc_lkhd=False, nophotoerr=False, backend=None, nthreads=1, grid=False, dtype='f8'):
+    """
+    Compute the chisq and/or likelihood of galaxy colors relative to the
+    red sequence.
+
+    The mode is set by the shapes of the inputs: one redshift, many galaxies
+    (mode 0); one galaxy, many redshifts (mode 1); or paired galaxies and
+    redshifts (mode 2).  With grid=True every galaxy is computed at every
+    redshift (mode 3): c, slope, pivotmag and covmat are per-redshift as in
+    mode 1, the galaxy arrays are as in mode 0, lupcorr is (ngal, nz, ncol),
+    and the output is (ngal, nz).
+
+    The backend may be 'c' (the chisq_dist C code, one galaxy at a time) or
+    'numpy' (all galaxies at once with stacked covariance matrices), which
+    give the same values.
+
+    With the 'c' backend the calculation runs without the GIL, split over
+    nthreads OpenMP threads (if the extension was built with OpenMP).
+
+    Setting dtype='f4' does the calculation in single precision, which is
+    only supported by the numpy backend (the default for 'f4').  The
+    relative error on chisq is then typically below 1e-4.
+    """
+
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float64, np.float32):
+        raise ValueError("dtype must be 'f8' or 'f4'")
+
+    if backend is None:
+        backend = 'c' if dtype == np.float64 else 'numpy'
+    if backend not in ('c', 'numpy'):
+        raise ValueError("backend must be 'c' or 'numpy'")
+    if backend == 'c' and dtype != np.float64:
+        raise ValueError("The c backend only supports dtype 'f8'")
+
+    _covmat = covmat.astype(dtype)
+    _c = c.astype(dtype)
+    _slope = slope.astype(dtype)
+    _pivotmag = np.atleast_1d(pivotmag.astype(dtype))
+    _refmag = np.atleast_1d(refmag.astype(dtype))
+    _magerr = magerr.astype(dtype)
+    _color = color.astype(dtype)
 
     if (refmagerr is None):
-        _refmagerr = np.zeros(refmag.size,dtype='f8')
+        _refmagerr = np.zeros(refmag.size,dtype=dtype)
     else:
-        _refmagerr = np.atleast_1d(refmagerr.astype('f8'))
+        _refmagerr = np.atleast_1d(refmagerr.astype(dtype))
 
     # need to figure out the mode here...
-    if (c.ndim == 1) :
+    if grid:
+        # mode 3: many galaxies x many redshifts
+        if (c.ndim != 2):
+            raise ValueError("c must be 2D for mode 3")
+        mode = 3
+        ncol = c.shape[1]
+    elif (c.ndim == 1) :
         # mode 0: one redshift, many galaxies
         mode = 0
         ncol = c.size
@@ -83,9 +126,9 @@ def compute_chisq(covmat, c, slope, pivotmag, refmag, magerr, color, refmagerr=N
             raise ValueError("color must be ngal x ncol for mode 0")
 
         if (lupcorr is None):
-            _lupcorr = np.zeros((ngal, ncol),dtype='f8')
+            _lupcorr = np.zeros((ngal, ncol),dtype=dtype)
         else :
-            _lupcorr = lupcorr.astype('f8')
+            _lupcorr = lupcorr.astype(dtype)
 
         if (_lupcorr.shape[0] != ngal) or (_lupcorr.shape[1] != ncol):
             raise ValueError("lupcorr must be ncol x ngal for mode 0")
@@ -123,9 +166,9 @@ def compute_chisq(covmat, c, slope, pivotmag, refmag, magerr, color, refmagerr=N
             raise ValueError("color must be ncol length for mode 1")
 
         if (lupcorr is None):
-            _lupcorr = np.zeros((nz, ncol),dtype='f8')
+            _lupcorr = np.zeros((nz, ncol),dtype=dtype)
         else :
-            _lupcorr = lupcorr.astype('f8')
+            _lupcorr = lupcorr.astype(dtype)
 
         if (_lupcorr.shape[0] != nz) or (_lupcorr.shape[1] != ncol):
             raise ValueError("lupcorr must be ncol x nz for mode 1")
@@ -157,18 +200,73 @@ def compute_chisq(covmat, c, slope, pivotmag, refmag, magerr, color, refmagerr=N
             raise ValueError("color must be ngal x ncol for mode 2")
 
         if (lupcorr is None):
-            _lupcorr = np.zeros((ngal, ncol),dtype='f8')
+            _lupcorr = np.zeros((ngal, ncol),dtype=dtype)
         else :
-            _lupcorr = lupcorr.astype('f8')
+            _lupcorr = lupcorr.astype(dtype)
 
         if (_lupcorr.shape[0] != ngal) or (_lupcorr.shape[1] != ncol):
             raise ValueError("lupcorr must be ngal x ncol for mode 2")
 
         if (_refmagerr.size != ngal) :
             raise ValueError("refmagerr must be ngal elements for mode 2")
+    elif (mode == 3):
+        nz = c.shape[0]
+        ngal = _refmag.size
+
+        if (slope.shape[0] != nz or slope.shape[1] != ncol):
+            raise ValueError("slope must have ncol x nz elements for mode 3")
+        if (_pivotmag.size != nz):
+            raise ValueError("pivotmag must be nz elements for mode 3")
+        if (covmat.ndim != 3):
+            raise ValueError("covmat must be 3 dimensions for mode 3")
+        if (covmat.shape[0] != ncol or covmat.shape[1] != ncol or covmat.shape[2] != nz):
+            raise ValueError("covmat must be ncol x ncol x nz for mode 3")
+
+        if (magerr.ndim != 2):
+            raise ValueError("magerr must be 2D for mode 3")
+        if (magerr.shape[0] != ngal) or (magerr.shape[1] != nmag):
+            raise ValueError("magerr must be ngal x nmag for mode 3")
+        if (color.ndim != 2):
+            raise ValueError("color must be 2D for mode 3")
+        if (color.shape[0] != ngal) or (color.shape[1] != ncol):
+            raise ValueError("color must be ngal x ncol for mode 3")
+
+        if (lupcorr is None):
+            _lupcorr = np.zeros((ngal, nz, ncol),dtype=dtype)
+        else :
+            _lupcorr = np.ascontiguousarray(lupcorr, dtype=dtype)
+
+        if (_lupcorr.shape != (ngal, nz, ncol)):
+            raise ValueError("lupcorr must be ngal x nz x ncol for mode 3")
+
+        if (_refmagerr.size != ngal) :
+            raise ValueError("refmagerr must be ngal elements for mode 3")
+
+        # The C code needs each redshift's covmat to be contiguous
+        _covmat = np.ascontiguousarray(np.transpose(_covmat, (2, 0, 1)))
+        _magerr = np.ascontiguousarray(_magerr)
+        _color = np.ascontiguousarray(_color)
     else:
         raise ValueError("Illegal mode (unpossible)")
 
+    if backend == 'numpy':
+        # this computes both at once
+        if mode == 3:
+            _covmat = np.transpose(_covmat, (1, 2, 0))
+        chisq, lkhd = _compute_chisq_numpy(mode, ncol, _covmat, _c, _slope, _pivotmag,
+                                           _refmag, _refmagerr, _magerr, _color, _lupcorr,
+                                           nophotoerr)
+        if mode == 3:
+            chisq = chisq.reshape(ngal, nz)
+            lkhd = lkhd.reshape(ngal, nz)
+
+        if calc_chisq and not calc_lkhd:
+            return chisq
+        elif not calc_chisq and calc_lkhd:
+            return lkhd
+        else:
+            return (chisq, lkhd)
+
     _chisq_dist = _chisq_dist_pywrap.ChisqDist(mode,
                                                ngal,
                                                nz,
@@ -184,10 +282,16 @@ def compute_chisq(covmat, c, slope, pivotmag, refmag, magerr, color, refmagerr=N
                                                _lupcorr)
 
     if calc_chisq:
-        chisq = _chisq_dist.compute(True, nophotoerr)
+        chisq = _chisq_dist.compute(True, nophotoerr, nthreads)
 
     if calc_lkhd:
-        lkhd = _chisq_dist.compute(False, nophotoerr)
+        lkhd = _chisq_dist.compute(False, nophotoerr, nthreads)
+
+    if mode == 3:
+        if calc_chisq:
+            chisq = chisq.reshape(ngal, nz)
+        if calc_lkhd:
+            lkhd = lkhd.reshape(ngal, nz)
 
     if calc_chisq and not calc_lkhd:
         return chisq
@@ -196,3 +300,393 @@ def compute_chisq(covmat, c, slope, pivotmag, refmag, magerr, color, refmagerr=N
     else:
         return (chisq, lkhd)
 
+
+class ChisqContext(object):
+    """
+    Red-sequence tables prepared once for repeated chisq calls.
+
+    The covmat, c, slope, pivotmag and lupcorr tables of a
+    RedSequenceColorPar are stored as C-contiguous float64 arrays (covmat as
+    nz x ncol x ncol), so that a call only needs the galaxy arrays and the
+    redshift index.  The Cholesky factor of the (fixed) intrinsic covmat at
+    each redshift is also stored; this is used directly when there are no
+    photometric or reference magnitude errors to add.  Otherwise, as these
+    errors only add positive semi-definite terms, the C code can skip the
+    eigenvalue check of the total covmat wherever the intrinsic covmat is
+    safely positive definite.
+
+    The tables are copied when the context is created, so later changes to
+    the RedSequenceColorPar are not seen.
+
+    With dtype 'f4' the tables are single precision and the calculations
+    use the numpy code (see compute_chisq).
+
+    parameters
+    ----------
+    zredstr: RedSequenceColorPar
+        red sequence parameters
+    sigint: float, optional
+        minimum intrinsic scatter (default SIGINT_DEFAULT)
+    dtype: string, optional
+        'f8' (default) or 'f4'
+    """
+    def __init__(self, zredstr, sigint=SIGINT_DEFAULT, dtype='f8'):
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float64, np.float32):
+            raise ValueError("dtype must be 'f8' or 'f4'")
+
+        self.covmat = np.ascontiguousarray(np.transpose(zredstr.covmat, (2, 0, 1)), dtype=self.dtype)
+        self.c = np.ascontiguousarray(zredstr.c, dtype=self.dtype)
+        self.slope = np.ascontiguousarray(zredstr.slope, dtype=self.dtype)
+        self.pivotmag = np.ascontiguousarray(zredstr.pivotmag, dtype=self.dtype)
+        self.lupcorr = np.ascontiguousarray(zredstr.lupcorr, dtype=self.dtype)
+
+        self.nz = self.c.shape[0]
+        self.ncol = self.c.shape[1]
+        self.sigint = sigint
+
+        # Redshifts where the intrinsic scatter is too small are flagged
+        # (as in chisq_dist)
+        self.sigint_ok = np.all(np.diagonal(self.covmat, axis1=1, axis2=2) >= sigint * sigint, axis=1)
+
+        # Leave a margin for round-off when the errors are added
+        _, posdef = _cholesky_stacked(self.covmat - 2.0 * MIN_EIGENVAL * np.eye(self.ncol))
+        self.covmat_posdef = posdef.astype(np.int32)
+
+        cov = self.covmat.copy()
+        _fix_covmat_stacked(cov)
+        self.chol, _ = _cholesky_stacked(cov)
+        self.logdet = 2.0 * np.sum(np.log(np.diagonal(self.chol, axis1=1, axis2=2)), axis=1)
+
+    def compute(self, zind, refmag, magerr, color, refmagerr=None, magind=None,
+                calc_chisq=True, calc_lkhd=False, nophotoerr=False, nthreads=1):
+        """
+        Compute the chisq and/or likelihood for galaxies at one redshift
+        (compute_chisq mode 0).
+
+        parameters
+        ----------
+        zind: int
+            redshift index
+        refmag: array of floats
+            reference magnitudes (ngal)
+        magerr: array of floats
+            magnitude errors (ngal x nmag)
+        color: array of floats
+            galaxy colors (ngal x ncol)
+        refmagerr: array of floats, optional
+            reference magnitude errors (ngal).  Default is no error.
+        magind: array of ints, optional
+            refmag indices for the luptitude correction.  Default is no
+            correction.
+        calc_chisq: bool, optional
+            compute the chisq (default True)
+        calc_lkhd: bool, optional
+            compute the likelihood (default False)
+        nophotoerr: bool, optional
+            do not add the photometric errors (default False)
+        nthreads: int, optional
+            number of threads (default 1)
+
+        returns
+        -------
+        chisq and/or lkhd: array(s) of floats (ngal)
+        """
+        _refmag = np.ascontiguousarray(np.atleast_1d(refmag), dtype=self.dtype)
+        ngal = _refmag.size
+        _magerr = np.ascontiguousarray(np.atleast_2d(magerr), dtype=self.dtype)
+        _color = np.ascontiguousarray(np.atleast_2d(color), dtype=self.dtype)
+
+        if magind is None:
+            _lupcorr = np.zeros((ngal, self.ncol), dtype=self.dtype)
+        else:
+            _lupcorr = self.lupcorr[magind, zind, :].reshape(ngal, self.ncol)
+
+        if nophotoerr and refmagerr is None:
+            dc = (self.c[zind, :] + self.slope[zind, :] * (_refmag[:, np.newaxis] - self.pivotmag[zind])) + _lupcorr - _color
+            chisq, lkhd = self._compute_intrinsic(np.atleast_1d(zind), dc[:, np.newaxis, :])
+            return self._select(chisq[:, 0], lkhd[:, 0], calc_chisq, calc_lkhd)
+
+        if refmagerr is None:
+            _refmagerr = np.zeros(ngal, dtype=self.dtype)
+        else:
+            _refmagerr = np.ascontiguousarray(np.atleast_1d(refmagerr), dtype=self.dtype)
+
+        if self.dtype != np.float64:
+            chisq, lkhd = _compute_chisq_numpy(0, self.ncol, self.covmat[zind], self.c[zind],
+                                               self.slope[zind], self.pivotmag[zind: zind + 1],
+                                               _refmag, _refmagerr, _magerr, _color, _lupcorr,
+                                               nophotoerr, sigint=self.sigint)
+            return self._select(chisq, lkhd, calc_chisq, calc_lkhd)
+
+        _chisq_dist = _chisq_dist_pywrap.ChisqDist(0, ngal, 1, self.ncol,
+                                                   self.covmat[zind],
+                                                   self.c[zind],
+                                                   self.slope[zind],
+                                                   self.pivotmag[zind: zind + 1],
+                                                   _refmag,
+                                                   _refmagerr,
+                                                   _magerr,
+                                                   _color,
+                                                   _lupcorr,
+                                                   self.covmat_posdef[zind: zind + 1])
+
+        chisq, lkhd = self._run(_chisq_dist, calc_chisq, calc_lkhd, nophotoerr, nthreads)
+        return self._select(chisq, lkhd, calc_chisq, calc_lkhd)
+
+    def compute_grid(self, zinds, refmag, magerr, color, refmagerr=None, magind=None,
+                     calc_chisq=True, calc_lkhd=False, nophotoerr=False, nthreads=1):
+        """
+        Compute the chisq and/or likelihood for galaxies at every one of a
+        set of redshifts (compute_chisq mode 3).
+
+        parameters are as for compute(), with zinds an array of redshift
+        indices.
+
+        returns
+        -------
+        chisq and/or lkhd: array(s) of floats (ngal x nz)
+        """
+        _zinds = np.atleast_1d(zinds)
+        nz = _zinds.size
+        _refmag = np.ascontiguousarray(np.atleast_1d(refmag), dtype=self.dtype)
+        ngal = _refmag.size
+        _magerr = np.ascontiguousarray(np.atleast_2d(magerr), dtype=self.dtype)
+        _color = np.ascontiguousarray(np.atleast_2d(color), dtype=self.dtype)
+
+        if magind is None:
+            _lupcorr = np.zeros((ngal, nz, self.ncol), dtype=self.dtype)
+        else:
+            _lupcorr = self.lupcorr[np.atleast_1d(magind)[:, np.newaxis], _zinds[np.newaxis, :], :]
+
+        if nophotoerr and refmagerr is None:
+            dc = ((self.c[np.newaxis, _zinds, :] +
+                   self.slope[np.newaxis, _zinds, :] * (_refmag[:, np.newaxis, np.newaxis] - self.pivotmag[np.newaxis, _zinds, np.newaxis])) +
+                  _lupcorr - _color[:, np.newaxis, :])
+            chisq, lkhd = self._compute_intrinsic(_zinds, dc)
+            return self._select(chisq, lkhd, calc_chisq, calc_lkhd)
+
+        if refmagerr is None:
+            _refmagerr = np.zeros(ngal, dtype=self.dtype)
+        else:
+            _refmagerr = np.ascontiguousarray(np.atleast_1d(refmagerr), dtype=self.dtype)
+
+        if self.dtype != np.float64:
+            chisq, lkhd = _compute_chisq_numpy(3, self.ncol, np.transpose(self.covmat[_zinds], (1, 2, 0)),
+                                               self.c[_zinds], self.slope[_zinds], self.pivotmag[_zinds],
+                                               _refmag, _refmagerr, _magerr, _color, _lupcorr,
+                                               nophotoerr, sigint=self.sigint)
+            return self._select(chisq.reshape(ngal, nz), lkhd.reshape(ngal, nz), calc_chisq, calc_lkhd)
+
+        # The C code does not keep references, so these gathered tables
+        # must be held here.
+        _covmat = self.covmat[_zinds]
+        _c = self.c[_zinds]
+        _slope = self.slope[_zinds]
+        _pivotmag = self.pivotmag[_zinds]
+        _covmat_posdef = self.covmat_posdef[_zinds]
+
+        _chisq_dist = _chisq_dist_pywrap.ChisqDist(3, ngal, nz, self.ncol,
+                                                   _covmat,
+                                                   _c,
+                                                   _slope,
+                                                   _pivotmag,
+                                                   _refmag,
+                                                   _refmagerr,
+                                                   _magerr,
+                                                   _color,
+                                                   _lupcorr,
+                                                   _covmat_posdef)
+
+        chisq, lkhd = self._run(_chisq_dist, calc_chisq, calc_lkhd, nophotoerr, nthreads)
+        if calc_chisq:
+            chisq = chisq.reshape(ngal, nz)
+        if calc_lkhd:
+            lkhd = lkhd.reshape(ngal, nz)
+        return self._select(chisq, lkhd, calc_chisq, calc_lkhd)
+
+    def _compute_intrinsic(self, zinds, dc):
+        """
+        Compute chisq and lkhd from the intrinsic covmat Cholesky factors,
+        with dc (ngal, nz, ncol) the color offsets from the red sequence.
+        """
+        chisq = np.sum(_forward_substitute(self.chol[zinds], dc)**2., axis=-1)
+        lkhd = -0.5 * chisq - 0.5 * self.logdet[zinds]
+
+        bad = ~self.sigint_ok[zinds]
+        chisq[:, bad] = 1e11
+        lkhd[:, bad] = -1e11
+
+        return chisq, lkhd
+
+    def _run(self, _chisq_dist, calc_chisq, calc_lkhd, nophotoerr, nthreads):
+        """
+        Run the C code for the requested outputs.  Returns (chisq, lkhd),
+        with None for an output that was not requested.
+        """
+        chisq = None
+        lkhd = None
+        if calc_chisq:
+            chisq = _chisq_dist.compute(True, nophotoerr, nthreads)
+        if calc_lkhd:
+            lkhd = _chisq_dist.compute(False, nophotoerr, nthreads)
+
+        return chisq, lkhd
+
+    @staticmethod
+    def _select(chisq, lkhd, calc_chisq, calc_lkhd):
+        if calc_chisq and not calc_lkhd:
+            return chisq
+        elif not calc_chisq and calc_lkhd:
+            return lkhd
+        else:
+            return (chisq, lkhd)
+
+
+def _compute_chisq_numpy(mode, ncol, covmat, c, slope, pivotmag, refmag, refmagerr, magerr, color, lupcorr, nophotoerr, sigint=SIGINT_DEFAULT):
+    """
+    Compute the chisq and likelihood for all the calculations at once, with
+    stacked (ncalc, ncol, ncol) covariance matrices.  This follows
+    chisq_dist() in chisq_dist.c, with arrays already checked by
+    compute_chisq().
+
+    Returns (chisq, lkhd).
+    """
+
+    nmag = ncol + 1
+
+    if mode == 3:
+        # grid of galaxies x redshifts, flattened as igal*nz + iz
+        ngal = refmag.size
+        nz = c.shape[0]
+        ncalc = ngal * nz
+        cov = np.tile(np.transpose(covmat, (2, 0, 1)), (ngal, 1, 1))
+        slopes = np.tile(slope, (ngal, 1))
+        dc = ((c[np.newaxis, :, :] +
+               slope[np.newaxis, :, :] * (refmag[:, np.newaxis, np.newaxis] - pivotmag[np.newaxis, :, np.newaxis])) +
+              lupcorr - color[:, np.newaxis, :]).reshape(ncalc, ncol)
+        magerr = np.repeat(magerr, nz, axis=0)
+        refmagerr = np.repeat(refmagerr, nz)
+    elif mode == 0:
+        # one redshift, many galaxies
+        ncalc = refmag.size
+        cov = np.repeat(covmat[np.newaxis, :, :], ncalc, axis=0)
+        slopes = np.broadcast_to(slope, (ncalc, ncol))
+        dc = (c + slope * (refmag[:, np.newaxis] - pivotmag[0])) + lupcorr - color
+    else:
+        # covmat is ncol x ncol x ncalc
+        ncalc = c.shape[0]
+        cov = np.transpose(covmat, (2, 0, 1)).copy()
+        if mode == 1:
+            # one galaxy, many redshifts
+            slopes = slope
+            dc = (c + slope * (refmag[0] - pivotmag[:, np.newaxis])) + lupcorr - color[np.newaxis, :]
+        else:
+            # many galaxies, many redshifts.  Note that the C code uses
+            # the first slope for the refmag error term in this mode.
+            slopes = np.broadcast_to(slope[0, :], (ncalc, ncol))
+            dc = (c + slope * (refmag[:, np.newaxis] - pivotmag[:, np.newaxis])) + lupcorr - color
+
+    chisq = np.zeros(ncalc, dtype=cov.dtype) + 1e11
+    lkhd = np.zeros(ncalc, dtype=cov.dtype) - 1e11
+
+    # check sigint
+    good = np.all(np.diagonal(cov, axis1=1, axis2=2) >= sigint * sigint, axis=1)
+
+    gd, = np.where(good)
+    if gd.size == 0:
+        return (chisq, lkhd)
+
+    cov = cov[gd, :, :]
+    dc = dc[gd, :]
+
+    if not nophotoerr:
+        # rotate the magnitude errors to color errors, so that
+        # var(color_j) = var(mag_j) + var(mag_j+1), and
+        # covar(color_j, color_j+1) = -var(mag_j+1)
+        magvar = np.atleast_2d(magerr**2.)
+        if mode != 1:
+            magvar = magvar[gd, :]
+        for j in xrange(ncol):
+            cov[:, j, j] += magvar[:, j] + magvar[:, j + 1]
+            if j < ncol - 1:
+                cov[:, j, j + 1] -= magvar[:, j + 1]
+                cov[:, j + 1, j] -= magvar[:, j + 1]
+
+    # and the refmag error term
+    if mode == 1:
+        refmagvar = np.zeros(ncalc, dtype=cov.dtype) + refmagerr[0]**2.
+    else:
+        refmagvar = refmagerr**2.
+    cov += (slopes[gd, :, np.newaxis] * slopes[gd, np.newaxis, :] *
+            refmagvar[gd, np.newaxis, np.newaxis])
+
+    # check and fix the matrices if necessary
+    _fix_covmat_stacked(cov)
+
+    # chisq = dc^T C^-1 dc = |L^-1 dc|^2 with C = L L^T
+    chol, _ = _cholesky_stacked(cov)
+    vdc = _forward_substitute(chol, dc)
+    chisq[gd] = np.sum(vdc**2., axis=1)
+
+    # log(det(C)) = 2 * sum(log(diag(L)))
+    lkhd[gd] = -0.5 * chisq[gd] - np.sum(np.log(np.diagonal(chol, axis1=1, axis2=2)), axis=1)
+
+    return (chisq, lkhd)
+
+
+def _fix_covmat_stacked(cov):
+    """
+    Fix stacked (n, ncol, ncol) covariance matrices in place, clipping
+    eigenvalues below MIN_EIGENVAL, as check_and_fix_covmat() does.
+
+    A matrix has an eigenvalue below MIN_EIGENVAL if
+    (cov - MIN_EIGENVAL * I) is not positive definite, so only those
+    matrices need an eigendecomposition.
+    """
+    ncol = cov.shape[1]
+
+    _, posdef = _cholesky_stacked(cov - MIN_EIGENVAL * np.eye(ncol, dtype=cov.dtype))
+    fix, = np.where(~posdef)
+    if fix.size > 0:
+        eigenvals, eigenvecs = np.linalg.eigh(cov[fix, :, :])
+        if np.any(eigenvals < MIN_EIGENVAL):
+            eigenvals = np.clip(eigenvals, MIN_EIGENVAL, None)
+            cov[fix, :, :] = np.matmul(eigenvecs * eigenvals[:, np.newaxis, :],
+                                       np.transpose(eigenvecs, (0, 2, 1)))
+
+
+def _forward_substitute(chol, dc):
+    """
+    Solve L x = dc for lower triangular L, where chol (..., ncol, ncol) and
+    dc (..., ncol) broadcast against each other.
+    """
+    ncol = chol.shape[-1]
+
+    vdc = np.zeros(np.broadcast(chol[..., 0], dc).shape, dtype=np.result_type(chol, dc))
+    for j in xrange(ncol):
+        vdc[..., j] = (dc[..., j] - np.sum(chol[..., j, :j] * vdc[..., :j], axis=-1)) / chol[..., j, j]
+
+    return vdc
+
+
+def _cholesky_stacked(cov):
+    """
+    Cholesky decomposition of stacked (n, ncol, ncol) matrices, looping over
+    the (small) matrix dimension rather than the matrices.
+
+    Returns the lower triangular factors and whether each matrix is positive
+    definite (the factors of the other matrices are not meaningful).
+    """
+    ncol = cov.shape[1]
+
+    chol = np.zeros_like(cov)
+    posdef = np.ones(cov.shape[0], dtype=np.bool)
+    for j in xrange(ncol):
+        diag = cov[:, j, j] - np.sum(chol[:, j, :j]**2., axis=1)
+        posdef &= (diag > 0.0)
+        chol[:, j, j] = np.sqrt(np.where(diag > 0.0, diag, 1.0))
+        for i in xrange(j + 1, ncol):
+            chol[:, i, j] = (cov[:, i, j] - np.sum(chol[:, i, :j] * chol[:, j, :j], axis=1)) / chol[:, j, j]
+
+    return chol, posdef
@@ -40,6 +40,7 @@ ChisqDistObject_init(struct ChisqDistObject* self, PyObject* args)
     PyArrayObject *magerr_obj = NULL;
     PyArrayObject *color_obj = NULL;
     PyArrayObject *lupcorr_obj = NULL;
+    PyObject *covmat_posdef_obj = NULL;
 
     // debug
     // int i,j,k,stride;
@@ -47,7 +48,7 @@ ChisqDistObject_init(struct ChisqDistObject* self, PyObject* args)
     self->allocated = 0;
 
     if (!PyArg_ParseTuple(args,
-			  (char*)"iiiiOOOOOOOOO",
+			  (char*)"iiiiOOOOOOOOO|O",
 			  &mode,
 			  &ngal,
 			  &nz,
@@ -60,7 +61,8 @@ ChisqDistObject_init(struct ChisqDistObject* self, PyObject* args)
 			  &refmagerr_obj,
 			  &magerr_obj,
 			  &color_obj,
-			  &lupcorr_obj)){
+			  &lupcorr_obj,
+			  &covmat_posdef_obj)){
 	PyErr_SetString(PyExc_RuntimeError,"Failed to parse init");
 	return -1;
     }
@@ -84,9 +86,16 @@ ChisqDistObject_init(struct ChisqDistObject* self, PyObject* args)
     self->chisq_dist->magerr = (double *) PyArray_DATA(magerr_obj);
     self->chisq_dist->color = (double *) PyArray_DATA(color_obj);
     self->chisq_dist->lupcorr = (double *) PyArray_DATA(lupcorr_obj);
+    if (covmat_posdef_obj == NULL || covmat_posdef_obj == Py_None) {
+	self->chisq_dist->covmat_posdef = NULL;
+    } else {
+	self->chisq_dist->covmat_posdef = (int *) PyArray_DATA((PyArrayObject*)covmat_posdef_obj);
+    }
 
     if (self->chisq_dist->mode == 0) {
 	self->chisq_dist->ncalc = ngal;
+    } else if (self->chisq_dist->mode == 3) {
+	self->chisq_dist->ncalc = ngal*nz;
     } else {
 	self->chisq_dist->ncalc = nz;
     }
@@ -113,6 +122,7 @@ PyObject* ChisqDistObject_compute(const struct ChisqDistObject* self, PyObject *
     PyObject* chisq_obj = NULL;
     double *chisq;
     int do_chisq, nophotoerr;
+    int nthreads = 1;
 
     dims[0] = self->chisq_dist->ncalc;
     chisq_obj = PyArray_ZEROS(1, dims, NPY_FLOAT64, 0);
@@ -121,25 +131,29 @@ PyObject* ChisqDistObject_compute(const struct ChisqDistObject* self, PyObject *
 
     // parse the args
     if (!PyArg_ParseTuple(args,
-			  (char*)"ii",
+			  (char*)"ii|i",
 			  &do_chisq,
-			  &nophotoerr)) {
+			  &nophotoerr,
+			  &nthreads)) {
 	PyErr_SetString(PyExc_RuntimeError,"Failed to parse args");
 	return chisq_obj;
     }
 
-    // and do the work.
+    // and do the work, without the GIL
+    Py_BEGIN_ALLOW_THREADS
     chisq_dist(self->chisq_dist->mode, do_chisq, nophotoerr, self->chisq_dist->ncalc,
-	       self->chisq_dist->ncol, self->chisq_dist->covmat, self->chisq_dist->c,
+	       self->chisq_dist->nz, self->chisq_dist->ncol, self->chisq_dist->covmat, self->chisq_dist->c,
 	       self->chisq_dist->slope, self->chisq_dist->pivotmag, self->chisq_dist->refmag,
 	       self->chisq_dist->refmagerr, self->chisq_dist->magerr, self->chisq_dist->color,
-	       self->chisq_dist->lupcorr, chisq, self->chisq_dist->sigint);
+	       self->chisq_dist->lupcorr, chisq, self->chisq_dist->sigint,
+	       self->chisq_dist->covmat_posdef, nthreads);
+    Py_END_ALLOW_THREADS
 
     return chisq_obj;
 }
 
 static PyMethodDef ChisqDistObject_methods[] = {
-    {"compute", (PyCFunction)ChisqDistObject_compute, METH_VARARGS, "compute()"},
+    {"compute", (PyCFunction)ChisqDistObject_compute, METH_VARARGS, "compute(do_chisq, nophotoerr, nthreads=1)"},
     {NULL} /* Sentinel */
 };
 
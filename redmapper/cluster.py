@@ -9,9 +9,9 @@ import scipy.optimize
 import scipy.integrate
 import copy
 
-from .solver_nfw import Solver
+from .solver_nfw import Solver, solve_nfw_batch
 from .catalog import Catalog, Entry
-from .utilities import chisq_pdf, calc_theta_i, MStar
+from .utilities import chisq_pdf, calc_theta_i, MStar, nfw_sigma, get_nfw_sigma_table
 from .mask import HPMask
 from .chisq_dist import ChisqDist
 from .redsequence import RedSequenceColorPar
@@ -39,6 +39,7 @@ cluster_dtype_base = [('MEM_MATCH_ID', 'i4'),
                       ('ZRED_E', 'f4'),
                       ('CHISQ', 'f4'),
                       ('Z_LAMBDA_NITER', 'i2'),
+                      ('LAMBDA_NITER', 'i2'),
                       ('EBV_MEAN', 'f4'),
                       ('LNLAMLIKE', 'f4'),
                       ('LNCGLIKE', 'f4'),
@@ -76,6 +77,196 @@ member_dtype_base = [('MEM_MATCH_ID', 'i4'),
                      ('EBV', 'f4'),
                      ('ZSPEC', 'f4')]
 
+# Per-cluster working columns for the neighbors
+neighbor_extra_dtype = [('R', 'f8'),
+                        ('DIST', 'f8'),
+                        ('CHISQ', 'f8'),
+                        ('PFREE', 'f8'),
+                        ('THETA_I', 'f8'),
+                        ('THETA_R', 'f8'),
+                        ('P', 'f8'),
+                        ('PCOL', 'f8'),
+                        ('PMEM', 'f8'),
+                        ('INDEX', 'i8')]
+
+
+class ClusterNeighbors(GalaxyCatalog):
+    """
+    Class to hold the neighbors of a cluster.
+
+    The galaxy columns are not copied: they are read from the parent galaxy
+    catalog through an index (and are a view when there is no index), and
+    are only gathered for the columns that are used.  The per-cluster
+    working columns (r, dist, chisq, pfree, theta_i, theta_r, p, pcol, pmem,
+    index) are held in separate preallocated arrays, and a copy only
+    duplicates these.
+
+    parameters
+    ----------
+    galcat: GalaxyCatalog
+       parent galaxy catalog
+    indices: integer array, optional
+       indices of the neighbors in galcat.  Default is all of galcat.
+    """
+
+    def __init__(self, galcat, indices=None):
+        self._set_parent(galcat._ndarray, indices, galcat.depth)
+
+        # Allocate the working columns, taking any values that are
+        # in the parent catalog.
+        for name, dt in neighbor_extra_dtype:
+            name = name.lower()
+            if name in self._parent.dtype.names:
+                self._scratch[name] = self._get_base(name).copy()
+            else:
+                self._scratch[name] = np.zeros(self.size, dtype=dt)
+                if name == 'pfree':
+                    # The PFREE is new, so we must set it to 1s
+                    self._scratch[name][:] = 1.0
+
+    @classmethod
+    def _from_parent(cls, parent, indices, depth, scratch):
+        """
+        Make a ClusterNeighbors with the given working columns.
+        """
+        neighbors = cls.__new__(cls)
+        neighbors._set_parent(parent, indices, depth)
+        neighbors._scratch.update(scratch)
+        return neighbors
+
+    def _set_parent(self, parent, indices, depth):
+        self._parent = parent
+        self._indices = indices
+        self._scratch = {}
+        self._cache = {}
+        self._written = set()
+        self._htm_matcher = None
+        self.depth = depth
+
+    @property
+    def size(self):
+        if self._indices is None:
+            return self._parent.size
+        return self._indices.size
+
+    @property
+    def dtype(self):
+        dtype = [(name, self._parent.dtype[name]) for name in self._parent.dtype.names
+                 if name not in self._scratch]
+        dtype.extend([(name, self._scratch[name].dtype) for name in self._scratch])
+        return np.dtype(dtype)
+
+    @property
+    def _ndarray(self):
+        # This is a full (copied) record array of the neighbors
+        array = np.zeros(self.size, dtype=self.dtype)
+        for name in array.dtype.names:
+            array[name] = self.__getattr__(name)
+        return array
+
+    def _get_base(self, name):
+        """
+        Get a galaxy column from the parent catalog.
+        """
+        if name not in self._cache:
+            if self._indices is None:
+                self._cache[name] = self._parent[name]
+            else:
+                self._cache[name] = self._parent[name][self._indices]
+        return self._cache[name]
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+
+        name = attr.lower()
+        if name in self._scratch:
+            return self._scratch[name]
+        if name in self._parent.dtype.names:
+            return self._get_base(name)
+
+        raise AttributeError(attr)
+
+    def __setattr__(self, attr, val):
+        name = attr.lower()
+        if attr.startswith('_') or attr == 'depth':
+            object.__setattr__(self, attr, val)
+        elif name in self._scratch:
+            self._scratch[name][:] = val
+        elif name in self._parent.dtype.names:
+            # Never write into the parent catalog
+            if name not in self._written:
+                self._cache[name] = np.array(self._get_base(name), copy=True)
+                self._written.add(name)
+            self._cache[name][:] = val
+        else:
+            object.__setattr__(self, attr, val)
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self.entry_class(self[np.atleast_1d(key)]._ndarray[0])
+
+        if self._indices is None:
+            indices = np.arange(self._parent.size)[key]
+        else:
+            indices = self._indices[key]
+
+        neighbors = ClusterNeighbors._from_parent(self._parent, indices, self.depth,
+                                                  {name: self._scratch[name][key] for name in self._scratch})
+        for name in self._written:
+            neighbors._cache[name] = self._cache[name][key]
+            neighbors._written.add(name)
+        return neighbors
+
+    def copy(self):
+        """
+        Copy the neighbors.  Only the working columns (and any galaxy columns
+        that have been written to) are duplicated.
+        """
+        neighbors = ClusterNeighbors._from_parent(self._parent, self._indices, self.depth,
+                                                  {name: self._scratch[name].copy() for name in self._scratch})
+        for name in self._cache:
+            if name in self._written:
+                neighbors._cache[name] = self._cache[name].copy()
+                neighbors._written.add(name)
+            else:
+                neighbors._cache[name] = self._cache[name]
+        return neighbors
+
+
+class NeighborWorkingSet(object):
+    """
+    The neighbor columns used for the richness, gathered once as a struct
+    of contiguous arrays.
+
+    With no index the arrays are the neighbor columns themselves and
+    nothing is copied.  The working set can be passed to
+    RedSequenceColorPar.calculate_chisq in place of a GalaxyCatalog.
+
+    parameters
+    ----------
+    neighbors: ClusterNeighbors
+       neighbors of the cluster
+    index: integer array, optional
+       indices of the neighbors to gather.  Default is all.
+    """
+    __slots__ = ('size', 'r', 'refmag', 'refmag_err', 'mag', 'mag_err', 'pfree')
+
+    def __init__(self, neighbors, index=None):
+        for name in self.__slots__[1:]:
+            col = getattr(neighbors, name)
+            if index is not None:
+                col = col[index]
+            setattr(self, name, col)
+        self.size = self.refmag.size
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def galcol(self):
+        return self.mag[:, :-1] - self.mag[:, 1:]
+
 
 class Cluster(Entry):
     """
@@ -137,36 +328,22 @@ class Cluster(Entry):
 
     def set_neighbors(self, neighbors):
         """
+        Set the neighbors of the cluster.  A GalaxyCatalog is referenced
+        (not copied), and ClusterNeighbors have their working columns
+        copied.
         """
 
-        if (neighbors.__class__ is not GalaxyCatalog and neighbors is not None):
+        if (neighbors is not None and not isinstance(neighbors, GalaxyCatalog)):
             raise ValueError("Cluster neighbors must be a GalaxyCatalog")
 
         self.neighbors = None
         if (neighbors is not None):
-            self.neighbors = copy.deepcopy(neighbors)
-
-            # extra fields
-            neighbor_extra_dtype = [('R', 'f8'),
-                                    ('DIST', 'f8'),
-                                    ('CHISQ', 'f8'),
-                                    ('PFREE', 'f8'),
-                                    ('THETA_I', 'f8'),
-                                    ('THETA_R', 'f8'),
-                                    ('P', 'f8'),
-                                    ('PCOL', 'f8'),
-                                    ('PMEM', 'f8'),
-                                    ('INDEX', 'i8')]
-
-            dtype_augment = [dt for dt in neighbor_extra_dtype if dt[0].lower() not in self.neighbors.dtype.names]
-            if len(dtype_augment) > 0:
-                self.neighbors.add_fields(dtype_augment)
-
-            if 'PFREE' in [dt[0] for dt in dtype_augment]:
-                # The PFREE is new, so we must set it to 1s
-                self.neighbors.pfree[:] = 1.0
-
-    def find_neighbors(self, radius, galcat, megaparsec=False, maxmag=None):
+            if isinstance(neighbors, ClusterNeighbors):
+                self.neighbors = neighbors.copy()
+            else:
+                self.neighbors = ClusterNeighbors(neighbors)
+
+    def find_neighbors(self, radius, galcat, megaparsec=False, maxmag=None, matches=None):
         """
         parameters
         ----------
@@ -176,6 +353,10 @@ class Cluster(Entry):
             catalog of galaxies
         megaparsec: bool, optional, default False
             The radius is in mpc not degrees.
+        matches: tuple, optional
+            (indices, dists) of galaxies already matched within radius
+            (e.g., a slice of GalaxyCatalog.match_many_offsets()).
+            If set, the matching is skipped.
 
         This method is not finished or tested.
 
@@ -186,20 +367,23 @@ class Cluster(Entry):
         if galcat is None:
             raise ValueError("A GalaxyCatalog object must be specified.")
 
-        if megaparsec:
-            #radius_degrees = np.degrees(radius / self.cosmo.Da(0.0, self._redshift))
-            radius_degrees = radius / self.mpc_scale
+        if matches is not None:
+            indices, dists = matches
         else:
-            radius_degrees = radius
+            if megaparsec:
+                #radius_degrees = np.degrees(radius / self.cosmo.Da(0.0, self._redshift))
+                radius_degrees = radius / self.mpc_scale
+            else:
+                radius_degrees = radius
 
-        indices, dists = galcat.match_one(self.ra, self.dec, radius_degrees)
+            indices, dists = galcat.match_one(self.ra, self.dec, radius_degrees)
 
         if maxmag is not None:
             use, = np.where(galcat.refmag[indices] <= maxmag)
             indices = indices[use]
             dists = dists[use]
 
-        self.set_neighbors(galcat[indices])
+        self.neighbors = ClusterNeighbors(galcat, indices=indices)
         self.neighbors.dist = dists
         self.neighbors.index = indices
 
@@ -230,7 +414,7 @@ class Cluster(Entry):
         # copy the neighbors to a members subset
         pass
 
-    def _calc_radial_profile(self, idx=None, rscale=0.15):
+    def _calc_radial_profile(self, idx=None, rscale=0.15, r=None):
         """
         internal method for computing radial profile weights
 
@@ -240,54 +424,31 @@ class Cluster(Entry):
            indices to compute
         rscale: float
            r_s for nfw profile
+        r: float array (optional)
+           radii (Mpc) to use instead of self.neighbors.r[idx]
 
         returns
         -------
         sigx: array of floats
            sigma(x)
+
+        If config.nfw_sigma_table is set, sigma(x) is interpolated from a
+        table (see utilities.NFWSigmaTable).
         """
-        if idx is None:
-            idx = np.arange(len(self.neighbors))
+        if r is None:
+            if idx is None:
+                idx = np.arange(len(self.neighbors))
+            r = self.neighbors.r[idx]
 
         corer = 0.1
-        x, corex = self.neighbors.r[idx]/rscale, corer/rscale
-        sigx = np.zeros(self.neighbors.r[idx].size)
-
-        low, = np.where(x < corex)
-        mid, = np.where((x >= corex) & (x < 1.0))
-        high, = np.where((x >= 1.0) & (x < 10.0/rscale))
-        other, = np.where((x > 0.999) & (x < 1.001))
-
-        if low.size > 0:
-            arg = np.sqrt((1. - corex)/(1. + corex))
-            pre = 2./(np.sqrt(1. - corex**2))
-            front = 1./(corex**2 - 1)
-            sigx[low] = front * (1. - pre*0.5*np.log((1.+arg)/(1.-arg)))
-
-        if mid.size > 0:
-            arg = np.sqrt((1. - x[mid])/(1. + x[mid]))
-            pre = 2./(np.sqrt(1. - x[mid]**2))
-            front = 1./(x[mid]**2 - 1.)
-            sigx[mid] = front * (1. - pre*0.5*np.log((1.+arg)/(1.-arg)))
-
-        if high.size > 0:
-            arg = np.sqrt((x[high] - 1.)/(x[high] + 1.))
-            pre = 2./(np.sqrt(x[high]**2 - 1.))
-            front = 1./(x[high]**2 - 1)
-            sigx[high] = front * (1. - pre*np.arctan(arg))
-
-        if other.size > 0:
-            xlo, xhi = 0.999, 1.001
-            arglo, arghi = np.sqrt((1-xlo)/(1+xlo)), np.sqrt((xhi-1)/(xhi+1))
-            prelo, prehi = 2./np.sqrt(1.-xlo**2), 2./np.sqrt(xhi**2 - 1)
-            frontlo, fronthi = 1./(xlo**2 - 1), 1./(xhi**2 - 1)
-            testlo = frontlo * (1 - prelo*0.5*np.log((1+arglo)/(1-arglo)))
-            testhi = fronthi * (1 - prehi*np.arctan(arghi))
-            sigx[other] = (testlo + testhi)/2.
-
-        return sigx
-
-    def _calc_luminosity(self, normmag, idx=None):
+        rmax = 10.0
+
+        if self.config is not None and self.config.nfw_sigma_table:
+            return get_nfw_sigma_table(rscale, corer, rmax)(r)
+
+        return nfw_sigma(r/rscale, corer/rscale, rmax/rscale)
+
+    def _calc_luminosity(self, normmag, idx=None, redshift=None, refmag=None):
         """
         Internal method to compute luminosity filter
 
@@ -299,6 +460,10 @@ class Cluster(Entry):
             Normalization magnitude
         idx: int array (optional)
             Indices to compute
+        redshift: float (optional)
+            Redshift to use instead of the cluster redshift
+        refmag: float array (optional)
+            Magnitudes to use instead of self.neighbors.refmag[idx]
 
         returns
         -------
@@ -307,19 +472,19 @@ class Cluster(Entry):
 
         """
 
-        if idx is None:
-            idx = np.arange(len(self.neighbors))
+        if refmag is None:
+            if idx is None:
+                idx = np.arange(len(self.neighbors))
+            refmag = self.neighbors.refmag[idx]
+        if redshift is None:
+            redshift = self._redshift
 
-        zind = self.zredstr.zindex(self._redshift)
+        zind = self.zredstr.zindex(redshift)
         refind = self.zredstr.lumrefmagindex(normmag)
         normalization = self.zredstr.lumnorm[refind, zind]
-        mstar = self.zredstr.mstar(self._redshift)
-        phi_term_a = 10. ** (0.4 * (self.zredstr.alpha+1.)
-                                 * (mstar-self.neighbors.refmag[idx]))
-        phi_term_b = np.exp(-10. ** (0.4 * (mstar-self.neighbors.refmag[idx])))
-        return phi_term_a * phi_term_b / normalization
+        return self.zredstr.calc_lumphi(refmag, zind) / normalization
 
-    def calc_bkg_density(self, r, chisq, refmag):
+    def calc_bkg_density(self, r, chisq, refmag, redshift=None):
         """
         Internal method to compute background filter
 
@@ -328,6 +493,7 @@ class Cluster(Entry):
         r: radius (Mpc)
         chisq: chisq values at redshift of cluster
         refmag: total magnitude of galaxies
+        redshift: redshift to use instead of the cluster redshift (optional)
 
         returns
         -------
@@ -335,8 +501,13 @@ class Cluster(Entry):
         bcounts: float array
             b(x) for the cluster
         """
-        sigma_g = self.bkg.sigma_g_lookup(self._redshift, chisq, refmag)
-        return 2. * np.pi * r * (sigma_g/self.mpc_scale**2.)
+        if redshift is None:
+            redshift = self._redshift
+            mpc_scale = self.mpc_scale
+        else:
+            mpc_scale = np.radians(1.) * self.cosmo.Da(0, redshift)
+        sigma_g = self.bkg.sigma_g_lookup(redshift, chisq, refmag)
+        return 2. * np.pi * r * (sigma_g/mpc_scale**2.)
 
     def calc_cbkg_density(self, r, col_index, col, refmag):
         """
@@ -382,41 +553,32 @@ class Cluster(Entry):
         lam: cluster richness
 
         """
-        #set index for slicing self.neighbors
-        if index is not None:
-            idx = index
-        else:
-            idx = np.arange(len(self.neighbors))
+        # Gather the neighbor columns once; with no index these are the
+        # columns themselves.  out is used to write back the results.
+        ws = NeighborWorkingSet(self.neighbors, index=index)
+        out = slice(None) if index is None else index
 
-        #self.mstar = self.zredstr.mstar(self.z)
-
-        #maxmag = self.mstar(update=True) - 2.5*np.log10(self.config.lval_reference)
-        #self.neighbors.r = np.radians(self.neighbors.dist) * self.cosmo.Da(0, self._redshift)
         maxmag = self.mstar - 2.5 * np.log10(self.config.lval_reference)
 
-        # need to clip r at > 1e-6 or else you get a singularity
-        #self.neighbors.r[idx] = self.neighbors.r[idx].clip(min=1e-6)
+        # The chisq values are recorded, and used at the precision of
+        # the neighbor chisq column.
+        chisq = self.zredstr.calculate_chisq(ws, self._redshift)
+        self.neighbors.chisq[out] = chisq
+        chisq = chisq.astype(self.neighbors.chisq.dtype, copy=False)
 
-        self.neighbors.chisq[idx] = self.zredstr.calculate_chisq(self.neighbors[idx], self._redshift)
-        rho = chisq_pdf(self.neighbors.chisq[idx], self.zredstr.ncol)
-        nfw = self._calc_radial_profile(idx=idx)
-        phi = self._calc_luminosity(maxmag, idx=idx) #phi is lumwt in the IDL code
-        ucounts = (2*np.pi*self.neighbors.r[idx]) * nfw * phi * rho
-        bcounts = self.calc_bkg_density(self.neighbors.r[idx], self.neighbors.chisq[idx],
-                                         self.neighbors.refmag[idx])
+        rho = chisq_pdf(chisq, self.zredstr.ncol)
+        nfw = self._calc_radial_profile(r=ws.r)
+        phi = self._calc_luminosity(maxmag, refmag=ws.refmag) #phi is lumwt in the IDL code
+        ucounts = (2*np.pi*ws.r) * nfw * phi * rho
+        bcounts = self.calc_bkg_density(ws.r, chisq, ws.refmag)
 
-        theta_i = calc_theta_i(self.neighbors.refmag[idx], self.neighbors.refmag_err[idx],
-                               maxmag, self.zredstr.limmag)
+        theta_i = calc_theta_i(ws.refmag, ws.refmag_err, maxmag, self.zredstr.limmag)
 
         cpars = mask.calc_maskcorr(self.mstar, maxmag, self.zredstr.limmag)
 
-        try:
-            #w = theta_i * self.neighbors.wvals[idx]
-            w = theta_i * self.neighbors.pfree[idx]
-        except AttributeError:
-            w = theta_i * np.ones_like(ucounts)
+        w = theta_i * ws.pfree
 
-        richness_obj = Solver(self.r0, self.beta, ucounts, bcounts, self.neighbors.r[idx], w,
+        richness_obj = Solver(self.r0, self.beta, ucounts, bcounts, ws.r, w,
                               cpars = cpars, rsig = self.config.rsig)
 
         # Call the solving routine
@@ -424,6 +586,7 @@ class Cluster(Entry):
         # Note that pmem used to be called "wvals" in IDL code
         # pmem = p * pfree * theta_i * theta_r
         lam, p, pmem, rlam, theta_r = richness_obj.solve_nfw()
+        self.lambda_niter = richness_obj.niter
 
         # error
         bar_pmem = np.sum(pmem**2.0)/np.sum(pmem)
@@ -455,16 +618,16 @@ class Cluster(Entry):
             ucounts = rho*phi
 
             pcol = ucounts * lam/(ucounts * lam + bcounts)
-            bad, = np.where((self.neighbors.r[idx] > rlam) | (self.neighbors.refmag[idx] > maxmag) |
-                            (self.neighbors.refmag[idx] > self.zredstr.limmag) | (~np.isfinite(pcol)))
+            bad, = np.where((ws.r > rlam) | (ws.refmag > maxmag) |
+                            (ws.refmag > self.zredstr.limmag) | (~np.isfinite(pcol)))
             pcol[bad] = 0.0
 
             # and set the values
-            self.neighbors.theta_i[idx] = theta_i
-            self.neighbors.theta_r[idx] = theta_r
-            self.neighbors.p[idx] = p
-            self.neighbors.pcol[idx] = pcol
-            self.neighbors.pmem[idx] = pmem
+            self.neighbors.theta_i[out] = theta_i
+            self.neighbors.theta_r[out] = theta_r
+            self.neighbors.p[out] = p
+            self.neighbors.pcol[out] = pcol
+            self.neighbors.pmem[out] = pmem
 
         # set values and return
 
@@ -477,7 +640,7 @@ class Cluster(Entry):
 
         return lam
 
-    def calc_lambdaerr(self, maskgals, mstar, lam, rlam, cval, gamma):
+    def calc_lambdaerr(self, maskgals, mstar, lam, rlam, cval, gamma, redshift=None):
         """
         Calculate richness error
 
@@ -488,6 +651,7 @@ class Cluster(Entry):
         rlam     :
         cval     :
         gamma    : Local slope of the richness profile of galaxy clusters
+        redshift : Redshift to use instead of the cluster redshift (optional)
 
         returns
         -------
@@ -520,7 +684,7 @@ class Cluster(Entry):
         refmag_for_bcounts = np.copy(refmag)
         refmag_for_bcounts[faint] = limmag-0.01
 
-        bcounts = self.calc_bkg_density(r, chisq , refmag_for_bcounts)
+        bcounts = self.calc_bkg_density(r, chisq , refmag_for_bcounts, redshift=redshift)
 
         out, = np.where((refmag > limmag) | (mark == 0))
 
@@ -535,6 +699,104 @@ class Cluster(Entry):
 
         return lam_err
 
+    def calc_richness_derivatives(self, mask, redshifts, calc_err=True):
+        """
+        compute the richness of the cluster at a set of redshifts, with the
+        same neighbors.  This is used for the derivatives of lambda with
+        respect to redshift, and does not change the cluster or its neighbors.
+
+        The neighbor columns are gathered once, the chisq values at all
+        the redshifts are computed in one pass, and the richness is solved
+        for all the redshifts with one call to the c code.
+
+        parameters
+        ----------
+        mask: mask object
+        redshifts: float array
+           redshifts to compute the richness
+        calc_err: if False, no error calculated
+
+        returns
+        -------
+        lams: float array
+           richness at each redshift
+        lam_errs: float array
+           richness error at each redshift (0 if calc_err is False,
+           -1 if the richness could not be computed)
+        """
+        redshifts = np.atleast_1d(redshifts).astype(np.float64)
+        nz = redshifts.size
+        ngal = len(self.neighbors)
+
+        ws = NeighborWorkingSet(self.neighbors)
+        dist = self.neighbors.dist
+        r_dtype = ws.r.dtype
+
+        chisqs = self.zredstr.calculate_chisq_grid(ws, redshifts)
+        chisqs = chisqs.astype(self.neighbors.chisq.dtype, copy=False)
+
+        mstars = np.zeros(nz)
+        cvals = np.zeros((nz, 4))
+        ucounts = np.zeros(nz * ngal)
+        bcounts = np.zeros(nz * ngal)
+        r = np.zeros(nz * ngal)
+        w = np.zeros(nz * ngal)
+        offsets = np.arange(nz + 1, dtype=np.int64) * ngal
+
+        for i, z in enumerate(redshifts):
+            mstars[i] = self.zredstr.mstar(z)
+            maxmag = mstars[i] - 2.5 * np.log10(self.config.lval_reference)
+            mpc_scale = np.radians(1.) * self.cosmo.Da(0, z)
+
+            # r has the precision of the neighbor r column, as when
+            # the cluster redshift is set.
+            rz = np.clip(mpc_scale * dist, 1e-6, None).astype(r_dtype)
+            chisq = chisqs[:, i]
+
+            rho = chisq_pdf(chisq, self.zredstr.ncol)
+            nfw = self._calc_radial_profile(r=rz)
+            phi = self._calc_luminosity(maxmag, redshift=z, refmag=ws.refmag)
+
+            s = slice(offsets[i], offsets[i + 1])
+            r[s] = rz
+            ucounts[s] = (2*np.pi*rz) * nfw * phi * rho
+            bcounts[s] = self.calc_bkg_density(rz, chisq, ws.refmag, redshift=z)
+
+            theta_i = calc_theta_i(ws.refmag, ws.refmag_err, maxmag, self.zredstr.limmag)
+            w[s] = theta_i * ws.pfree
+
+            cvals[i, :] = mask.calc_maskcorr(mstars[i], maxmag, self.zredstr.limmag)
+
+        lams, p, pmem, rlams, theta_r, niter = solve_nfw_batch(self.r0, self.beta,
+                                                                ucounts, bcounts, r, w,
+                                                                offsets, cpars=cvals,
+                                                                rsig=self.config.rsig)
+
+        # The scaleval and lambda_e values are rounded to the precision of
+        # the cluster columns, to match calc_richness.
+        lam_errs = np.zeros(nz, dtype=np.float32)
+        for i, z in enumerate(redshifts):
+            lam = lams[i]
+            if lam < 0.0:
+                lam_errs[i] = -1.0
+                continue
+            if not calc_err:
+                continue
+
+            s = slice(offsets[i], offsets[i + 1])
+            bar_pmem = np.sum(pmem[s]**2.0)/np.sum(pmem[s])
+            cval = np.clip(np.sum(cvals[i, :] * rlams[i]**np.arange(cvals.shape[1], dtype=float)),
+                           0.0, None)
+            scaleval = np.float32(np.absolute(lam / np.sum(pmem[s])))
+            lam_unscaled = lam / scaleval
+
+            lam_cerr = self.calc_lambdaerr(mask.maskgals, mstars[i],
+                                           lam, rlams[i], cval, self.config.dldr_gamma,
+                                           redshift=z)
+            lam_errs[i] = np.sqrt((1-bar_pmem) * lam_unscaled * scaleval**2. + lam_cerr**2.)
+
+        return lams, lam_errs
+
     def calc_richness_fit(self, mask, col_index, centcolor_in=None, rcut=0.5, mingal=5, sigint=0.05, calc_err=False):
         """
         Compute richness for a cluster by fitting the red sequence in a single color.
@@ -717,8 +979,8 @@ class Cluster(Entry):
         return self.__copy__()
 
     def __copy__(self):
-        # This returns a copy of the cluster, and note that the neighbors will
-        # be deepcopied which is what we want.
+        # This returns a copy of the cluster, and note that the neighbor
+        # working columns will be copied which is what we want.
         return Cluster(r0=self.r0,
                        beta=self.beta,
                        config=self.config,
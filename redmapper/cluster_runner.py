@@ -4,20 +4,32 @@ from past.builtins import xrange
 import fitsio
 import numpy as np
 import esutil
+import healpy as hp
+import copy
+import types
+from multiprocessing import Pool
 from esutil.cosmology import Cosmo
 
+try:
+    import copy_reg as copyreg
+except ImportError:
+    import copyreg
+
 from .configuration import Configuration
 from .cluster import ClusterCatalog
 from .background import Background
 from .mask import get_mask
-from .galaxy import GalaxyCatalog
-from .catalog import Catalog
+from .galaxy import GalaxyCatalog, _galfile_indices
+from .catalog import Catalog, FitsTableWriter
 from .cluster import Cluster
 from .cluster import ClusterCatalog
 from .depthmap import DepthMap
 from .zlambda import Zlambda
 from .zlambda import ZlambdaCorrectionPar
 from .redsequence import RedSequenceColorPar
+from .utilities import _pickle_method
+
+copyreg.pickle(types.MethodType, _pickle_method)
 
 ###################################################
 # Order of operations:
@@ -29,6 +41,8 @@ from .redsequence import RedSequenceColorPar
 #    _process_cluster() [override this]
 #    _postprocess() [override this]
 #  output()
+#
+# or run_streaming() in place of run() and output()
 ###################################################
 
 class ClusterRunner(object):
@@ -48,6 +62,19 @@ class ClusterRunner(object):
         self.use_colorbkg = False
         self.use_parfile = True
 
+        # The galaxy columns needed by the runner (plus zred columns if
+        # read_zreds is set)
+        self.galaxy_columns = ['id', 'ra', 'dec', 'refmag', 'refmag_err',
+                               'mag', 'mag_err', 'ebv']
+
+        # Only set when running a single sky tile (see run_tiled)
+        self._tile_hpix = None
+
+        # Only set when streaming the output (see run_streaming)
+        self._stream_output = None
+        self._cat_writer = None
+        self._mem_writer = None
+
         # Will want to add stuff to check that everything needed is present?
 
         self._additional_initialization(**kwargs)
@@ -60,8 +87,11 @@ class ClusterRunner(object):
         self.runmode = None
         self.filetype = None
 
-    def _setup(self):
+    def _set_radii(self):
         """
+        Set the richness and masking radius parameters for the runmode.
+
+        maxrad is the maximum radius (Mpc) to match neighbors.
         """
         self.r0 = self.config.__getattribute__(self.runmode + '_r0')
         self.beta = self.config.__getattribute__(self.runmode + '_beta')
@@ -91,6 +121,11 @@ class ClusterRunner(object):
         if self.maxrad2 > self.maxrad:
             self.maxrad = self.maxrad2
 
+    def _setup(self):
+        """
+        """
+        self._set_radii()
+
         # read in background
         if self.use_colorbkg:
             self.cbkg = ColorBackground(self.config.bkgfile_color)
@@ -101,7 +136,8 @@ class ClusterRunner(object):
 
         # read in parameters
         if self.use_parfile:
-            self.zredstr = RedSequenceColorPar(self.config.parfile, fine=True)
+            self.zredstr = RedSequenceColorPar(self.config.parfile, fine=True,
+                                               cachepath=self.config.parfile_cachepath)
         else:
             self.zredstr = RedSequenceColorPar(None, config=self.config)
 
@@ -131,10 +167,16 @@ class ClusterRunner(object):
         # Use self.read_zreds to know if we should read them!
         # And self.zreds_required to know if we *must* read them
 
+        galaxy_columns = list(self.galaxy_columns)
+        if self.read_zreds:
+            galaxy_columns.extend(['zred', 'zred_e', 'zred_chisq'])
+
         self.gals = GalaxyCatalog.from_galfile(self.config.galfile,
                                                nside=self.config.nside,
                                                hpix=self.config.hpix,
-                                               border=self.config.border)
+                                               border=self.config.border,
+                                               columns=galaxy_columns,
+                                               nthreads=self.config.galfile_read_nthreads)
 
         # default limiting luminosity
         self.limlum = np.clip(self.config.lval_reference - 0.1, 0.01, None)
@@ -149,6 +191,9 @@ class ClusterRunner(object):
         self.record_members = False
         self.doublerun = False
 
+        # Number of clusters to match to the galaxies at a time
+        self.prematch_chunksize = 1000
+
     def _more_setup(self, *args, **kwargs):
         # This is to be overridden if necessary
         # this can receive all the keywords.
@@ -191,6 +236,10 @@ class ClusterRunner(object):
         # Setup specific for a given task.  Will read in the galaxy catalog.
         self._more_setup(*args, **kwargs)
 
+        # Cut down to the clusters in this tile if running tiled
+        if self._tile_hpix is not None:
+            self._cut_to_tile()
+
         # Match centers and galaxies if required
         if self.match_centers_to_galaxies:
             i0, i1, dist = self.gals.match_many(self.cat.ra, self.cat.dec, 1./3600.)
@@ -200,14 +249,20 @@ class ClusterRunner(object):
             self.cat.mag_err[i0, :] = self.gals.mag[i1, :]
             # do zred stuff when in...
 
+        if self._stream_output is not None:
+            self._open_output_streams()
+
         # loop over clusters...
-        # at the moment, we are doing the matching once per cluster.
-        # if this proves too slow we can prematch bulk clusters as in the IDL code
+        # the neighbors are matched in bulk for chunks of clusters (as in
+        # the IDL code), see _prematch_neighbors()
 
         if self.do_percolation_masking:
             self.pgal = np.zeros(self.gals.size, dtype=np.float32)
 
         self.members = None
+        # The members of each cluster are collected and concatenated once
+        # at the end, see _collect_members()
+        self._member_chunks = []
 
         if self.doublerun:
             nruniter = 2
@@ -227,11 +282,23 @@ class ClusterRunner(object):
                     self.do_percolation_masking = True
                     self.record_members = True
 
-            for cluster in self.cat:
+            for i, cluster in enumerate(self.cat):
                 # Note that the cluster is set with .z if available! (which becomes ._z)
 
+                if (i % self.prematch_chunksize) == 0:
+                    offsets, match_indices, match_dists = self._prematch_neighbors(i)
+                    chunk_start = i
+
+                lo = offsets[i - chunk_start]
+                hi = offsets[i - chunk_start + 1]
+
+                if (self._cat_writer is not None and
+                    (i - self._nstreamed) >= self.stream_batchsize):
+                    self._write_output_batch(i)
+
                 maxmag = cluster.mstar - 2.5*np.log10(self.limlum)
-                cluster.find_neighbors(self.maxrad, self.gals, megaparsec=True, maxmag=maxmag)
+                cluster.find_neighbors(self.maxrad, self.gals, megaparsec=True, maxmag=maxmag,
+                                       matches=(match_indices[lo: hi], match_dists[lo: hi]))
 
                 if cluster.neighbors.size == 0:
                     self._reset_bad_values(cluster)
@@ -279,18 +346,13 @@ class ClusterRunner(object):
 
                 # compute additional dlambda bits (if desired)
                 if self.do_lam_plusminus:
-                    cluster_temp = cluster.copy()
-
-                    #cluster_temp.z = cluster.z_lambda - self.config.zlambda_epsilon
-                    #cluster_temp.update_z(cluster.z_lambda - self.config.zlambda_epsilon)
-                    cluster_temp.redshift = cluster.z_lambda - self.config.zlambda_epsilon
-                    lam_zmeps = cluster_temp.calc_richness(self.mask)
-                    elambda_zmeps = cluster_temp.lambda_e
-                    #cluster_temp.z = cluster.z_lambda + self.config.zlambda_epsilon
-                    #cluster_temp.update_z(cluster.z_lambda + self.config.zlambda_epsilon)
-                    cluster_temp.redshift = cluster.z_lambda + self.config.zlambda_epsilon
-                    lam_zpeps = cluster_temp.calc_richness(self.mask)
-                    elambda_zpeps = cluster_temp.lambda_e
+                    # both redshifts are computed on the same neighbors,
+                    # without copying the cluster
+                    lams, elambdas = cluster.calc_richness_derivatives(self.mask,
+                                                                       [cluster.z_lambda - self.config.zlambda_epsilon,
+                                                                        cluster.z_lambda + self.config.zlambda_epsilon])
+                    lam_zmeps, lam_zpeps = lams
+                    elambda_zmeps, elambda_zpeps = elambdas
 
                     cluster.dlambda_dz = (np.log(lam_zpeps) - np.log(lam_zmeps)) / (2. * self.config.zlambda_epsilon)
                     cluster.dlambda_dz2 = (np.log(lam_zpeps) + np.log(lam_zmeps) - 2.*np.log(cluster.Lambda)) / (self.config.zlambda_epsilon**2.)
@@ -316,10 +378,6 @@ class ClusterRunner(object):
                         self.pgal[cluster.neighbors.index[u]] += cluster.neighbors.p[u]
 
                 # and save members
-                # Note that this is probably horribly inefficient for memory
-                #  usage right now, but will start here and fix later if it
-                #  is a problem.
-
                 pfree_temp = cluster.neighbors.pfree[:]
 
                 if self.use_memradius or self.use_memlum:
@@ -359,32 +417,207 @@ class ClusterRunner(object):
                     mem_temp.mag[:, :] = cluster.neighbors.mag[memuse, :]
                     mem_temp.mag_err[:, :] = cluster.neighbors.mag_err[memuse, :]
 
-                    # Worried this is going to be slow...
-                    if self.members is None:
-                        self.members = mem_temp
-                    else:
-                        self.members.append(mem_temp)
+                    self._member_chunks.append(mem_temp._ndarray)
+
+        if self._cat_writer is not None:
+            self._write_output_batch(self.cat.size)
 
+        self._collect_members()
 
         self._postprocess()
 
+    def _collect_members(self):
+        """
+        Concatenate the recorded members of all the clusters into self.members.
+
+        Appending to a Catalog copies it every time, so the members are kept
+        as a list of per-cluster arrays until the end of the run.
+        """
+        if len(self._member_chunks) > 0:
+            self.members = Catalog(np.concatenate(self._member_chunks))
+        self._member_chunks = []
+
+    def _prematch_neighbors(self, start):
+        """
+        Match the chunk of clusters starting at start to the galaxies in one
+        go, out to maxrad at each cluster redshift.
+
+        Returns (offsets, indices, dists), where the neighbors of cluster
+        start + j are indices[offsets[j]: offsets[j + 1]].
+        """
+
+        chunk = self.cat._ndarray[start: start + self.prematch_chunksize]
+
+        # Clusters without a redshift have no neighbors
+        radii = np.zeros(chunk.size)
+        good, = np.where(chunk['z'] > 0.0)
+        radii[good] = self.maxrad / (np.radians(1.) * self.cosmo.Da(0, chunk['z'][good]))
+
+        return self.gals.match_many_offsets(chunk['ra'], chunk['dec'], radii)
+
+    def run_tiled(self, nside_tile, *args, **kwargs):
+        """
+        Run split into healpix sky tiles, processed in parallel.
+
+        Each tile (ring order at nside_tile) is run in its own process on the
+        clusters whose centers are in the tile, with only the galaxies in the
+        tile plus a border read in.  The results are reassembled into
+        self.cat and self.members in the order of a serial run.
+
+        This is not valid with percolation masking, which depends on the
+        order in which all the clusters are processed.  The tiles that
+        overlap the (pixelized) galaxy catalog are run first, followed by
+        any other tiles that have input clusters in them.
+
+        parameters
+        ----------
+        nside_tile: int
+           healpix nside of the tiles
+        nproc: int, optional
+           number of processes to run.  Default is config.calib_nproc
+        border: float, optional
+           tile border (degrees).  Default is the largest angular maxrad
+           over zrange, padded by the resolution of the border trim.
+
+        All other args and kwargs are passed to run().
+        """
+
+        nproc = kwargs.pop('nproc', self.config.calib_nproc)
+        border = kwargs.pop('border', None)
+
+        if not self.config.galfile_pixelized:
+            raise ValueError("Tiled runs require a pixelized galfile")
+        if self.config.hpix > 0:
+            raise ValueError("Tiled runs cannot be combined with config.hpix")
+        if nside_tile > self.config.galfile_nside:
+            raise ValueError("nside_tile (%d) must not be larger than galfile nside (%d)" %
+                             (nside_tile, self.config.galfile_nside))
+
+        if border is None:
+            self._set_radii()
+            # Da is largest in the middle of the range, so the angular
+            # radius is largest at one of the ends.
+            da_min = min(self.config.cosmo.Da(0.0, self.config.zrange[0]),
+                         self.config.cosmo.Da(0.0, self.config.zrange[1]))
+            # The border trim works at 1/10th of the border.
+            border = 1.1 * np.degrees(self.maxrad / da_min)
+
+        # Which tiles cover the galaxy catalog?
+        tab = fitsio.read(self.config.galfile, ext=1, upper=True)
+        theta, phi = hp.pix2ang(tab[0]['NSIDE'], tab[0]['HPIX'])
+        tiles = np.unique(hp.ang2pix(nside_tile, theta, phi))
+
+        self._tile_nside = nside_tile
+        self._tile_border = border
+        self._tile_args = args
+        self._tile_kwargs = kwargs
+
+        pool = Pool(processes=nproc)
+        retvals = pool.map(self._tile_worker, tiles, chunksize=1)
+
+        # And any tiles with input clusters that have not been run.  These
+        # must still be within the border of some galaxies.
+        cluster_tiles = np.unique(np.concatenate([retval[3] for retval in retvals]))
+        extra_tiles = np.setdiff1d(cluster_tiles, tiles)
+        if extra_tiles.size > 0:
+            empty = [tile for tile in extra_tiles
+                     if _galfile_indices(tab, nside_tile, tile, border).size == 0]
+            if len(empty) > 0:
+                pool.close()
+                pool.join()
+                raise RuntimeError("Input clusters in tiles %s have no galaxies within the border; run serially" %
+                                   (str(empty)))
+            retvals.extend(pool.map(self._tile_worker, extra_tiles, chunksize=1))
+
+        pool.close()
+        pool.join()
+
+        # Put the clusters back in serial order, and the members in the
+        # order of their clusters.
+        cat = np.concatenate([retval[1] for retval in retvals])
+        order = np.concatenate([retval[0] for retval in retvals])
+        st = np.argsort(order, kind='mergesort')
+
+        self.cat = ClusterCatalog(cat[st], config=self.config)
+
+        members = [retval[2] for retval in retvals if retval[2] is not None]
+        if len(members) == 0:
+            self.members = None
+        else:
+            members = np.concatenate(members)
+            a, b = esutil.numpy_util.match(self.cat.mem_match_id, members['mem_match_id'])
+            cluster_pos = np.zeros(members.size, dtype=np.int64)
+            cluster_pos[b] = a
+            st = np.argsort(cluster_pos, kind='mergesort')
+            self.members = Catalog(members[st])
+
+    def _tile_worker(self, hpix):
+        """
+        Run a single sky tile.  Returns the serial-order positions of the
+        clusters, the cluster array, the member array (or None), and the
+        tiles of all the input clusters.
+        """
+
+        self.config.nside = self._tile_nside
+        self.config.hpix = hpix
+        self.config.border = self._tile_border
+        self._tile_hpix = hpix
+
+        self.run(*self._tile_args, **self._tile_kwargs)
+
+        if self.cat.size == 0:
+            order = np.zeros(0, dtype=np.int64)
+        else:
+            a, b = esutil.numpy_util.match(self._tile_ids, self.cat.mem_match_id)
+            order = np.zeros(self.cat.size, dtype=np.int64)
+            order[b] = self._tile_indices[a]
+
+        if self.members is None:
+            members = None
+        else:
+            members = self.members._ndarray
+
+        return (order, self.cat._ndarray, members, self._tile_cluster_tiles)
+
+    def _cut_to_tile(self):
+        """
+        Cut self.cat to the clusters with centers in the current tile.
+        """
+
+        if self.do_percolation_masking or self.doublerun:
+            raise RuntimeError("Tiled runs are not supported with percolation masking")
+
+        theta = (90.0 - self.cat.dec) * np.pi/180.
+        phi = self.cat.ra * np.pi/180.
+        ipring = hp.ang2pix(self.config.nside, theta, phi)
+
+        self._tile_cluster_tiles = np.unique(ipring)
+        self._tile_indices, = np.where(ipring == self._tile_hpix)
+        self._tile_ids = self.cat.mem_match_id[self._tile_indices]
+
+        self.cat = self.cat[self._tile_indices]
+
     def _postprocess(self):
         # default post-processing...
 
-        use, = np.where(self.cat.Lambda >= self.min_lambda)
+        use = self._output_selection(self.cat)
         self.cat = self.cat[use]
 
         # And crop down members?
         # FIXME
 
-    def output(self, savemembers=True, withversion=True, clobber=False):
+    def _output_selection(self, cat):
         """
+        Select the clusters to output.  This is applied to the full catalog
+        in _postprocess(), and to each batch in run_streaming().
         """
+        use, = np.where(cat.Lambda >= self.min_lambda)
+        return use
 
-        # Try with a universal method.
-        # It will save the underlying _ndarrays of the Cluster and
-        # (optionally) Member catalogs.
-
+    def _output_basename(self, withversion=True):
+        """
+        Get the base name of the output files.
+        """
         fname_base = self.config.outbase
 
         if withversion:
@@ -392,6 +625,101 @@ class ClusterRunner(object):
 
         fname_base += '_' + self.filetype
 
+        return fname_base
+
+    def run_streaming(self, *args, **kwargs):
+        """
+        Run, writing the clusters (and members) to the output files in
+        batches as they are finished, rather than all at the end with
+        output().
+
+        The output files are written with a '.partial' suffix and renamed
+        when the run is complete.  If the run fails the partial files are
+        left with the clusters finished so far.  Members written to disk are
+        not kept in self.members.
+
+        parameters
+        ----------
+        savemembers: bool, optional
+           write the members file.  Default is True.
+        withversion: bool, optional
+           put the version in the file names.  Default is True.
+        clobber: bool, optional
+           overwrite existing files.  Default is False.
+        batchsize: int, optional
+           number of clusters to write at a time.  Default is 1000.
+
+        All other args and kwargs are passed to run().
+        """
+        self._stream_output = (kwargs.pop('savemembers', True),
+                               kwargs.pop('withversion', True),
+                               kwargs.pop('clobber', False))
+        self.stream_batchsize = kwargs.pop('batchsize', 1000)
+
+        try:
+            self.run(*args, **kwargs)
+        except:
+            self._close_output_streams(abort=True)
+            raise
+
+        self._close_output_streams()
+
+    def _open_output_streams(self):
+        """
+        Open the output writers for run_streaming().
+        """
+        if self.doublerun:
+            raise RuntimeError("Cannot stream the output of a doublerun.")
+
+        savemembers, withversion, clobber = self._stream_output
+        fname_base = self._output_basename(withversion=withversion)
+
+        self._cat_writer = FitsTableWriter(fname_base + '.fit', self.cat.dtype, clobber=clobber)
+        if savemembers and self.record_members:
+            dtype = Catalog.zeros(0, dtype=self.config.member_dtype).dtype
+            self._mem_writer = FitsTableWriter(fname_base + '_members.fit', dtype, clobber=clobber)
+        self._nstreamed = 0
+
+    def _write_output_batch(self, end):
+        """
+        Write the finished clusters up to end, and their members.
+        """
+        batch = self.cat[self._nstreamed: end]
+        self._cat_writer.append(batch[self._output_selection(batch)])
+
+        if self._mem_writer is not None:
+            if len(self._member_chunks) > 0:
+                self._mem_writer.append(np.concatenate(self._member_chunks))
+            self._member_chunks = []
+
+        self._nstreamed = end
+
+    def _close_output_streams(self, abort=False):
+        """
+        Close (or abort) the output writers for run_streaming().
+        """
+        for writer in [self._cat_writer, self._mem_writer]:
+            if writer is None:
+                continue
+            if abort:
+                writer.abort()
+            else:
+                writer.close()
+
+        self._stream_output = None
+        self._cat_writer = None
+        self._mem_writer = None
+
+    def output(self, savemembers=True, withversion=True, clobber=False):
+        """
+        """
+
+        # Try with a universal method.
+        # It will save the underlying _ndarrays of the Cluster and
+        # (optionally) Member catalogs.
+
+        fname_base = self._output_basename(withversion=withversion)
+
         fitsio.write(fname_base + '.fit', self.cat._ndarray, clobber=clobber)
 
         if savemembers:
@@ -219,7 +219,10 @@ class ColorBackgroundGenerator(object):
         self.config = config
         self.minrangecheck = minrangecheck
 
-    def run(self, clobber=False):
+        # The galaxy columns needed to compute the color background
+        self.galaxy_columns = ['refmag', 'mag']
+
+    def run(self, clobber=False, natatime=100000):
         """
         """
 
@@ -228,12 +231,6 @@ class ColorBackgroundGenerator(object):
             print("Found %s and clobber is False" % (self.config.bkgfile_color))
             return
 
-        # read in the galaxies
-        gals = GalaxyCatalog.from_galfile(self.config.galfile,
-                                          nside=self.config.nside,
-                                          hpix=self.config.hpix,
-                                          border=self.config.border)
-
         # Generate ranges based on the data
         refmagbinsize = 0.1
 
@@ -242,19 +239,28 @@ class ColorBackgroundGenerator(object):
         nmag = self.config.nmag
         ncol = nmag - 1
 
-        col = gals.galcol
-
         colrange_default = np.array([-2.0, 5.0])
 
         colranges = np.zeros((2, ncol))
         colbinsize = 0.1
-        for i in xrange(ncol):
-            use, = np.where((col[:, i] > colrange_default[0]) &
-                            (col[:, i] < colrange_default[1]) &
-                            (gals.refmag < (self.config.limmag_ref - 0.5)))
 
-            h = esutil.stat.histogram(col[use, i], min=colrange_default[0],
-                                      max=colrange_default[1], binsize=colbinsize)
+        # First pass over the galaxies for the color histograms
+        hists = [None] * ncol
+        for gals in self._iter_galaxies(natatime):
+            col = gals.galcol
+            for i in xrange(ncol):
+                use, = np.where((col[:, i] > colrange_default[0]) &
+                                (col[:, i] < colrange_default[1]) &
+                                (gals.refmag < (self.config.limmag_ref - 0.5)))
+                if use.size == 0:
+                    continue
+
+                h = esutil.stat.histogram(col[use, i], min=colrange_default[0],
+                                          max=colrange_default[1], binsize=colbinsize)
+                hists[i] = h if hists[i] is None else hists[i] + h
+
+        for i in xrange(ncol):
+            h = hists[i]
             bins = np.arange(h.size) * colbinsize + colrange_default[0]
 
             good, = np.where(h > self.minrangecheck)
@@ -265,32 +271,64 @@ class ColorBackgroundGenerator(object):
         nrefmag = np.ceil((refmagrange[1] - refmagrange[0]) / refmagbinsize).astype(np.int32)
         refmagbins = np.arange(nrefmag) * refmagbinsize + refmagrange[0]
 
+        ncolbins = np.ceil((colranges[1, :] - colranges[0, :]) / colbinsize).astype(np.int32)
+
+        # Second pass to accumulate the cic fields, which are additive
+        fields = {}
+        for gals in self._iter_galaxies(natatime):
+            col = gals.galcol
+            for i in xrange(ncol):
+                for j in xrange(i, ncol):
+                    if (i == j):
+                        # diagonal
+                        bad = ((col[:, i] < colranges[0, i]) |
+                               (col[:, i] >= colranges[1, i]) |
+                               (gals.refmag < refmagrange[0]) |
+                               (gals.refmag >= refmagrange[1]))
+
+                        colpos = (col[~bad, i] - colranges[0, i]) * ncolbins[i] / (colranges[1, i] - colranges[0, i])
+                        refmagpos = (gals.refmag[~bad] - refmagrange[0]) * nrefmag / (refmagrange[1] - refmagrange[0])
+
+                        value = np.ones(np.sum(~bad))
+                        field = cic(value, colpos, ncolbins[i], refmagpos, nrefmag, isolated=True)
+                    else:
+                        # off-diagonal
+                        bad = ((col[:, i] < colranges[0, i]) |
+                               (col[:, i] >= colranges[1, i]) |
+                               (col[:, j] < colranges[0, j]) |
+                               (col[:, j] >= colranges[1, j]) |
+                               (gals.refmag < refmagrange[0]) |
+                               (gals.refmag >= refmagrange[1]))
+
+                        col1pos = (col[~bad, i] - colranges[0, i]) * ncolbins[i] / (colranges[1, i] - colranges[0, i])
+                        col2pos = (col[~bad, j] - colranges[0, j]) * ncolbins[j] / (colranges[1, j] - colranges[0, j])
+                        refmagpos = (gals.refmag[~bad] - refmagrange[0]) * nrefmag / (refmagrange[1] - refmagrange[0])
+
+                        value = np.ones(np.sum(~bad))
+                        field = cic(value, col1pos, ncolbins[i], col2pos, ncolbins[j], refmagpos, nrefmag, isolated=True)
+
+                    # need to fix cic...
+                    bad = ~np.isfinite(field)
+                    field[bad] = 0.0
+
+                    if (i, j) in fields:
+                        fields[(i, j)] += field
+                    else:
+                        fields[(i, j)] = field
+
         depthstr = DepthMap(self.config)
         areas = depthstr.calc_areas(refmagbins)
 
         for i in xrange(ncol):
             for j in xrange(i, ncol):
+                field = fields[(i, j)]
+
                 if (i == j):
                     # diagonal
-                    ncoldiag = np.ceil((colranges[1, i] - colranges[0, i]) / colbinsize).astype(np.int32)
+                    ncoldiag = ncolbins[i]
                     coldiagbins = np.arange(ncoldiag) * colbinsize + colranges[0, i]
                     binsizes = refmagbinsize * colbinsize
 
-                    bad = ((col[:, i] < colranges[0, i]) |
-                           (col[:, i] >= colranges[1, i]) |
-                           (gals.refmag < refmagrange[0]) |
-                           (gals.refmag >= refmagrange[1]))
-
-                    colpos = (col[~bad, i] - colranges[0, i]) * ncoldiag / (colranges[1, i] - colranges[0, i])
-                    refmagpos = (gals[~bad].refmag - refmagrange[0]) * nrefmag / (refmagrange[1] - refmagrange[0])
-
-                    value = np.ones(np.sum(~bad))
-                    print("Running CIC on %d, %d" % (i, j))
-                    field = cic(value, colpos, ncoldiag, refmagpos, nrefmag, isolated=True)
-                    # need to fix cic...
-                    bad = ~np.isfinite(field)
-                    field[bad] = 0.0
-
                     bc = field.astype(np.float32) / binsizes
                     n = np.sum(bc, axis=1) * colbinsize
 
@@ -324,31 +362,13 @@ class ColorBackgroundGenerator(object):
 
                 else:
                     # off-diagonal
-
-                    ncol1 = np.ceil((colranges[1, i] - colranges[0, i]) / colbinsize).astype(np.int32)
+                    ncol1 = ncolbins[i]
                     col1bins = np.arange(ncol1) * colbinsize + colranges[0, i]
-                    ncol2 = np.ceil((colranges[1, j] - colranges[0, j]) / colbinsize).astype(np.int32)
+                    ncol2 = ncolbins[j]
                     col2bins = np.arange(ncol2) * colbinsize + colranges[0, j]
 
                     binsizes = refmagbinsize * colbinsize * colbinsize
 
-                    bad = ((col[:, i] < colranges[0, i]) |
-                           (col[:, i] >= colranges[1, i]) |
-                           (col[:, j] < colranges[0, j]) |
-                           (col[:, j] >= colranges[1, j]) |
-                           (gals.refmag < refmagrange[0]) |
-                           (gals.refmag >= refmagrange[1]))
-
-                    col1pos = (col[~bad, i] - colranges[0, i]) * ncol1 / (colranges[1, i] - colranges[0, i])
-                    col2pos = (col[~bad, j] - colranges[0, j]) * ncol2 / (colranges[1, j] - colranges[0, j])
-                    refmagpos = (gals[~bad].refmag - refmagrange[0]) * nrefmag / (refmagrange[1] - refmagrange[0])
-
-                    value = np.ones(np.sum(~bad))
-                    print("Running CIC on %d, %d" % (i, j))
-                    field = cic(value, col1pos, ncol1, col2pos, ncol2, refmagpos, nrefmag, isolated=True)
-                    bad = ~np.isfinite(field)
-                    field[bad] = 0.0
-
                     bc = field.astype(np.float32) / binsizes
                     temp = np.sum(bc, axis=2) * colbinsize
                     n = np.sum(temp, axis=1) * colbinsize
@@ -400,5 +420,14 @@ class ColorBackgroundGenerator(object):
 
                 fitsio.write(self.config.bkgfile_color, outstr, extname=extname, header=hdr, clobber=startClobber)
 
+    def _iter_galaxies(self, natatime):
+        """
+        Iterate over the galaxies in the configured region in blocks.
+        """
+        return GalaxyCatalog.iter_chunks(self.config.galfile, chunksize=natatime,
+                                         columns=self.galaxy_columns,
+                                         region=(self.config.nside, self.config.hpix,
+                                                 self.config.border))
+
 
 
@@ -120,11 +120,13 @@ class Configuration(object):
 
     outpath = ConfigField(default='./', required=True)
     plotpath = ConfigField(default='', required=True)
+    parfile_cachepath = ConfigField()
 
     border = ConfigField(default=0.0, required=True)
     hpix = ConfigField(default=0, required=True)
     nside = ConfigField(default=0, required=True)
     galfile_pixelized = ConfigField(required=True)
+    galfile_read_nthreads = ConfigField(default=1, required=True)
 
     nmag = ConfigField(required=True)
     area = ConfigField(required=True)
@@ -147,6 +149,7 @@ class Configuration(object):
 
     dldr_gamma = ConfigField(default=0.6, required=True)
     rsig = ConfigField(default=0.05, required=True)
+    nfw_sigma_table = ConfigField(default=False)
     chisq_max = ConfigField(default=20.0, required=True)
     npzbins = ConfigField(default=21, required=True)
 
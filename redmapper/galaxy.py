@@ -8,9 +8,267 @@ import numpy as np
 import itertools
 import healpy as hp
 import os
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
 
 from .catalog import Catalog, Entry
 
+def columnar_store_path(galfile):
+    """
+    Get the path of the columnar store for a pixelized galfile.
+
+    parameters
+    ----------
+    galfile: string
+       name of the galfile master table
+
+    returns
+    -------
+    storepath: string
+       directory of the columnar store
+    """
+    return os.path.splitext(os.path.abspath(galfile))[0] + '_columns'
+
+def write_columnar_store(galfile, clobber=False):
+    """
+    Convert a pixelized galfile to a columnar store.
+
+    The store is a directory (see columnar_store_path) with one .npy file
+    per column, which can be memory mapped, with the rows of all the pixel
+    files in master table order.  index.npy records the row offset of each
+    pixel, and dtype.npy the record dtype.  This only needs to be done once,
+    after which GalaxyCatalog.from_galfile() will read from the store.  The
+    store is written to a temporary directory and renamed into place when
+    complete, so an interrupted write never leaves a partial store.
+
+    parameters
+    ----------
+    galfile: string
+       name of the galfile master table
+    clobber: bool, optional
+       overwrite an existing store.  Default is False.
+
+    returns
+    -------
+    storepath: string
+       directory of the columnar store
+    """
+
+    hdr = fitsio.read_header(galfile, ext=1)
+    if not hdr.get("PIXELS", 0) or not hdr.get("FITS", 0):
+        raise ValueError("Can only make a columnar store from a pixelized fits galfile")
+
+    storepath = columnar_store_path(galfile)
+    if os.path.isdir(storepath) and not clobber:
+        raise IOError("Columnar store %s already exists and clobber is False" % (storepath))
+
+    tab = fitsio.read(galfile, ext=1, upper=True)
+    path = os.path.dirname(os.path.abspath(galfile))
+
+    npix = tab[0]['HPIX'].size
+    index = np.zeros(npix, dtype=[('HPIX', 'i8'),
+                                  ('OFFSET', 'i8'),
+                                  ('NGALS', 'i8')])
+    index['HPIX'] = tab[0]['HPIX']
+    index['NGALS'] = tab[0]['NGALS']
+    index['OFFSET'][1:] = np.cumsum(index['NGALS'])[:-1]
+
+    elt = fitsio.read('%s/%s' % (path, tab[0]['FILENAMES'][0].decode()), ext=1, rows=0, upper=True)
+
+    tmppath = tempfile.mkdtemp(dir=os.path.dirname(storepath),
+                               prefix=os.path.basename(storepath) + '-tmp')
+    try:
+        _write_columnar_store(tmppath, path, tab, index, elt.dtype)
+    except:
+        shutil.rmtree(tmppath)
+        raise
+
+    if os.path.isdir(storepath):
+        shutil.rmtree(storepath)
+    os.rename(tmppath, storepath)
+
+    return storepath
+
+def _write_columnar_store(storepath, path, tab, index, dtype):
+    """
+    Write the columns, dtype.npy and index.npy of a columnar store.
+    """
+    ngal = np.sum(index['NGALS'])
+
+    columns = {}
+    for name in dtype.names:
+        columns[name] = np.lib.format.open_memmap(os.path.join(storepath, name + '.npy'),
+                                                  mode='w+', dtype=dtype[name].base,
+                                                  shape=(ngal, ) + dtype[name].shape)
+
+    for i in xrange(index.size):
+        gals = fitsio.read('%s/%s' % (path, tab[0]['FILENAMES'][i].decode()), ext=1, upper=True)
+        if gals.size != index['NGALS'][i]:
+            raise ValueError("Pixel file %s has %d galaxies, expected %d" %
+                             (tab[0]['FILENAMES'][i].decode(), gals.size, index['NGALS'][i]))
+        for name in dtype.names:
+            columns[name][index['OFFSET'][i]: index['OFFSET'][i] + gals.size] = gals[name]
+
+    for name in columns:
+        columns[name].flush()
+
+    np.save(os.path.join(storepath, 'dtype.npy'), np.zeros(0, dtype=dtype))
+    np.save(os.path.join(storepath, 'index.npy'), index)
+
+def _valid_columnar_store(galfile, tab):
+    """
+    Get the columnar store of a pixelized galfile, if it has been made and
+    matches the master table.
+
+    parameters
+    ----------
+    galfile: string
+       name of the galfile master table
+    tab: np.ndarray
+       galfile master table
+
+    returns
+    -------
+    storepath: string
+       directory of the columnar store, or None if there is no store or it
+       does not match the master table (e.g. the galfile was regenerated).
+    """
+    storepath = columnar_store_path(galfile)
+    if not os.path.isdir(storepath):
+        return None
+
+    try:
+        index = np.load(os.path.join(storepath, 'index.npy'))
+        np.load(os.path.join(storepath, 'dtype.npy'))
+    except (IOError, ValueError):
+        index = None
+
+    ngals = tab[0]['NGALS']
+    if (index is None or index.size != ngals.size or
+            not np.array_equal(index['HPIX'], tab[0]['HPIX']) or
+            not np.array_equal(index['NGALS'], ngals) or
+            not np.array_equal(index['OFFSET'][1:], np.cumsum(ngals)[:-1]) or
+            (index.size > 0 and index['OFFSET'][0] != 0)):
+        print('Warning: columnar store %s does not match %s; reading pixel files.' %
+              (storepath, galfile))
+        return None
+
+    return storepath
+
+def _select_columns(names, columns):
+    """
+    Select the requested columns (case insensitive) that are in names,
+    in the order of names.
+    """
+    columns_lower = [col.lower() for col in columns]
+    return [name for name in names if name.lower() in columns_lower]
+
+def _get_column(arr, name):
+    """
+    Get a column (case insensitive) from a record array.
+    """
+    for _name in arr.dtype.names:
+        if _name.lower() == name.lower():
+            return arr[_name]
+    raise ValueError("No column %s" % (name))
+
+def _in_pixel_border(ra, dec, nside, hpix, border):
+    """
+    Find which positions are in a healpix pixel (ring order), or within
+    border (degrees) of the pixel.
+
+    The border test is approximate: it uses the pixels at a finer nside
+    (resolution about 1/10th of the border) that overlap the discs of
+    radius border around the sampled pixel boundary, with the radius
+    padded by the boundary sampling.  Every position within border of
+    the pixel is kept, along with some slightly beyond it.
+    """
+    theta = np.radians(90.0 - dec)
+    phi = np.radians(ra)
+
+    inside = (hp.ang2pix(nside, theta, phi) == hpix)
+    if border <= 0.0:
+        return inside
+
+    nside_fine = nside
+    while (hp.nside2resol(nside_fine, arcmin=True) / 60. > border / 10. and
+           nside_fine < 65536):
+        nside_fine *= 2
+
+    boundaries = hp.boundaries(nside, hpix, step=nside_fine // nside)
+
+    # A point within border of the boundary is within border plus half the
+    # largest spacing of the boundary samples of one of them.
+    cosdist = np.sum(boundaries * np.roll(boundaries, 1, axis=1), axis=0)
+    spacing = np.max(np.arccos(np.clip(cosdist, -1.0, 1.0)))
+    radius = np.radians(border) + spacing / 2.
+
+    borderpix = np.unique(np.concatenate([hp.query_disc(nside_fine, boundaries[:, i],
+                                                        radius, inclusive=True, nest=True)
+                                          for i in xrange(boundaries.shape[1])]))
+
+    candidates, = np.where(~inside)
+    ipnest = hp.ang2pix(nside_fine, theta[candidates], phi[candidates], nest=True)
+    inside[candidates[np.in1d(ipnest, borderpix)]] = True
+
+    return inside
+
+def _check_region(nside, hpix, border):
+    """
+    Check a (nside, hpix, border) sub-region, and return hpix, or None
+    if hpix is 0 (the full catalog).
+    """
+    if hpix == 0:
+        _hpix = None
+    else:
+        _hpix = hpix
+    # do we have appropriate keywords
+    if _hpix is not None and nside is None:
+        raise ValueError("If hpix is specified, must also specify nside")
+    if border < 0.0:
+        raise ValueError("Border must be >= 0.0.")
+    # ensure that nside is valid, and hpix is within range (if necessary)
+    if nside > 0:
+        if not hp.isnsideok(nside):
+            raise ValueError("Nside not valid")
+        if _hpix is not None:
+            if _hpix < 0 or _hpix >= hp.nside2npix(nside):
+                raise ValueError("hpix out of range.")
+
+    return _hpix
+
+def _galfile_indices(tab, nside, hpix, border):
+    """
+    Find the indices of the galfile master table pixels that cover a
+    sub-region (hpix None for all of them).
+    """
+    nside_tab = tab[0]['NSIDE']
+    if nside > nside_tab:
+        raise ValueError("""Requested nside (%d) must not be larger than
+                                table nside (%d).""" % (nside, nside_tab))
+
+    if hpix is None:
+        # all of them!
+        return np.arange(tab[0]['FILENAMES'].size)
+
+    # first we need all the pixels that are contained in the big pixel
+    theta, phi = hp.pix2ang(nside_tab, tab[0]['HPIX'])
+    ipring_big = hp.ang2pix(nside, theta, phi)
+    indices, = np.where(ipring_big == hpix)
+    if border > 0.0:
+        # now we need to find the extra boundary...
+        boundaries = hp.boundaries(nside, hpix, step=nside_tab/nside)
+        inhpix = tab[0]['HPIX'][indices]
+        for i in xrange(boundaries.shape[1]):
+            pixint = hp.query_disc(nside_tab, boundaries[:,i],
+                            border*np.pi/180., inclusive=True, fact=8)
+            inhpix = np.append(inhpix, pixint)
+        inhpix = np.unique(inhpix)
+        _, indices = esutil.numpy_util.match(inhpix, tab[0]['HPIX'])
+
+    return indices
+
 class Galaxy(Entry):
     """
     """
@@ -39,7 +297,8 @@ class GalaxyCatalog(Catalog):
         #self._smatch_nside = 4096 if 'smatch_nside' not in kwargs else kwargs['smatch_nside']
 
     @classmethod
-    def from_galfile(cls, filename, nside=0, hpix=0, border=0.0):
+    def from_galfile(cls, filename, nside=0, hpix=0, border=0.0, use_store=True, columns=None,
+                     nthreads=1):
         """
         Name:
             from_galfile
@@ -55,25 +314,21 @@ class GalaxyCatalog(Catalog):
                 healpix nside of sub-pixel
             hpix: integer
                 healpix pixel (ring order) of sub-pixel
+            border: float
+                border (degrees) around the sub-pixel
+            use_store: bool
+                read from the columnar store (see write_columnar_store)
+                if it has been made.  Default is True.
+            columns: list of strings
+                columns to read (case insensitive).  Requested columns
+                that are not in the catalog are skipped.  Default is all.
+            nthreads: integer
+                maximum number of threads to read pixel files concurrently.
+                Default is 1 (serial).
         Outputs:
             A galaxy catalog object
         """
-        if hpix == 0:
-            _hpix = None
-        else:
-            _hpix = hpix
-        # do we have appropriate keywords
-        if _hpix is not None and nside is None:
-            raise ValueError("If hpix is specified, must also specify nside")
-        if border < 0.0:
-            raise ValueError("Border must be >= 0.0.")
-        # ensure that nside is valid, and hpix is within range (if necessary)
-        if nside > 0:
-            if not hp.isnsideok(nside):
-                raise ValueError("Nside not valid")
-            if _hpix is not None:
-                if _hpix < 0 or _hpix >= hp.nside2npix(nside):
-                    raise ValueError("hpix out of range.")
+        _hpix = _check_region(nside, hpix, border)
 
         # check that the file is there and the right format
         # this will raise an exception if it's not there.
@@ -81,7 +336,11 @@ class GalaxyCatalog(Catalog):
         pixelated, fitsformat = hdr.get("PIXELS", 0), hdr.get("FITS", 0)
 
         if not pixelated:
-            cat = fitsio.read(filename, ext=1, upper=True)
+            if columns is not None:
+                fits = fitsio.FITS(filename)
+                columns = _select_columns(fits[1].get_colnames(), columns)
+                fits.close()
+            cat = fitsio.read(filename, ext=1, columns=columns, upper=True)
             return cls(cat)
 
         # this is to keep us from trying to use old IDL galfiles
@@ -90,44 +349,218 @@ class GalaxyCatalog(Catalog):
 
         # now we can read in the galaxy table summary file...
         tab = fitsio.read(filename, ext=1, upper=True)
-        nside_tab = tab[0]['NSIDE']
-        if nside > nside_tab:
-            raise ValueError("""Requested nside (%d) must not be larger than
-                                    table nside (%d).""" % (nside, nside_tab))
 
         # which files do we want to read?
         path = os.path.dirname(os.path.abspath(filename))
-        if _hpix is None:
-            # all of them!
-            indices = np.arange(tab[0]['FILENAMES'].size)
+        indices = _galfile_indices(tab, nside, _hpix, border)
+
+        trim = (_hpix is not None and border > 0.0)
+        if trim and columns is not None:
+            # We need the positions to trim to the border
+            columns = list(columns) + ['ra', 'dec']
+
+        storepath = _valid_columnar_store(filename, tab) if use_store else None
+        if storepath is not None:
+            # read from the columnar store instead of the pixel files
+            cat = cls._read_columnar_store(storepath, indices, columns=columns)
+        else:
+            cat = cls._read_pixel_files(path, tab, indices, columns=columns, nthreads=nthreads)
+
+        if trim:
+            # Trim to the precise boundary requested, as in the IDL version
+            cat = cat[_in_pixel_border(_get_column(cat, 'ra'), _get_column(cat, 'dec'),
+                                       nside, _hpix, border)]
+
+        return cls(cat)
+
+    @classmethod
+    def iter_chunks(cls, galfile, chunksize=100000, columns=None, region=None, use_store=True):
+        """
+        Iterate over a galaxy catalog file in blocks of at most chunksize
+        galaxies, so that the full catalog is never in memory.
+
+        This works for both pixelized and flat galfiles.  Pixel files are
+        split across blocks as necessary.
+
+        parameters
+        ----------
+        galfile: string
+           name of the galaxy catalog file (or galfile master table)
+        chunksize: int, optional
+           maximum number of galaxies in each block.  Default is 100000.
+        columns: list of strings, optional
+           columns to read (case insensitive), as in from_galfile.
+           Default is all.
+        region: tuple, optional
+           (nside, hpix, border) of the sub-region to read, as in
+           from_galfile.  Default is None (all galaxies).
+        use_store: bool, optional
+           read from the columnar store if it has been made.  Default is True.
+
+        yields
+        ------
+        gals: GalaxyCatalog
+           block of galaxies
+        """
+        if chunksize < 1:
+            raise ValueError("chunksize must be >= 1")
+
+        if region is None:
+            nside, hpix, border = 0, 0, 0.0
+        else:
+            nside, hpix, border = region
+        _hpix = _check_region(nside, hpix, border)
+
+        hdr = fitsio.read_header(galfile, ext=1)
+        pixelated, fitsformat = hdr.get("PIXELS", 0), hdr.get("FITS", 0)
+
+        # Pixelized files only need trimming in the border, flat files everywhere
+        trim = (_hpix is not None and (border > 0.0 or not pixelated))
+        if trim and columns is not None:
+            # We need the positions to trim to the region
+            columns = list(columns) + ['ra', 'dec']
+
+        storepath = None
+        if not pixelated:
+            filenames = [galfile]
+            ngals = np.array([hdr['NAXIS2']])
+        else:
+            # this is to keep us from trying to use old IDL galfiles
+            if not fitsformat:
+                raise ValueError("Input galfile must describe fits files.")
+
+            tab = fitsio.read(galfile, ext=1, upper=True)
+            indices = _galfile_indices(tab, nside, _hpix, border)
+
+            path = os.path.dirname(os.path.abspath(galfile))
+            filenames = ['%s/%s' % (path, filename.decode()) for filename in tab[0]['FILENAMES'][indices]]
+            ngals = tab[0]['NGALS'][indices]
+
+            if use_store:
+                storepath = _valid_columnar_store(galfile, tab)
+
+        if len(filenames) == 0:
+            return
+
+        if storepath is not None:
+            offsets = np.load(os.path.join(storepath, 'index.npy'))['OFFSET'][indices]
+            dtype = np.load(os.path.join(storepath, 'dtype.npy')).dtype
         else:
-            # first we need all the pixels that are contained in the big pixel
-            theta, phi = hp.pix2ang(nside_tab, tab[0]['HPIX'])
-            ipring_big = hp.ang2pix(nside, theta, phi)
-            indices, = np.where(ipring_big == _hpix)
-            if border > 0.0:
-                # now we need to find the extra boundary...
-                boundaries = hp.boundaries(nside, _hpix, step=nside_tab/nside)
-                inhpix = tab[0]['HPIX'][indices]
-                for i in xrange(boundaries.shape[1]):
-                    pixint = hp.query_disc(nside_tab, boundaries[:,i],
-                                    border*np.pi/180., inclusive=True, fact=8)
-                    inhpix = np.append(inhpix, pixint)
-                inhpix = np.unique(inhpix)
-                _, indices = esutil.numpy_util.match(inhpix, tab[0]['HPIX'])
+            dtype = fitsio.read(filenames[0], ext=1, rows=0, upper=True).dtype
+        if columns is not None:
+            columns = _select_columns(dtype.names, columns)
+        names = list(dtype.names) if columns is None else columns
+        # Each block gets its own dtype, which is lower-cased by the catalog
+        descr = [(name, dtype[name]) for name in names]
+
+        if storepath is not None:
+            store = {name: np.load(os.path.join(storepath, name + '.npy'), mmap_mode='r')
+                     for name in names}
+
+        p = 0
+        lo = 0
+        while p < len(filenames):
+            # Collect the (file, lo, hi) row ranges for the next block
+            spans = []
+            nrow = 0
+            while p < len(filenames) and nrow < chunksize:
+                hi = min(ngals[p], lo + chunksize - nrow)
+                if hi > lo:
+                    spans.append((p, lo, hi))
+                    nrow += hi - lo
+                if hi == ngals[p]:
+                    p += 1
+                    lo = 0
+                else:
+                    lo = hi
+
+            cat = np.zeros(nrow, dtype=descr)
+            ctr = 0
+            for p_, lo_, hi_ in spans:
+                if storepath is not None:
+                    for name in names:
+                        cat[name][ctr: ctr + hi_ - lo_] = store[name][offsets[p_] + lo_: offsets[p_] + hi_]
+                elif lo_ == 0 and hi_ == ngals[p_]:
+                    cat[ctr: ctr + hi_ - lo_] = fitsio.read(filenames[p_], ext=1, columns=columns, upper=True)
+                else:
+                    cat[ctr: ctr + hi_ - lo_] = fitsio.read(filenames[p_], ext=1, rows=np.arange(lo_, hi_),
+                                                            columns=columns, upper=True)
+                ctr += hi_ - lo_
+
+            if trim:
+                cat = cat[_in_pixel_border(_get_column(cat, 'ra'), _get_column(cat, 'dec'),
+                                           nside, _hpix, border)]
+
+            if cat.size > 0:
+                yield cls(cat)
+
+    @staticmethod
+    def _read_pixel_files(path, tab, indices, columns=None, nthreads=1):
+        """
+        Read the given galfile pixel files (indices into the master table).
+        """
 
         # create the catalog array to read into
         elt = fitsio.read('%s/%s' % (path, tab[0]['FILENAMES'][indices[0]].decode()),ext=1, rows=0, upper=True)
-        cat = np.zeros(np.sum(tab[0]['NGALS'][indices]), dtype=elt.dtype)
-
-        # read the files
-        ctr = 0
-        for index in indices:
-            cat[ctr : ctr+tab[0]['NGALS'][index]] = fitsio.read('%s/%s' % (path, tab[0]['FILENAMES'][index].decode()), ext=1, upper=True)
-            ctr += tab[0]['NGALS'][index]
-        # In the IDL version this is trimmed to the precise boundary requested.
-        # that's easy in simplepix.  Not sure how to do in healpix.
-        return cls(cat)
+        dtype = elt.dtype
+        if columns is not None:
+            columns = _select_columns(dtype.names, columns)
+            dtype = np.dtype([(name, dtype[name]) for name in columns])
+        cat = np.zeros(np.sum(tab[0]['NGALS'][indices]), dtype=dtype)
+
+        # read the files, each into its own slice of cat
+        offsets = np.zeros(indices.size + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(tab[0]['NGALS'][indices])
+
+        def _read_pixel(i):
+            cat[offsets[i]: offsets[i + 1]] = fitsio.read('%s/%s' % (path, tab[0]['FILENAMES'][indices[i]].decode()), ext=1, columns=columns, upper=True)
+
+        nthreads = min(nthreads, indices.size)
+        if nthreads > 1:
+            # fitsio releases the GIL while reading
+            pool = ThreadPool(processes=nthreads)
+            pool.map(_read_pixel, xrange(indices.size))
+            pool.close()
+            pool.join()
+        else:
+            for i in xrange(indices.size):
+                _read_pixel(i)
+
+        return cat
+
+    @staticmethod
+    def _read_columnar_store(storepath, indices, columns=None):
+        """
+        Read the rows of the given galfile pixels (indices into the master
+        table) from a columnar store.
+        """
+
+        index = np.load(os.path.join(storepath, 'index.npy'))
+        dtype = np.load(os.path.join(storepath, 'dtype.npy')).dtype
+        if columns is not None:
+            columns = _select_columns(dtype.names, columns)
+            dtype = np.dtype([(name, dtype[name]) for name in columns])
+
+        offsets = index['OFFSET'][indices]
+        ngals = index['NGALS'][indices]
+
+        # merge adjacent pixels into contiguous runs of rows
+        runstart = np.ones(indices.size, dtype=np.bool)
+        runstart[1:] = (offsets[1:] != offsets[:-1] + ngals[:-1])
+        runs, = np.where(runstart)
+        runends = np.append(runs[1:], indices.size)
+
+        cat = np.zeros(np.sum(ngals), dtype=dtype)
+
+        for name in dtype.names:
+            column = np.load(os.path.join(storepath, name + '.npy'), mmap_mode='r')
+            ctr = 0
+            for start, end in zip(runs, runends):
+                nrow = np.sum(ngals[start: end])
+                cat[name][ctr: ctr + nrow] = column[offsets[start]: offsets[start] + nrow]
+                ctr += nrow
+
+        return cat
 
     @property
     def galcol(self):
@@ -212,3 +645,38 @@ class GalaxyCatalog(Catalog):
 
         return self._htm_matcher.match(ras, decs, radius, maxmatch=maxmatch)
 
+    def match_many_offsets(self, ras, decs, radius):
+        """
+        match many ras/decs to the galaxy catalog, with the matches grouped
+        by input position (compressed sparse row style)
+
+        parameters
+        ----------
+        ras: input ras
+        decs: input decs
+        radius: float
+           radius/radii in degrees
+
+        returns
+        -------
+        (offsets, i1, dists)
+        offsets: array of integers
+            length ras.size + 1.  The matches for input j are
+            i1[offsets[j]: offsets[j + 1]]
+        i1: array of integers
+            indices for galaxy catalog
+        dists: array of floats
+            match distance (degrees)
+        """
+
+        nmatch = np.atleast_1d(ras).size
+
+        i0, i1, dists = self.match_many(ras, decs, radius, maxmatch=0)
+
+        st = np.argsort(i0, kind='mergesort')
+
+        offsets = np.zeros(nmatch + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(i0, minlength=nmatch))
+
+        return offsets, i1[st], dists[st]
+
@@ -1,6 +1,8 @@
 from __future__ import division, absolute_import, print_function
 from past.builtins import xrange
 
+import os
+import hashlib
 import fitsio
 import esutil
 import numpy as np
@@ -8,10 +10,25 @@ from scipy import interpolate
 
 from .chisq_dist import ChisqDist
 from .chisq_dist import compute_chisq
+from .chisq_dist import ChisqContext
 from .catalog import Catalog
 from .utilities import CubicSpline
 from .utilities import MStar
 
+def _atomic_save(filename, data):
+    """
+    Save an array (.npy) or a dict of arrays (.npz) to filename via a
+    temporary file, so that a partially written cache is never read.
+    """
+    tempfile = '%s.partial.%d' % (filename, os.getpid())
+    with open(tempfile, 'wb') as f:
+        if isinstance(data, dict):
+            np.savez(f, **data)
+        else:
+            np.save(f, data)
+    os.rename(tempfile, filename)
+
+
 class RedSequenceColorPar(object):
     """
     Class which contains a red-sequence parametrization
@@ -29,9 +46,40 @@ class RedSequenceColorPar(object):
     zrange: float*2, optional
         redshift range [zlo,zhi].  Default from filename header
         (maximum range)
+    dtype: string, optional
+        precision of the chisq calculations and the lupcorr table, 'f8' or
+        'f4'.  Default 'f8'.  'f4' halves the size of the lupcorr table,
+        with a relative error on chisq typically below 1e-4.
+    cachepath: string, optional
+        directory for a cache of the interpolated tables, keyed by the
+        contents of filename and every other argument that affects the
+        tables (zbinsize, which is set by fine, minsig, zrange, limmag and
+        dtype).  Default None (no cache).
 
     """
-    def __init__(self, filename, zbinsize=None, minsig=0.01, fine=False, zrange=None, config=None, limmag=None):
+    # Increment this when the cached tables change
+    _cache_version = 2
+
+    # Tables and scalars saved in the cache
+    _cache_arrays = ('z', 'zinteger', 'extrapolated',
+                     'refmagbins', 'refmaginteger', 'lumrefmagbins', 'lumrefmaginteger',
+                     'pivotmag', 'maxrefmag', 'minrefmag', 'c', 'slope', 'sigma', 'covmat',
+                     'volume_factor', 'corr', 'corr_slope', 'corr2', 'corr2_slope',
+                     'corr_r', 'corr2_r', '_mstar', 'lumnorm')
+    _cache_scalars = ('nmag', 'ncol', 'zbinsize', 'zbinscale', 'refmagbinsize', 'refmagbinscale',
+                      'alpha', 'mstar_survey', 'mstar_band', 'limmag')
+    _cache_lupcorr_pars = ('do_lupcorr', 'bvalues', 'ref_ind', 'refmagbins')
+
+    def __init__(self, filename, zbinsize=None, minsig=0.01, fine=False, zrange=None, config=None, limmag=None, dtype='f8', cachepath=None):
+
+        self._chisq_context = None
+        self._lupcorr = None
+        self._lupcorr_pars = None
+        self._lupcorr_cachefile = None
+
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float64, np.float32):
+            raise ValueError("dtype must be 'f8' or 'f4'")
 
         if filename is None:
             if config is None:
@@ -80,6 +128,14 @@ class RedSequenceColorPar(object):
             except:
                 raise ValueError("Missing field from parameter header.")
 
+        cachefile = None
+        if has_file and cachepath is not None:
+            cachefile = os.path.join(cachepath, 'redsequence_%s' %
+                                     (self._cache_key(filename, zbinsize, minsig, zrange, limmag)))
+            if os.path.isfile(cachefile + '.npz'):
+                self._load_cache(cachefile)
+                return
+
         try:
             lowzmode=hdr['LOWZMODE']
         except:
@@ -252,37 +308,17 @@ class RedSequenceColorPar(object):
         self.lumnorm = np.zeros((self.lumrefmagbins.size,nz))
         self.alpha = alpha
         for i in xrange(nz):
-            f=10.**(0.4*(self.alpha+1.0)*(self._mstar[i]-self.lumrefmagbins))*np.exp(-10.**(0.4*(self._mstar[i]-self.lumrefmagbins)))
+            f=self.calc_lumphi(self.lumrefmagbins, i)
             self.lumnorm[:,i] = refmagbinsize*np.cumsum(f)
 
         if has_file:
-            # lupcorr (annoying!)
-            self.lupcorr = np.zeros((self.refmagbins.size,nz,ncol),dtype='f8')
-            if (do_lupcorr):
-                bnmgy = bvalues*1e9
-
-                for i in xrange(nz):
-                    mags = np.zeros((self.refmagbins.size,nmag))
-                    lups = np.zeros((self.refmagbins.size,nmag))
-
-                    mags[:,ref_ind] = self.refmagbins
-
-                    # go redward
-                    for j in xrange(ref_ind+1,nmag):
-                        mags[:,j] = mags[:,j-1] - (self.c[i,j-1]+self.slope[i,j-1]*(mags[:,ref_ind]-self.pivotmag[i]))
-                    # blueward
-                    for j in xrange(ref_ind-1,-1,-1):
-                        mags[:,j] = mags[:,j+1] + (self.c[i,j]+self.slope[i,j]*(mags[:,ref_ind]-self.pivotmag[i]))
-
-                    # and the luptitude conversion
-                    for j in xrange(nmag):
-                        flux = 10.**((mags[:,j]-22.5)/(-2.5))
-                        lups[:,j] = 2.5*np.log10(1.0/bvalues[j]) - np.arcsinh(0.5*flux/bnmgy[j])/(0.4*np.log(10.0))
-
-                    magcol = mags[:,0:ncol] - mags[:,1:ncol+1]
-                    lupcol = lups[:,0:ncol] - lups[:,1:ncol+1]
-
-                    self.lupcorr[:,i,:] = lupcol - magcol
+            # lupcorr (annoying!)  This is large, so it is only computed
+            # when first used (see the lupcorr property).  Note that the
+            # refmagbins are copied before the overflow bin is set below.
+            self._lupcorr_pars = {'do_lupcorr': do_lupcorr,
+                                  'bvalues': bvalues,
+                                  'ref_ind': ref_ind,
+                                  'refmagbins': self.refmagbins.copy()}
 
         # set top overflow bins to very large number
         self.z[self.z.size-1] = 1000.0
@@ -297,6 +333,9 @@ class RedSequenceColorPar(object):
         self.mstar_band = mstar_band
         self.limmag = limmag
 
+        if cachefile is not None:
+            self._save_cache(cachefile)
+
         # don't make this into a catalog
         #super(RedSequenceColorPar, self).__init__(zredstr)
 
@@ -388,6 +427,173 @@ class RedSequenceColorPar(object):
         else:
             return lumrefmagind
 
+    def calc_lumphi(self, refmag, zind):
+        """
+        Luminosity filter (Schechter function, without normalization)
+
+        phi = 10**(0.4*(alpha+1)*(mstar-refmag))*exp(-10**(0.4*(mstar-refmag)))
+
+        parameters
+        ----------
+        refmag: float or array of floats
+           reference magnitude
+        zind: int or array of ints
+           redshift index (broadcast against refmag)
+
+        returns
+        -------
+        phi: float or array of floats
+        """
+        dmag = self._mstar[zind] - refmag
+        phi = np.exp(-10.**(0.4 * dmag))
+        if self.alpha != -1.0:
+            # (otherwise this term is exactly 1)
+            phi *= 10.**(0.4 * (self.alpha + 1.0) * dmag)
+        return phi
+
+    @property
+    def lupcorr(self):
+        """
+        Luptitude color corrections, refmagbins x nz x ncol.  This is
+        computed on first use.
+        """
+        if self._lupcorr is None:
+            if self._lupcorr_pars is None:
+                raise AttributeError("No lupcorr without a parameter file")
+            if self._lupcorr_cachefile is not None:
+                if not os.path.isfile(self._lupcorr_cachefile):
+                    _atomic_save(self._lupcorr_cachefile, self._compute_lupcorr(**self._lupcorr_pars))
+                # memory map, so that processes share the pages
+                self._lupcorr = np.load(self._lupcorr_cachefile, mmap_mode='r')
+            else:
+                self._lupcorr = self._compute_lupcorr(**self._lupcorr_pars)
+        return self._lupcorr
+
+    @lupcorr.setter
+    def lupcorr(self, value):
+        self._lupcorr = value
+
+    def _compute_lupcorr(self, do_lupcorr, bvalues, ref_ind, refmagbins, zchunksize=100):
+        """
+        Compute the luptitude color corrections, vectorized over refmag
+        bins and blocks of zchunksize redshifts.
+
+        parameters
+        ----------
+        do_lupcorr: bool
+            compute corrections (else all zero)
+        bvalues: array of floats
+            softening parameters for each band
+        ref_ind: int
+            index of the reference band
+        refmagbins: array of floats
+            reference magnitude bins
+        zchunksize: int, optional
+            number of redshifts to do at a time.  Default 100.
+
+        returns
+        -------
+        lupcorr: array, refmagbins x nz x ncol
+        """
+        nz = self.z.size
+        ncol = self.ncol
+        nmag = ncol + 1
+
+        lupcorr = np.zeros((refmagbins.size, nz, ncol), dtype=self.dtype)
+        if not do_lupcorr:
+            return lupcorr
+
+        bnmgy = bvalues*1e9
+
+        for i0 in xrange(0, nz, zchunksize):
+            i1 = min(i0 + zchunksize, nz)
+
+            c = self.c[np.newaxis, i0: i1, :]
+            slope = self.slope[np.newaxis, i0: i1, :]
+            pivotmag = self.pivotmag[np.newaxis, i0: i1]
+
+            mags = np.zeros((refmagbins.size, i1 - i0, nmag))
+            lups = np.zeros_like(mags)
+
+            mags[:, :, ref_ind] = refmagbins[:, np.newaxis]
+
+            # go redward
+            for j in xrange(ref_ind+1,nmag):
+                mags[:, :, j] = mags[:, :, j-1] - (c[:, :, j-1]+slope[:, :, j-1]*(mags[:, :, ref_ind]-pivotmag))
+            # blueward
+            for j in xrange(ref_ind-1,-1,-1):
+                mags[:, :, j] = mags[:, :, j+1] + (c[:, :, j]+slope[:, :, j]*(mags[:, :, ref_ind]-pivotmag))
+
+            # and the luptitude conversion
+            for j in xrange(nmag):
+                flux = 10.**((mags[:, :, j]-22.5)/(-2.5))
+                lups[:, :, j] = 2.5*np.log10(1.0/bvalues[j]) - np.arcsinh(0.5*flux/bnmgy[j])/(0.4*np.log(10.0))
+
+            magcol = mags[:, :, 0:ncol] - mags[:, :, 1:ncol+1]
+            lupcol = lups[:, :, 0:ncol] - lups[:, :, 1:ncol+1]
+
+            lupcorr[:, i0: i1, :] = lupcol - magcol
+
+        return lupcorr
+
+    def _cache_key(self, filename, zbinsize, minsig, zrange, limmag):
+        """
+        Hash of the parameter file contents and the constructor arguments
+        that affect the tables.
+        """
+        m = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1024*1024), b''):
+                m.update(block)
+        m.update(repr((self._cache_version, float(zbinsize), float(minsig),
+                       [float(z) for z in zrange], float(limmag),
+                       self.dtype.str)).encode('utf-8'))
+        return m.hexdigest()
+
+    def _save_cache(self, cachefile):
+        """
+        Save the interpolated tables to cachefile + '.npz'.  The lupcorr
+        table is saved separately (cachefile + '_lupcorr.npy') when it is
+        first computed.
+        """
+        arrays = {}
+        for key in self._cache_arrays + self._cache_scalars:
+            arrays[key] = np.asarray(getattr(self, key))
+        for key in self._cache_lupcorr_pars:
+            arrays['_lupcorr_pars.' + key] = np.asarray(self._lupcorr_pars[key])
+
+        if not os.path.isdir(os.path.dirname(cachefile)):
+            os.makedirs(os.path.dirname(cachefile))
+        _atomic_save(cachefile + '.npz', arrays)
+
+        self._lupcorr_cachefile = cachefile + '_lupcorr.npy'
+
+    def _load_cache(self, cachefile):
+        """
+        Load the interpolated tables saved by _save_cache().
+        """
+        with np.load(cachefile + '.npz') as data:
+            for key in self._cache_arrays:
+                setattr(self, key, data[key])
+            for key in self._cache_scalars:
+                setattr(self, key, data[key].item())
+            self._lupcorr_pars = {}
+            for key in self._cache_lupcorr_pars:
+                value = data['_lupcorr_pars.' + key]
+                self._lupcorr_pars[key] = value.item() if value.ndim == 0 else value
+
+        self._lupcorr_cachefile = cachefile + '_lupcorr.npy'
+
+    @property
+    def chisq_context(self):
+        """
+        ChisqContext with the red sequence tables prepared for chisq calls.
+        This is created on first use.
+        """
+        if self._chisq_context is None:
+            self._chisq_context = ChisqContext(self, dtype=self.dtype)
+        return self._chisq_context
+
     def calculate_chisq(self, galaxies, z, calc_lkhd=False, z_is_index=False):
         """
         compute chisq for a set of galaxies at redshift z OR a galaxy at many redshifts OR
@@ -433,6 +639,13 @@ class RedSequenceColorPar(object):
         else:
             calc_chisq = True
 
+        if np.ndim(zind) == 0:
+            # A single redshift uses the prepared tables
+            return self.chisq_context.compute(zind, galaxies.refmag, galaxies.mag_err,
+                                              galcolor, refmagerr=galaxies.refmag_err,
+                                              magind=magind,
+                                              calc_chisq=calc_chisq, calc_lkhd=calc_lkhd)
+
         return compute_chisq(self.covmat[:,:,zind], self.c[zind,:],
                              self.slope[zind,:], self.pivotmag[zind],
                              galaxies.refmag, galaxies.mag_err,
@@ -440,6 +653,42 @@ class RedSequenceColorPar(object):
                              lupcorr=self.lupcorr[magind,zind,:],
                              calc_chisq=calc_chisq, calc_lkhd=calc_lkhd)
 
+    def calculate_chisq_grid(self, galaxies, zs, calc_lkhd=False, z_is_index=False):
+        """
+        compute chisq for a set of galaxies at every one of a set of redshifts,
+        in a single pass.
+
+        parameters
+        ----------
+        galaxies: GalaxyCatalog or Galaxy
+            galaxies which need chisq values
+        zs: numpy array
+            redshifts to compute chisq
+        calc_lkhd: bool, optional
+            compute likelihood rather than chisq (default False)
+        z_is_index: bool, optional
+            The input redshifts are already redshift indices
+
+        returns
+        -------
+        chisqs: array of floats, ngal x nz
+        """
+        if z_is_index:
+            zind = np.atleast_1d(zs)
+        else:
+            zind = np.atleast_1d(self.zindex(zs))
+        magind = self.refmagindex(galaxies.refmag)
+
+        if calc_lkhd:
+            calc_chisq = False
+        else:
+            calc_chisq = True
+
+        return self.chisq_context.compute_grid(zind, galaxies.refmag, galaxies.mag_err,
+                                               galaxies.galcol, refmagerr=galaxies.refmag_err,
+                                               magind=magind,
+                                               calc_chisq=calc_chisq, calc_lkhd=calc_lkhd)
+
     def calculate_chisq_redshifts(self, galaxy, zs, calc_lkhd=False):
         """
         Compute chisq for a galaxy at a set of redshifts zs
@@ -117,7 +117,7 @@ class RunLikelihoods(ClusterRunner):
                      np.exp(-0.5 * (cluster.neighbors.zred[minrind] - zrmod)**2. / cluster.neighbors.zred_e[minrind]**2.))
             else:
                 # chisq filter
-                g = chisq_pdf(cluster.neighbors.chisq[minrind], self.zredstr.dof)
+                g = chisq_pdf(cluster.neighbors.chisq[minrind], self.zredstr.ncol)
 
             # and the w filter
             lum = 10.**((cluster.mstar - cluster.neighbors.refmag) / 2.5)
@@ -134,10 +134,10 @@ class RunLikelihoods(ClusterRunner):
         return bad
 
 
-    def _postprocess(self):
+    def _output_selection(self, cat):
         # For this catalog we're cutting on failed likelihood
 
-        use, = np.where(self.cat.lnlamlike > -1e11)
-        self.cat = self.cat[use]
-
         # should I delete unused columns here before saving?  
+
+        use, = np.where(cat.lnlamlike > -1e11)
+        return use
@@ -1,2 +1,2 @@
 from . import solver_nfw_lib
-from .solver_nfw_lib import Solver
+from .solver_nfw_lib import Solver, solve_nfw_batch
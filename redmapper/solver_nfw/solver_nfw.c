@@ -2,49 +2,62 @@
 #include <stdlib.h>
 #include <math.h>
 #include <string.h>
+#include <stdint.h>
 
 #include "solver_nfw.h"
 
+/*
+  Compute the weights at inlambda, and return the (mask-corrected) sum
+  of the weights.  lambda is the root of this minus inlambda.
+*/
+static double solver_nfw_sum(double inlambda, double r0, double beta, long ngal,
+                             double *ucounts, double *bcounts, double *r, double *w,
+                             double *p, double *wt, double *rlambda, double *theta_r,
+                             double *cpars, double rsig, int *niter)
+{
+  double out, cval;
+  long i;
+
+  nfw_weights(inlambda,r0,beta,ngal,ucounts,bcounts,r,w,p,wt,rlambda,theta_r,rsig,1);
+  (*niter)++;
+
+  out=0.0;
+  for (i=0;i<ngal;i++) {
+    out+=wt[i];
+  }
+  cval = cpars[3] + cpars[2]*(*rlambda) + cpars[1]*(*rlambda)*(*rlambda) + cpars[0]*(*rlambda)*(*rlambda)*(*rlambda);
+  if (cval < 0.0) { cval = 0.0; }
+
+  return out + inlambda*cval;
+}
+
 int solver_nfw(double r0, double beta, long ngal,
 	       double *ucounts, double *bcounts, double *r, double *w,
 	       double *lambda, double *p, double *wt, double *rlambda, double *theta_r,
-               double tol, double *cpars, double rsig)
+               double tol, double *cpars, double rsig, int *niter)
 {
   double lamlo,lamhi,mid,outlo,outmid;
-  double cval;
-  int i;
 
-  lamlo=0.5;
-  lamhi=2000.0;
-  outlo=-1.0;
+  *niter = 0;
+
+  /*
+    Bisection on [LAMBDA_LO, LAMBDA_HI], as in the IDL code.  When lamlo
+    moves to mid, the sum at the new lamlo is the one just computed at mid,
+    so it is kept rather than recomputed.  The points evaluated (and so
+    lambda, p, wt and theta_r) are the same as recomputing it.
+  */
+  lamlo=LAMBDA_LO;
+  lamhi=LAMBDA_HI;
+  outlo=solver_nfw_sum(lamlo,r0,beta,ngal,ucounts,bcounts,r,w,p,wt,rlambda,theta_r,cpars,rsig,niter);
 
   while (fabs(lamhi-lamlo) > 2*tol) {
     mid=(lamhi+lamlo)/2.0;
-    if (outlo < 0.0) {
-        nfw_weights(lamlo,r0,beta,ngal,ucounts,bcounts,r,w,p,wt,rlambda,theta_r,rsig,1);
-      outlo=0.0;
-      for (i=0;i<ngal;i++) {
-	outlo+=wt[i];
-      }
-      cval = cpars[3] + cpars[2]*(*rlambda) + cpars[1]*(*rlambda)*(*rlambda) + cpars[0]*(*rlambda)*(*rlambda)*(*rlambda);
-      if (cval < 0.0) { cval = 0.0; }
-
-      outlo += lamlo*cval;
-    }
-    nfw_weights(mid,r0,beta,ngal,ucounts,bcounts,r,w,p,wt,rlambda,theta_r,rsig,1);
-    outmid=0.0;
-    for (i=0;i<ngal;i++) {
-      outmid+=wt[i];
-    }
-    cval = cpars[3] + cpars[2]*(*rlambda) + cpars[1]*(*rlambda)*(*rlambda) + cpars[0]*(*rlambda)*(*rlambda)*(*rlambda);
-    if (cval < 0.0) { cval = 0.0; }
-
-    outmid += mid*cval;
+    outmid=solver_nfw_sum(mid,r0,beta,ngal,ucounts,bcounts,r,w,p,wt,rlambda,theta_r,cpars,rsig,niter);
 
     if (outlo < 1.0) { outlo = 0.9;} // stability at low end
     if ((outlo-lamlo)*(outmid-mid) > 0.0) {
       lamlo=mid;
-      outlo=-1.0;
+      outlo=outmid;
     } else {
       lamhi=mid;
     }
@@ -67,3 +80,36 @@ int solver_nfw(double r0, double beta, long ngal,
 
   return 0;
 }
+
+int solver_nfw_batch(long nclus, int64_t *offsets, double *r0, double *beta,
+                     double *cpars, double rsig,
+                     double *ucounts, double *bcounts, double *r, double *w,
+                     double *lambda, double *p, double *wt, double *rlambda, double *theta_r,
+                     double tol, int *niter, int nthreads)
+{
+  // Solve for nclus clusters.  The neighbors of cluster i are
+  // [offsets[i], offsets[i+1]) in the per-galaxy arrays, and its cpars
+  // are cpars[CPAR_NTERMS*i: CPAR_NTERMS*(i+1)].
+  //
+  // The clusters are split over nthreads threads (if compiled with
+  // OpenMP).  The clusters are independent, and solver_nfw() only
+  // touches its own slices, so no workspace is needed.
+
+  long i;
+  int64_t off;
+
+  if (nthreads < 1) {
+    nthreads = 1;
+  }
+
+#pragma omp parallel for num_threads(nthreads) private(i, off) schedule(dynamic)
+  for (i=0;i<nclus;i++) {
+    off = offsets[i];
+    solver_nfw(r0[i], beta[i], (long) (offsets[i+1] - off),
+               ucounts + off, bcounts + off, r + off, w + off,
+               &lambda[i], p + off, wt + off, &rlambda[i], theta_r + off,
+               tol, cpars + CPAR_NTERMS*i, rsig, &niter[i]);
+  }
+
+  return 0;
+}
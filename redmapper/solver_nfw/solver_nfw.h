@@ -3,12 +3,16 @@
 
 #define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
 
+#include <stdint.h>
+
 #define TOL_DEFAULT 1e-2
 #define SCALEVAL_DEFAULT 1.0
 #define SCALEVAL_DEFAULT_NOTUSE -1.0
 #define CVAL_DEFAULT 0.0
 #define RSIG_DEFAULT 0.0
 #define CPAR_NTERMS  4
+#define LAMBDA_LO 0.5
+#define LAMBDA_HI 2000.0
 
 struct solver {
     double r0;
@@ -36,7 +40,13 @@ int nfw_weights(double inlambda, double r0, double beta, long ngal,
 int solver_nfw(double r0, double beta, long ngal,
 	       double *ucounts, double *bcounts, double *r, double *w,
 	       double *lambda, double *p, double *wt, double *rlambda, double *theta_r,
-               double tol, double *cpars, double rsig);
+               double tol, double *cpars, double rsig, int *niter);
+
+int solver_nfw_batch(long nclus, int64_t *offsets, double *r0, double *beta,
+                     double *cpars, double rsig,
+                     double *ucounts, double *bcounts, double *r, double *w,
+                     double *lambda, double *p, double *wt, double *rlambda, double *theta_r,
+                     double tol, int *niter, int nthreads);
 
 
 #endif
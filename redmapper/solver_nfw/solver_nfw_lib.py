@@ -43,12 +43,14 @@ class Solver(object):
         self.r0 = float(r0)
         self.beta = float(beta)
 
-        self.ucounts = ucounts.astype('f8')
-        self.bcounts = bcounts.astype('f8')
-        self.r = r.astype('f8')
-        self.w = w.astype('f8')
-        self.cpars = cpars.astype('f8')
+        # The c code keeps pointers to these, so they must be kept here
+        self.ucounts = np.ascontiguousarray(ucounts, dtype='f8')
+        self.bcounts = np.ascontiguousarray(bcounts, dtype='f8')
+        self.r = np.ascontiguousarray(r, dtype='f8')
+        self.w = np.ascontiguousarray(w, dtype='f8')
+        self.cpars = np.ascontiguousarray(cpars, dtype='f8')
         self.rsig = float(rsig)
+        self.niter = 0
 
         ngal = self.ucounts.size
         if (ngal != self.bcounts.size):
@@ -78,6 +80,94 @@ class Solver(object):
         returns
         -------
         TBD
+
+        The number of evaluations of the weights used by the root finder
+        is stored in self.niter.
         """
-        return self._solver.solve_nfw()
+        lam, p, wt, rlam, theta_r, self.niter = self._solver.solve_nfw()
+        return lam, p, wt, rlam, theta_r
+
+
+def solve_nfw_batch(r0, beta, ucounts, bcounts, r, w, offsets,
+                    cpars=None, rsig=0.0, nthreads=1):
+    """
+    Solve for the richness of many clusters with one call to the c code.
+
+    The neighbors of all the clusters are concatenated, with the neighbors
+    of cluster i in [offsets[i], offsets[i + 1]).
+
+    parameters
+    ----------
+    r0: float or float array
+        Radius -- richness scaling amplitude, per cluster
+    beta: float or float array
+        Radius -- richness scaling index, per cluster
+    ucounts: float array
+        u(x) for the neighbors
+    bcounts: float array
+        b(x) for the neighbors
+    r: float array
+        Radius of the neighbors
+    w: float array
+        Weights of the neighbors
+    offsets: int array
+        Start of each cluster in the neighbor arrays, of length nclus + 1
+        with offsets[0] = 0 and offsets[-1] = number of neighbors
+    cpars: float array, optional
+        Mask correction parameters, shape (4,) or (nclus, 4).
+        Default is all zeros.
+    rsig: float, optional
+        Radial smoothing (default = 0.0)
+    nthreads: int, optional
+        Number of OpenMP threads (if the extension was built with OpenMP).
+        Default is 1.
+
+    returns
+    -------
+    lam: float array
+       Richness per cluster (-1 if it could not be computed)
+    p: float array
+       Membership probability per neighbor
+    wt: float array
+       Weighted membership probability (pmem) per neighbor
+    rlam: float array
+       Radius per cluster
+    theta_r: float array
+       Radial weight per neighbor
+    niter: int array
+       Number of evaluations of the weights per cluster
+    """
+
+    offsets = np.ascontiguousarray(offsets, dtype='i8')
+    if offsets.ndim != 1 or offsets.size < 1:
+        raise ValueError("offsets must be a 1d array of length nclus + 1")
+    nclus = offsets.size - 1
+
+    ucounts = np.ascontiguousarray(ucounts, dtype='f8')
+    bcounts = np.ascontiguousarray(bcounts, dtype='f8')
+    r = np.ascontiguousarray(r, dtype='f8')
+    w = np.ascontiguousarray(w, dtype='f8')
+
+    ngal = ucounts.size
+    if (ngal != bcounts.size):
+        raise ValueError("ucounts and bcounts must be same length")
+    if (ngal != r.size):
+        raise ValueError("ucounts and r must be the same length")
+    if (ngal != w.size):
+        raise ValueError("ucounts and w must be the same length")
+    if offsets[0] != 0 or offsets[-1] != ngal or np.any(np.diff(offsets) < 0):
+        raise ValueError("offsets must be increasing from 0 to the number of neighbors")
+
+    r0 = np.ascontiguousarray(np.broadcast_to(np.asarray(r0, dtype='f8'), (nclus, )))
+    beta = np.ascontiguousarray(np.broadcast_to(np.asarray(beta, dtype='f8'), (nclus, )))
+
+    if cpars is None:
+        cpars = np.zeros((nclus, 4), dtype='f8')
+    cpars = np.asarray(cpars, dtype='f8')
+    if cpars.shape[-1] != 4:
+        raise ValueError("cpars with wrong number of terms")
+    cpars = np.ascontiguousarray(np.broadcast_to(cpars, (nclus, 4)))
+
+    return _solver_nfw_pywrap.solve_nfw_batch(r0, beta, ucounts, bcounts, r, w,
+                                              offsets, cpars, float(rsig), int(nthreads))
 
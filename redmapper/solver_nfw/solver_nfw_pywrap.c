@@ -98,6 +98,7 @@ PyObject* SolverObject_solver_nfw(const struct SolverObject* self, PyObject *arg
     PyObject* p_obj = NULL;
     PyObject* wt_obj = NULL;
     PyObject* thetar_obj = NULL;
+    int niter;
 
     dims[0] = 1;
     lam_obj = PyArray_ZEROS(0, dims, NPY_DOUBLE, 0);
@@ -121,16 +122,17 @@ PyObject* SolverObject_solver_nfw(const struct SolverObject* self, PyObject *arg
 	       self->solver->ucounts, self->solver->bcounts, self->solver->r,
 	       self->solver->w, self->solver->lambda, self->solver->p, self->solver->wt,
                self->solver->rlambda, self->solver->theta_r,
-	       TOL_DEFAULT, self->solver->cpars, self->solver->rsig);
+	       TOL_DEFAULT, self->solver->cpars, self->solver->rsig, &niter);
 
     // this needs to return the tuple.
 
-    PyObject* retval = PyTuple_New(5);
+    PyObject* retval = PyTuple_New(6);
     PyTuple_SET_ITEM(retval, 0, lam_obj);
     PyTuple_SET_ITEM(retval, 1, p_obj);
     PyTuple_SET_ITEM(retval, 2, wt_obj);
     PyTuple_SET_ITEM(retval, 3, rlam_obj);
     PyTuple_SET_ITEM(retval, 4, thetar_obj);
+    PyTuple_SET_ITEM(retval, 5, PyLong_FromLong((long) niter));
 
     return retval;
 }
@@ -189,7 +191,85 @@ static PyTypeObject PySolverType = {
 };
 
 
+static PyObject*
+Solver_solve_nfw_batch(PyObject* self, PyObject *args)
+{
+    PyArrayObject *r0_obj = NULL;
+    PyArrayObject *beta_obj = NULL;
+    PyArrayObject *ucounts_obj = NULL;
+    PyArrayObject *bcounts_obj = NULL;
+    PyArrayObject *r_obj = NULL;
+    PyArrayObject *w_obj = NULL;
+    PyArrayObject *offsets_obj = NULL;
+    PyArrayObject *cpars_obj = NULL;
+    double rsig;
+    int nthreads = 1;
+    npy_intp dims[1];
+    PyObject* lam_obj = NULL;
+    PyObject* rlam_obj = NULL;
+    PyObject* niter_obj = NULL;
+    PyObject* p_obj = NULL;
+    PyObject* wt_obj = NULL;
+    PyObject* thetar_obj = NULL;
+    long nclus;
+
+    // All arrays are checked (and made contiguous) in solver_nfw_lib.py
+    if (!PyArg_ParseTuple(args,
+			  (char*)"OOOOOOOOd|i",
+			  &r0_obj,
+			  &beta_obj,
+			  &ucounts_obj,
+			  &bcounts_obj,
+			  &r_obj,
+			  &w_obj,
+			  &offsets_obj,
+			  &cpars_obj,
+			  &rsig,
+			  &nthreads)) {
+	PyErr_SetString(PyExc_RuntimeError,"Failed to parse args");
+	return NULL;
+    }
+
+    nclus = (long) PyArray_DIM(r0_obj, 0);
+
+    dims[0] = nclus;
+    lam_obj = PyArray_ZEROS(1, dims, NPY_DOUBLE, 0);
+    rlam_obj = PyArray_ZEROS(1, dims, NPY_DOUBLE, 0);
+    niter_obj = PyArray_ZEROS(1, dims, NPY_INT, 0);
+
+    dims[0] = PyArray_DIM(ucounts_obj, 0);
+    p_obj = PyArray_ZEROS(1, dims, NPY_DOUBLE, 0);
+    wt_obj = PyArray_ZEROS(1, dims, NPY_DOUBLE, 0);
+    thetar_obj = PyArray_ZEROS(1, dims, NPY_DOUBLE, 0);
+
+    Py_BEGIN_ALLOW_THREADS
+    solver_nfw_batch(nclus, (int64_t *) PyArray_DATA(offsets_obj),
+                     (double *) PyArray_DATA(r0_obj), (double *) PyArray_DATA(beta_obj),
+                     (double *) PyArray_DATA(cpars_obj), rsig,
+                     (double *) PyArray_DATA(ucounts_obj), (double *) PyArray_DATA(bcounts_obj),
+                     (double *) PyArray_DATA(r_obj), (double *) PyArray_DATA(w_obj),
+                     (double *) PyArray_DATA((PyArrayObject*)lam_obj),
+                     (double *) PyArray_DATA((PyArrayObject*)p_obj),
+                     (double *) PyArray_DATA((PyArrayObject*)wt_obj),
+                     (double *) PyArray_DATA((PyArrayObject*)rlam_obj),
+                     (double *) PyArray_DATA((PyArrayObject*)thetar_obj),
+                     TOL_DEFAULT, (int *) PyArray_DATA((PyArrayObject*)niter_obj), nthreads);
+    Py_END_ALLOW_THREADS
+
+    PyObject* retval = PyTuple_New(6);
+    PyTuple_SET_ITEM(retval, 0, lam_obj);
+    PyTuple_SET_ITEM(retval, 1, p_obj);
+    PyTuple_SET_ITEM(retval, 2, wt_obj);
+    PyTuple_SET_ITEM(retval, 3, rlam_obj);
+    PyTuple_SET_ITEM(retval, 4, thetar_obj);
+    PyTuple_SET_ITEM(retval, 5, niter_obj);
+
+    return retval;
+}
+
 static PyMethodDef Solver_module_methods[] = {
+    {"solve_nfw_batch", (PyCFunction)Solver_solve_nfw_batch, METH_VARARGS,
+     "solve_nfw_batch(r0, beta, ucounts, bcounts, r, w, offsets, cpars, rsig, nthreads=1)"},
     {NULL}  /* Sentinel */
 };
 
@@ -22,10 +22,183 @@ SEC_PER_DEG = 3600
 def astro_to_sphere(ra, dec):
     return np.radians(90.0-dec), np.radians(ra)
 
+# normalization of chisq_pdf for each k
+_chisq_pdf_norms = {}
+
 #Equation 7 in Rykoff et al. 2014
 def chisq_pdf(data, k):
-    normalization = 1./(2**(k/2.) * special.gamma(k/2.))
-    return normalization * data**((k/2.)-1) * np.exp(-data/2.)
+    try:
+        normalization = _chisq_pdf_norms[k]
+    except KeyError:
+        normalization = 1./(2**(k/2.) * special.gamma(k/2.))
+        _chisq_pdf_norms[k] = normalization
+    if k == 5 or k == 7:
+        # data**1.5 or data**2.5 with a square root, which is much faster
+        # than a general power (numpy has fast paths for data**1 and
+        # data**2).  This agrees with data**((k/2.)-1) to a few ulp.
+        pdf = normalization * data**((k - 3)//2)
+        pdf *= np.sqrt(data)
+    else:
+        pdf = normalization * data**((k/2.)-1)
+    # (data*-0.5 is exactly -data/2.)
+    pdf *= np.exp(np.multiply(data, -0.5))
+    return pdf
+
+def nfw_sigma(x, corex, xmax):
+    """
+    Projected NFW profile Sigma(x), constant inside corex and zero beyond
+    xmax.  Near x = 1 the average of the values at 0.999 and 1.001 is used.
+
+    parameters
+    ----------
+    x: float array
+       radius in units of r_s
+    corex: float
+       core radius in units of r_s
+    xmax: float
+       maximum radius in units of r_s
+
+    returns
+    -------
+    sigx: float array
+       sigma(x)
+    """
+    sigx = np.zeros(x.size)
+
+    low, = np.where(x < corex)
+    mid, = np.where((x >= corex) & (x < 1.0))
+    high, = np.where((x >= 1.0) & (x < xmax))
+    other, = np.where((x > 0.999) & (x < 1.001))
+
+    if low.size > 0:
+        arg = np.sqrt((1. - corex)/(1. + corex))
+        pre = 2./(np.sqrt(1. - corex**2))
+        front = 1./(corex**2 - 1)
+        sigx[low] = front * (1. - pre*0.5*np.log((1.+arg)/(1.-arg)))
+
+    if mid.size > 0:
+        arg = np.sqrt((1. - x[mid])/(1. + x[mid]))
+        pre = 2./(np.sqrt(1. - x[mid]**2))
+        front = 1./(x[mid]**2 - 1.)
+        sigx[mid] = front * (1. - pre*0.5*np.log((1.+arg)/(1.-arg)))
+
+    if high.size > 0:
+        arg = np.sqrt((x[high] - 1.)/(x[high] + 1.))
+        pre = 2./(np.sqrt(x[high]**2 - 1.))
+        front = 1./(x[high]**2 - 1)
+        sigx[high] = front * (1. - pre*np.arctan(arg))
+
+    if other.size > 0:
+        xlo, xhi = 0.999, 1.001
+        arglo, arghi = np.sqrt((1-xlo)/(1+xlo)), np.sqrt((xhi-1)/(xhi+1))
+        prelo, prehi = 2./np.sqrt(1.-xlo**2), 2./np.sqrt(xhi**2 - 1)
+        frontlo, fronthi = 1./(xlo**2 - 1), 1./(xhi**2 - 1)
+        testlo = frontlo * (1 - prelo*0.5*np.log((1+arglo)/(1-arglo)))
+        testhi = fronthi * (1 - prehi*np.arctan(arghi))
+        sigx[other] = (testlo + testhi)/2.
+
+    return sigx
+
+class NFWSigmaTable(object):
+    """
+    Lookup table for the projected NFW profile (see nfw_sigma), sampled
+    uniformly in log(x) between the core radius and the maximum radius,
+    with linear interpolation.  The interpolation goes to zero over the
+    first step beyond the maximum radius.
+
+    parameters
+    ----------
+    rscale: float
+       r_s for the nfw profile (Mpc)
+    corer: float
+       core radius (Mpc)
+    rmax: float
+       maximum radius (Mpc)
+    nstep: int, optional
+       number of samples.  Default is 10000.
+    tol: float, optional
+       maximum relative error of the interpolation.  Default is 1e-5.
+
+    raises ValueError if the interpolation error is larger than tol.
+    """
+    def __init__(self, rscale, corer, rmax, nstep=10000, tol=1e-5):
+        self.rscale = rscale
+        self.corex = corer/rscale
+        self.xmax = rmax/rscale
+
+        logx = np.linspace(np.log(self.corex), np.log(self.xmax), nstep)
+        dlogx = logx[1] - logx[0]
+        x = np.exp(logx)
+        # the last sample is the value just inside xmax
+        x[-1] = self.xmax*(1.0 - 1e-12)
+
+        # sigx and the slope per step, with a final zero for beyond xmax
+        self._sigx = np.zeros(nstep + 1)
+        self._sigx[: nstep] = nfw_sigma(x, self.corex, self.xmax)
+        self._dsigx = np.append(np.diff(self._sigx), 0.0)
+        self._logx0 = logx[0]
+        self._idlogx = 1./dlogx
+        self._nstep = nstep
+
+        # check the interpolation halfway between the samples, away from the
+        # approximation at x = 1
+        xtest = np.exp((logx[1:] + logx[:-1])/2.)
+        test, = np.where(np.abs(xtest - 1.0) > 0.001 + 2.*dlogx)
+        sigx_exact = nfw_sigma(xtest[test], self.corex, self.xmax)
+        self.max_relerr = np.max(np.abs(self(xtest[test]*rscale) / sigx_exact - 1.0))
+        if self.max_relerr > tol:
+            raise ValueError("NFW sigma table with %d steps has a relative error of %g > %g" %
+                             (nstep, self.max_relerr, tol))
+
+    def __call__(self, r):
+        """
+        Look up Sigma(x) for radius r (Mpc).
+
+        parameters
+        ----------
+        r: float array
+           radius (Mpc)
+
+        returns
+        -------
+        sigx: float array
+           sigma(x)
+        """
+        # r = 0 is inside the core
+        with np.errstate(divide='ignore'):
+            u = np.log(r/self.rscale)
+        u -= self._logx0
+        u *= self._idlogx
+        np.clip(u, 0.0, self._nstep, out=u)
+        i = u.astype(np.intp)
+        u -= i
+        u *= self._dsigx[i]
+        u += self._sigx[i]
+        return u
+
+_nfw_sigma_tables = {}
+
+def get_nfw_sigma_table(rscale, corer, rmax):
+    """
+    Get a (cached) NFWSigmaTable.
+
+    parameters
+    ----------
+    rscale: float
+       r_s for the nfw profile (Mpc)
+    corer: float
+       core radius (Mpc)
+    rmax: float
+       maximum radius (Mpc)
+
+    returns
+    -------
+    table: NFWSigmaTable
+    """
+    key = (rscale, corer, rmax)
+    if key not in _nfw_sigma_tables:
+        _nfw_sigma_tables[key] = NFWSigmaTable(rscale, corer, rmax)
+    return _nfw_sigma_tables[key]
 
 def gaussFunction(x, *p):
    A, mu, sigma = p
@@ -24,7 +24,7 @@ class Zlambda(object):
         self.cluster_parent = cluster
 
         # Make a copy of the cluster for modifications
-        # note that this makes a deep copy of the neighbors so we can modify at will.
+        # note that this copies the neighbor working columns so we can modify at will.
         self.cluster = cluster.copy()
 
         # For convenience, make references to these structures
@@ -32,6 +32,11 @@ class Zlambda(object):
         self.config = cluster.config
         self.cosmo = cluster.cosmo
 
+        # Cache of neighbor likelihoods by redshift index, valid for the
+        # neighbors selected in _zlambda_select_neighbors
+        self._zlambda_lkhd_cache = {}
+        self._zlambda_lkhd_inds = None
+
     def calc_zlambda(self, zin, mask, maxmag_in=None, calcpz=False, calc_err=True,
                      correction=False, record_values=True):
         """
@@ -52,6 +57,9 @@ class Zlambda(object):
 
         z_lambda = copy.copy(zin)
 
+        self._zlambda_lkhd_cache = {}
+        self._zlambda_lkhd_inds = None
+
         maxmag = self.zredstr.mstar(z_lambda) - 2.5*np.log10(self.config.lval_reference)
         if maxmag_in is not None:
             if maxmag_in.size == 1:
@@ -198,6 +206,13 @@ class Zlambda(object):
         # record these values
         self._zlambda_in_rad = use[gd]
 
+        # The cached likelihoods are only valid for the same neighbors
+        if (self._zlambda_lkhd_inds is None or
+                not np.array_equal(self._zlambda_in_rad, self._zlambda_lkhd_inds)):
+            self._zlambda_lkhd_cache = {}
+            self._zlambda_lkhd_inds = self._zlambda_in_rad
+            self._zlambda_neighbors = self.cluster.neighbors[self._zlambda_in_rad]
+
         self._zlambda_zrefmagbin = zrefmagbin[self._zlambda_in_rad]
         self._zlambda_refmag = self.cluster.neighbors.refmag[self._zlambda_in_rad]
         self._zlambda_refmag_err = self.cluster.neighbors.refmag_err[self._zlambda_in_rad]
@@ -222,9 +237,7 @@ class Zlambda(object):
         nsteps = 10
         steps = np.linspace(0., nsteps*self.config.zlambda_parab_step, num = nsteps,
             dtype = np.float64)+z_lambda - self.config.zlambda_parab_step*(nsteps-1)/2
-        likes = np.zeros(nsteps)
-        for i in xrange(0, nsteps):
-             likes[i] = self._bracket_fn(steps[i])
+        likes = self._bracket_fns(steps)
         fit = np.polyfit(steps, likes, 2)
 
         if fit[0] > 0.0:
@@ -239,15 +252,48 @@ class Zlambda(object):
         return z_lambda
 
 
+    def _zlambda_likelihoods(self, zinds):
+        """
+        likelihoods of the selected neighbors at a set of redshift indices.
+        These are cached by redshift index, and all the missing redshifts
+        are computed in one pass.
+
+        parameters
+        ----------
+        zinds: array of redshift indices
+
+        returns
+        -------
+        likelihoods: array of floats, nneighbors x nz
+        """
+        missing = np.unique([zind for zind in zinds if zind not in self._zlambda_lkhd_cache])
+        if missing.size > 0:
+            likelihoods = self.zredstr.calculate_chisq_grid(self._zlambda_neighbors,
+                                                            missing, calc_lkhd=True,
+                                                            z_is_index=True)
+            for i, zind in enumerate(missing):
+                self._zlambda_lkhd_cache[zind] = likelihoods[:, i]
+
+        return np.array([self._zlambda_lkhd_cache[zind] for zind in zinds]).T
+
     def _bracket_fn(self, z):
         """
         bracketing function
         """
-        likelihoods = self.zredstr.calculate_chisq(self.cluster.neighbors[self._zlambda_in_rad],
-                                                            z, calc_lkhd=True)
+        likelihoods = self._zlambda_likelihoods(np.atleast_1d(self.zredstr.zindex(z)))[:, 0]
         t = -np.sum(self._zlambda_pw*likelihoods)
         return t
 
+    def _bracket_fns(self, zs):
+        """
+        bracketing function at a set of redshifts
+        """
+        likelihoods = self._zlambda_likelihoods(np.atleast_1d(self.zredstr.zindex(zs)))
+        t = np.zeros(zs.size)
+        for i in xrange(zs.size):
+            t[i] = -np.sum(self._zlambda_pw*likelihoods[:, i])
+        return t
+
     def _delta_bracket_fn(self, z):
         t  = self._bracket_fn(z)
         dt = np.abs(t-self._zlambda_targval)
@@ -414,12 +460,7 @@ class Zlambda(object):
 
         # Now compute for each of the bins
 
-        ln_lkhd = np.zeros(self.config.npzbins)
-        for i in xrange(self.config.npzbins):
-            ln_lkhd[i] = -self._bracket_fn(pzbins[i])
-            #likelihoods = self.zredstr.calculate_chisq(self.neighbors[self._zlambda_in_rad],
-            #    pzbins[i], calc_lkhd=True)
-            #ln_lkhd[i] = np.sum(self._zlambda_pw*likelihoods)
+        ln_lkhd = -self._bracket_fns(pzbins)
 
         ln_lkhd = ln_lkhd - np.max(ln_lkhd)
         pz = np.exp(ln_lkhd) * self.zredstr.volume_factor[self.zredstr.zindex(pzbins)]
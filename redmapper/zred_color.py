@@ -233,7 +233,7 @@ class ZredColor(object):
 
         # Compute chisq at the closest bin position
         zbin = np.argmin(np.abs(zred - self.zredstr.z))
-        chisq = self.zredstr.calculate_chisq(galaxy, np.array([zbin, zbin]), z_is_index=True, calc_lkhd=(not self.use_chisq))[0]
+        chisq = self.zredstr.calculate_chisq_grid(galaxy, zbin, z_is_index=True, calc_lkhd=(not self.use_chisq))[0, 0]
 
         if not np.isfinite(lkhd):
             self._reset_bad_values(galaxy)
@@ -293,20 +293,13 @@ class ZredColor(object):
         """
 
         # Note we need to deal with photoerr...
-        if zbins.size > 1:
-            # we have many bins...
-            lndist = self.zredstr.calculate_chisq(galaxy, zbins, z_is_index=True, calc_lkhd=(not self.use_chisq))
-        else:
-            # we have a single bin... hack this
-            lndist = self.zredstr.calculate_chisq(galaxy, np.array([zbins, zbins]), z_is_index=True, calc_lkhd=(not self.use_chisq))[0]
+        lndist = self.zredstr.calculate_chisq_grid(galaxy, zbins, z_is_index=True, calc_lkhd=(not self.use_chisq))[0, :]
 
         if self.use_chisq:
             lndist *= -0.5
 
         #with np.errstate(invalid='ignore'):
-        lndistcorr = np.log((10.**(0.4 * (self.zredstr.alpha + 1.0) *
-                                   (self.zredstr._mstar[zbins] - galaxy.refmag)) *
-                             np.exp(-10.**(0.4 * (self.zredstr._mstar[zbins] - galaxy.refmag)))) *
+        lndistcorr = np.log(self.zredstr.calc_lumphi(galaxy.refmag, zbins) *
                             self.zredstr.volume_factor[zbins])
 
         lndist += lndistcorr
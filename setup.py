@@ -15,12 +15,21 @@ include_dirs = [numpy.get_include()]
 
 ext_modules=[]
 
+# OpenMP is used to thread the chisq_dist and batch solver_nfw
+# calculations.  Set REDMAPPER_NO_OPENMP for compilers without OpenMP
+# support (the code then runs single-threaded).
+if os.environ.get('REDMAPPER_NO_OPENMP') is None:
+    openmp_args = ['-fopenmp']
+else:
+    openmp_args = []
+
 # solver_nfw
 solver_nfw_sources=['redmapper/solver_nfw/solver_nfw_pywrap.c',
                     'redmapper/solver_nfw/solver_nfw.c',
                     'redmapper/solver_nfw/nfw_weights.c']
 solver_nfw_module = Extension('redmapper.solver_nfw._solver_nfw_pywrap',
-                              extra_compile_args=['-std=gnu99'],
+                              extra_compile_args=['-std=gnu99'] + openmp_args,
+                              extra_link_args=openmp_args,
                               sources=solver_nfw_sources,
                               include_dirs=include_dirs)
 ext_modules.append(solver_nfw_module)
@@ -29,8 +38,8 @@ ext_modules.append(solver_nfw_module)
 chisq_dist_sources=['redmapper/chisq_dist/chisq_dist.c',
                     'redmapper/chisq_dist/chisq_dist_pywrap.c']
 chisq_dist_module = Extension('redmapper.chisq_dist._chisq_dist_pywrap',
-                              extra_compile_args=['-std=gnu99',os.path.expandvars('-I${GSLI}')],
-                              extra_link_args=[os.path.expandvars('-L${GSLL}')],
+                              extra_compile_args=['-std=gnu99',os.path.expandvars('-I${GSLI}')] + openmp_args,
+                              extra_link_args=[os.path.expandvars('-L${GSLL}')] + openmp_args,
                               libraries=['gslcblas','gsl'],
                               sources=chisq_dist_sources,
                               include_dirs=include_dirs)
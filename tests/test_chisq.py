@@ -106,5 +106,146 @@ class ChisqColorTestCase(unittest.TestCase):
 
                                                     
         
+class ChisqNumpyTestCase(unittest.TestCase):
+    """
+    Test that the numpy chisq backend and the threaded C code match the
+    single-threaded C code in all modes.
+    """
+    def runTest(self):
+        file_path = 'data_for_tests'
+        parfile = 'test_dr8_pars.fit'
+
+        zredstr = redmapper.RedSequenceColorPar('%s/%s' % (file_path, parfile),fine=True,zrange=[0.15,0.25])
+
+        for mode in xrange(3):
+            data = fitsio.read('%s/testgals_chisq_mode%d.fit' % (file_path, mode), ext=1)
+
+            if mode == 0:
+                zind = zredstr.zindex(data['Z'][0])
+            elif mode == 1:
+                zind = zredstr.zindex(data[0]['Z_INDEXED'])
+            else:
+                zind = zredstr.zindex(data['Z_INDEXED'])
+
+            if mode == 1:
+                magind = zredstr.refmagindex(data[0]['REFMAG_INDEXED'])
+                magerr = data[0]['MODEL_MAGERR']
+                galcolor = data[0]['MODEL_MAG'][0:4] - data[0]['MODEL_MAG'][1:5]
+                refmagerr = data[0]['REFMAG_ERR']
+            else:
+                magind = zredstr.refmagindex(data['REFMAG_INDEXED'])
+                magerr = data['MODEL_MAGERR']
+                galcolor = data['MODEL_MAG'][:,0:4] - data['MODEL_MAG'][:,1:5]
+                refmagerr = data['REFMAG_ERR']
+
+            for nophotoerr in [False, True]:
+                chisq_c, lkhd_c = redmapper.compute_chisq(zredstr.covmat[:,:,zind],zredstr.c[zind,:],zredstr.slope[zind,:],zredstr.pivotmag[zind],data['REFMAG'],magerr,galcolor,refmagerr=refmagerr,lupcorr=zredstr.lupcorr[magind,zind,:], calc_chisq=True, calc_lkhd=True, nophotoerr=nophotoerr)
+                chisq_np, lkhd_np = redmapper.compute_chisq(zredstr.covmat[:,:,zind],zredstr.c[zind,:],zredstr.slope[zind,:],zredstr.pivotmag[zind],data['REFMAG'],magerr,galcolor,refmagerr=refmagerr,lupcorr=zredstr.lupcorr[magind,zind,:], calc_chisq=True, calc_lkhd=True, nophotoerr=nophotoerr, backend='numpy')
+
+                testing.assert_allclose(chisq_np, chisq_c, rtol=1e-10)
+                testing.assert_allclose(lkhd_np, lkhd_c, rtol=1e-10)
+
+                # and the threaded C code must match exactly
+                chisq_t, lkhd_t = redmapper.compute_chisq(zredstr.covmat[:,:,zind],zredstr.c[zind,:],zredstr.slope[zind,:],zredstr.pivotmag[zind],data['REFMAG'],magerr,galcolor,refmagerr=refmagerr,lupcorr=zredstr.lupcorr[magind,zind,:], calc_chisq=True, calc_lkhd=True, nophotoerr=nophotoerr, nthreads=3)
+
+                testing.assert_array_equal(chisq_t, chisq_c)
+                testing.assert_array_equal(lkhd_t, lkhd_c)
+
+        self.assertRaises(ValueError, redmapper.compute_chisq, zredstr.covmat[:,:,0], zredstr.c[0,:], zredstr.slope[0,:], zredstr.pivotmag[0], data['REFMAG'], data['MODEL_MAGERR'], galcolor, backend='fortran')
+
+class ChisqGridTestCase(unittest.TestCase):
+    """
+    Test that the galaxy x redshift grid matches the single redshift
+    calculations.
+    """
+    def runTest(self):
+        file_path = 'data_for_tests'
+        parfile = 'test_dr8_pars.fit'
+
+        zredstr = redmapper.RedSequenceColorPar('%s/%s' % (file_path, parfile),fine=True,zrange=[0.15,0.25])
+
+        galaxies = redmapper.GalaxyCatalog.from_fits_file('%s/test_dr8_gals_with_zred.fit' % (file_path))[0: 100]
+
+        zinds = np.arange(0, zredstr.z.size, 5)
+
+        for calc_lkhd in [False, True]:
+            grid = zredstr.calculate_chisq_grid(galaxies, zinds, z_is_index=True, calc_lkhd=calc_lkhd)
+            self.assertEqual(grid.shape, (galaxies.size, zinds.size))
+
+            for i, zind in enumerate(zinds):
+                testing.assert_array_equal(grid[:, i], zredstr.calculate_chisq(galaxies, zind, z_is_index=True, calc_lkhd=calc_lkhd))
+
+        # And the numpy backend
+        magind = zredstr.refmagindex(galaxies.refmag)
+        chisq_c, lkhd_c = redmapper.compute_chisq(zredstr.covmat[:, :, zinds], zredstr.c[zinds, :], zredstr.slope[zinds, :], zredstr.pivotmag[zinds], galaxies.refmag, galaxies.mag_err, galaxies.galcol, refmagerr=galaxies.refmag_err, lupcorr=zredstr.lupcorr[magind[:, np.newaxis], zinds[np.newaxis, :], :], calc_chisq=True, calc_lkhd=True, grid=True)
+        chisq_np, lkhd_np = redmapper.compute_chisq(zredstr.covmat[:, :, zinds], zredstr.c[zinds, :], zredstr.slope[zinds, :], zredstr.pivotmag[zinds], galaxies.refmag, galaxies.mag_err, galaxies.galcol, refmagerr=galaxies.refmag_err, lupcorr=zredstr.lupcorr[magind[:, np.newaxis], zinds[np.newaxis, :], :], calc_chisq=True, calc_lkhd=True, grid=True, backend='numpy')
+        testing.assert_allclose(chisq_np, chisq_c, rtol=1e-10)
+        testing.assert_allclose(lkhd_np, lkhd_c, rtol=1e-10)
+
+class ChisqContextTestCase(unittest.TestCase):
+    """
+    Test that the prepared ChisqContext matches compute_chisq.
+    """
+    def runTest(self):
+        file_path = 'data_for_tests'
+        parfile = 'test_dr8_pars.fit'
+
+        zredstr = redmapper.RedSequenceColorPar('%s/%s' % (file_path, parfile),fine=True,zrange=[0.15,0.25])
+        context = redmapper.ChisqContext(zredstr)
+
+        galaxies = redmapper.GalaxyCatalog.from_fits_file('%s/test_dr8_gals_with_zred.fit' % (file_path))[0: 100]
+        magind = zredstr.refmagindex(galaxies.refmag)
+
+        for zind in [0, 20, zredstr.z.size - 1]:
+            for nophotoerr in [False, True]:
+                chisq, lkhd = redmapper.compute_chisq(zredstr.covmat[:, :, zind], zredstr.c[zind, :], zredstr.slope[zind, :], zredstr.pivotmag[zind], galaxies.refmag, galaxies.mag_err, galaxies.galcol, refmagerr=galaxies.refmag_err, lupcorr=zredstr.lupcorr[magind, zind, :], calc_chisq=True, calc_lkhd=True, nophotoerr=nophotoerr)
+                chisq2, lkhd2 = context.compute(zind, galaxies.refmag, galaxies.mag_err, galaxies.galcol, refmagerr=galaxies.refmag_err, magind=magind, calc_chisq=True, calc_lkhd=True, nophotoerr=nophotoerr)
+                testing.assert_array_equal(chisq2, chisq)
+                testing.assert_array_equal(lkhd2, lkhd)
+
+            # And with only the intrinsic covmat (using the Cholesky factors)
+            chisq, lkhd = redmapper.compute_chisq(zredstr.covmat[:, :, zind], zredstr.c[zind, :], zredstr.slope[zind, :], zredstr.pivotmag[zind], galaxies.refmag, galaxies.mag_err, galaxies.galcol, lupcorr=zredstr.lupcorr[magind, zind, :], calc_chisq=True, calc_lkhd=True, nophotoerr=True)
+            chisq2, lkhd2 = context.compute(zind, galaxies.refmag, galaxies.mag_err, galaxies.galcol, magind=magind, calc_chisq=True, calc_lkhd=True, nophotoerr=True)
+            testing.assert_allclose(chisq2, chisq, rtol=1e-10)
+            testing.assert_allclose(lkhd2, lkhd, rtol=1e-10)
+
+        zinds = np.arange(0, zredstr.z.size, 5)
+        grid = context.compute_grid(zinds, galaxies.refmag, galaxies.mag_err, galaxies.galcol, refmagerr=galaxies.refmag_err, magind=magind, calc_chisq=False, calc_lkhd=True)
+        for i, zind in enumerate(zinds):
+            testing.assert_array_equal(grid[:, i], context.compute(zind, galaxies.refmag, galaxies.mag_err, galaxies.galcol, refmagerr=galaxies.refmag_err, magind=magind, calc_chisq=False, calc_lkhd=True))
+
+class ChisqFloat32TestCase(unittest.TestCase):
+    """
+    Test that single precision chisq values are close to double precision.
+    """
+    def runTest(self):
+        file_path = 'data_for_tests'
+        parfile = 'test_dr8_pars.fit'
+
+        zredstr = redmapper.RedSequenceColorPar('%s/%s' % (file_path, parfile),fine=True,zrange=[0.15,0.25])
+        zredstr32 = redmapper.RedSequenceColorPar('%s/%s' % (file_path, parfile),fine=True,zrange=[0.15,0.25],dtype='f4')
+        self.assertEqual(zredstr32.lupcorr.dtype, np.float32)
+
+        galaxies = redmapper.GalaxyCatalog.from_fits_file('%s/test_dr8_gals_with_zred.fit' % (file_path))[0: 500]
+
+        zinds = np.arange(0, zredstr.z.size - 1, 5)
+
+        chisq = zredstr.calculate_chisq_grid(galaxies, zinds, z_is_index=True)
+        chisq32 = zredstr32.calculate_chisq_grid(galaxies, zinds, z_is_index=True)
+        self.assertEqual(chisq32.dtype, np.float32)
+        testing.assert_allclose(chisq32, chisq, rtol=1e-4)
+
+        lkhd = zredstr.calculate_chisq(galaxies, zinds[5], z_is_index=True, calc_lkhd=True)
+        lkhd32 = zredstr32.calculate_chisq(galaxies, zinds[5], z_is_index=True, calc_lkhd=True)
+        testing.assert_allclose(lkhd32, lkhd, rtol=1e-4, atol=1e-3)
+
+        # And through compute_chisq
+        magind = zredstr.refmagindex(galaxies.refmag)
+        chisq = redmapper.compute_chisq(zredstr.covmat[:, :, 10], zredstr.c[10, :], zredstr.slope[10, :], zredstr.pivotmag[10], galaxies.refmag, galaxies.mag_err, galaxies.galcol, refmagerr=galaxies.refmag_err, lupcorr=zredstr.lupcorr[magind, 10, :])
+        chisq32 = redmapper.compute_chisq(zredstr.covmat[:, :, 10], zredstr.c[10, :], zredstr.slope[10, :], zredstr.pivotmag[10], galaxies.refmag, galaxies.mag_err, galaxies.galcol, refmagerr=galaxies.refmag_err, lupcorr=zredstr.lupcorr[magind, 10, :], dtype='f4')
+        testing.assert_allclose(chisq32, chisq, rtol=1e-4)
+
+        self.assertRaises(ValueError, redmapper.compute_chisq, zredstr.covmat[:, :, 10], zredstr.c[10, :], zredstr.slope[10, :], zredstr.pivotmag[10], galaxies.refmag, galaxies.mag_err, galaxies.galcol, dtype='f4', backend='c')
+
 if __name__=='__main__':
     unittest.main()
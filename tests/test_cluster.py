@@ -9,12 +9,14 @@ from numpy import random
 
 from redmapper import Entry
 from redmapper import Cluster
+from redmapper import ClusterNeighbors
 from redmapper import Configuration
 from redmapper import GalaxyCatalog
 from redmapper import Background
 from redmapper import RedSequenceColorPar
 from redmapper import HPMask
 from redmapper import DepthMap
+from redmapper.cluster import NeighborWorkingSet
 from redmapper.utilities import calc_theta_i
 
 #import matplotlib.pyplot as plt
@@ -86,6 +88,12 @@ class ClusterTestCase(unittest.TestCase):
         nfw_python = cluster._calc_radial_profile()
         testing.assert_almost_equal(nfw_python, neighbors.nfw/(2.*np.pi*neighbors.r),5)
 
+        # And the NFW profile lookup table
+        cluster.config.nfw_sigma_table = True
+        nfw_table = cluster._calc_radial_profile()
+        cluster.config.nfw_sigma_table = False
+        testing.assert_allclose(nfw_table, nfw_python, rtol=1e-5)
+
         # Test the luminosity
         # The problem is that the IDL code has multiple ways of computing the index.
         # And this should be fixed here.  I don't want to duplicate dumb ideas.
@@ -128,6 +136,42 @@ class ClusterTestCase(unittest.TestCase):
         testing.assert_almost_equal(cluster.Lambda, 23.86299324)
         testing.assert_almost_equal(cluster.lambda_e, 2.4780307)
 
+        # The richness at several redshifts on the same neighbors, which
+        # must match calc_richness and leave the cluster alone.
+        p_orig = cluster.neighbors.p.copy()
+        zs = cluster.redshift + np.array([0.0, cluster.config.zlambda_epsilon])
+
+        random.seed(seed = 0)
+        lams, lam_es = cluster.calc_richness_derivatives(mask, zs)
+        testing.assert_equal(lams[0], cluster.Lambda)
+        testing.assert_equal(lam_es[0], cluster.lambda_e)
+        testing.assert_equal(cluster.neighbors.p, p_orig)
+        testing.assert_almost_equal(cluster.redshift, zs[0])
+
+        cluster_temp = cluster.copy()
+        cluster_temp.redshift = zs[1]
+        random.seed(seed = 0)
+        cluster_temp.calc_richness(mask)
+        random.seed(seed = 0)
+        lams, lam_es = cluster.calc_richness_derivatives(mask, zs[1])
+        testing.assert_equal(lams[0], cluster_temp.Lambda)
+        testing.assert_equal(lam_es[0], cluster_temp.lambda_e)
+
+        # The working set shares the neighbor columns when there is no index
+        ws = NeighborWorkingSet(cluster.neighbors)
+        self.assertTrue(np.shares_memory(ws.r, cluster.neighbors.r))
+        self.assertTrue(np.shares_memory(ws.refmag, cluster.neighbors.refmag))
+        testing.assert_equal(ws.galcol, cluster.neighbors.galcol)
+
+        # and an index covering all the neighbors gives the same richness
+        random.seed(seed = 0)
+        lam_full = cluster.calc_richness(mask)
+        p_full = cluster.neighbors.p.copy()
+        random.seed(seed = 0)
+        lam = cluster.calc_richness(mask, index=np.arange(len(cluster.neighbors)))
+        testing.assert_equal(lam, lam_full)
+        testing.assert_equal(cluster.neighbors.p, p_full)
+
         #testing.assert_almost_equal(cluster.neighbors.theta_i,
         #                            neighbors.theta_i, 3)
         #testing.assert_almost_equal(cluster.neighbors.theta_r,
@@ -137,6 +181,54 @@ class ClusterTestCase(unittest.TestCase):
 
         return
 
+class ClusterNeighborsTestCase(unittest.TestCase):
+    """
+    Test the neighbor views of a galaxy catalog
+    """
+    def runTest(self):
+        file_path = 'data_for_tests'
+        galfile = 'pixelized_dr8_test/dr8_test_galaxies_master_table.fit'
+
+        gals = GalaxyCatalog.from_galfile(file_path + '/' + galfile)
+
+        indices, dists = gals.match_one(140.5, 65.0, 0.2)
+
+        cluster = Cluster()
+        cluster.neighbors = ClusterNeighbors(gals, indices=indices)
+        cluster.neighbors.dist = dists
+        cluster.neighbors.index = indices
+
+        testing.assert_equal(cluster.neighbors.size, indices.size)
+        testing.assert_equal(cluster.neighbors.refmag, gals.refmag[indices])
+        testing.assert_equal(cluster.neighbors.mag, gals.mag[indices, :])
+        testing.assert_equal(cluster.neighbors.galcol, gals.galcol[indices, :])
+        testing.assert_equal(cluster.neighbors.pfree, 1.0)
+        testing.assert_equal(cluster.neighbors.dist, dists)
+
+        # sub-selections index through to the parent catalog
+        sub = cluster.neighbors[10: 20]
+        testing.assert_equal(sub.refmag, gals.refmag[indices[10: 20]])
+        testing.assert_equal(sub.dist, dists[10: 20])
+        testing.assert_equal(cluster.neighbors[5].refmag, gals.refmag[indices[5]])
+
+        # copies only duplicate the working columns
+        cluster_copy = cluster.copy()
+        cluster_copy.neighbors.p[:] = 0.5
+        testing.assert_equal(cluster.neighbors.p, 0.0)
+        testing.assert_equal(cluster_copy.neighbors.refmag, cluster.neighbors.refmag)
+
+        # and writing a galaxy column does not touch the parent catalog
+        refmag_orig = gals.refmag.copy()
+        cluster_copy.neighbors.refmag = 0.0
+        testing.assert_equal(gals.refmag, refmag_orig)
+        testing.assert_equal(cluster.neighbors.refmag, gals.refmag[indices])
+
+        # a full record array can still be made
+        arr = cluster.neighbors._ndarray
+        testing.assert_equal(arr.size, indices.size)
+        testing.assert_equal(arr['ra'], gals.ra[indices])
+        testing.assert_equal(arr['dist'], dists)
+
 #class ClusterMembersTestCase(unittest.TestCase):
 
     #This next test MUST be done before the calc_richness test can be completed.
@@ -7,9 +7,14 @@ import numpy as np
 import fitsio
 from numpy import random
 import healpy as hp
+import os
+import shutil
+import tempfile
 
 from redmapper import Configuration
 from redmapper import GalaxyCatalog
+from redmapper.galaxy import write_columnar_store, columnar_store_path
+from redmapper.galaxy import _in_pixel_border
 
 
 class GalaxyCatalogTestCase(unittest.TestCase):
@@ -26,6 +31,16 @@ class GalaxyCatalogTestCase(unittest.TestCase):
         # check that we got the expected number...
         testing.assert_equal(gals_all.size, 14449)
 
+        # reading with threads should give the same catalog
+        gals_threads = GalaxyCatalog.from_galfile(file_path + '/' + galfile, nthreads=4)
+        testing.assert_equal(gals_threads._ndarray, gals_all._ndarray)
+
+        # read in a subset of columns
+        gals_cols = GalaxyCatalog.from_galfile(file_path + '/' + galfile,
+                                               columns=['ra', 'DEC', 'refmag', 'notacolumn'])
+        self.assertEqual(gals_cols.dtype.names, ('ra', 'dec', 'refmag'))
+        testing.assert_equal(gals_cols.refmag, gals_all.refmag)
+
         # read in a subregion, no border
         gals_sub = GalaxyCatalog.from_galfile(file_path + '/' + galfile,
                                               hpix=2163, nside=64)
@@ -42,7 +57,18 @@ class GalaxyCatalogTestCase(unittest.TestCase):
                                               hpix=9218, nside=128, border=0.1)
 
         # this isn't really a big enough sample catalog to fully test...
-        testing.assert_equal(gals_sub.size, 7950)
+        testing.assert_equal(gals_sub.size, 1819)
+
+        # compare to the brute-force distance to the pixel boundary
+        boundary = hp.boundaries(128, 9218, step=1000)
+        vec = hp.ang2vec(theta, phi)
+        dist = np.degrees(np.arccos(np.clip(np.max(np.dot(vec, boundary), axis=1), -1.0, 1.0)))
+        inpix = (hp.ang2pix(128, theta, phi) == 9218)
+
+        kept = np.in1d(gals_all.id, gals_sub.id)
+        testing.assert_equal(np.all(kept[inpix]), True)
+        testing.assert_array_less(dist[kept & ~inpix], 0.1 * 1.2)
+        testing.assert_equal(np.all(kept[~inpix & (dist < 0.1)]), True)
 
         # and test the matching...
 
@@ -59,3 +85,157 @@ class GalaxyCatalogTestCase(unittest.TestCase):
         test, = np.where(i0 == 1)
         testing.assert_equal(test.size, 666 - 521)
         testing.assert_array_less(dists[test], 0.1)
+
+        # and the grouped matching
+        offsets, i1, dists = gals_all.match_many_offsets([140.5,141.2],
+                                                         [65.0, 65.2], [0.2,0.1])
+        testing.assert_equal(offsets, [0, 521, 666])
+        indices, _ = gals_all.match_one(141.2, 65.2, 0.1)
+        testing.assert_equal(np.sort(i1[offsets[1]: offsets[2]]), np.sort(indices))
+        testing.assert_array_less(dists[offsets[1]: offsets[2]], 0.1)
+
+
+class PixelBorderTestCase(unittest.TestCase):
+    """
+    Test that the border trim keeps every position within the border
+    """
+    def runTest(self):
+        random.seed(seed=12345)
+
+        for nside, hpix, border in [(128, 9218, 0.1), (8, 0, 0.5), (32, 6000, 0.05)]:
+            # random positions around the pixel
+            ra_cen, dec_cen = hp.pix2ang(nside, hpix, lonlat=True)
+            radius = hp.nside2resol(nside, arcmin=True) / 60. * 1.5 + 2. * border
+            vec = hp.ang2vec(ra_cen, dec_cen, lonlat=True)
+            ipring = hp.query_disc(4096, vec, np.radians(radius))
+            ipring = ipring[random.randint(0, ipring.size, size=20000)]
+            theta, phi = hp.pix2ang(4096, ipring)
+            theta += random.uniform(-0.5, 0.5, size=ipring.size) * hp.nside2resol(4096)
+            phi += random.uniform(-0.5, 0.5, size=ipring.size) * hp.nside2resol(4096)
+            ra = np.degrees(phi)
+            dec = 90.0 - np.degrees(theta)
+
+            # distance to a densely sampled pixel boundary
+            boundary = hp.boundaries(nside, hpix, step=2000)
+            dist = np.degrees(np.arccos(np.clip(np.max(np.dot(hp.ang2vec(theta, phi), boundary), axis=1),
+                                                -1.0, 1.0)))
+            inpix = (hp.ang2pix(nside, theta, phi) == hpix)
+
+            kept = _in_pixel_border(ra, dec, nside, hpix, border)
+
+            testing.assert_equal(np.all(kept[inpix]), True)
+            testing.assert_equal(np.all(kept[dist < border]), True)
+            testing.assert_array_less(dist[kept & ~inpix], border * 1.3)
+            # and there are positions outside the border to be trimmed
+            self.assertTrue(np.sum(~kept) > 0)
+
+
+class GalaxyCatalogStoreTestCase(unittest.TestCase):
+    """
+    Test reading from the columnar galaxy store
+    """
+    def runTest(self):
+
+        file_path = 'data_for_tests'
+
+        test_dir = tempfile.mkdtemp(dir='./', prefix='TestRedmapper-')
+        galpath = os.path.join(test_dir, 'pixelized_dr8_test')
+        shutil.copytree(os.path.join(file_path, 'pixelized_dr8_test'), galpath)
+        galfile = os.path.join(galpath, 'dr8_test_galaxies_master_table.fit')
+
+        storepath = write_columnar_store(galfile)
+        self.assertEqual(storepath, columnar_store_path(galfile))
+        self.assertRaises(IOError, write_columnar_store, galfile)
+
+        for nside, hpix, border in [(0, 0, 0.0), (64, 2163, 0.0), (128, 9218, 0.1)]:
+            gals_fits = GalaxyCatalog.from_galfile(galfile, nside=nside, hpix=hpix,
+                                                   border=border, use_store=False)
+            gals_store = GalaxyCatalog.from_galfile(galfile, nside=nside, hpix=hpix,
+                                                    border=border)
+
+            testing.assert_equal(gals_store.size, gals_fits.size)
+            self.assertEqual(gals_store.dtype, gals_fits.dtype)
+            for name in gals_fits.dtype.names:
+                testing.assert_equal(gals_store._ndarray[name], gals_fits._ndarray[name])
+
+            gals_fits = GalaxyCatalog.from_galfile(galfile, nside=nside, hpix=hpix,
+                                                   border=border, use_store=False,
+                                                   columns=['ra', 'mag'])
+            gals_store = GalaxyCatalog.from_galfile(galfile, nside=nside, hpix=hpix,
+                                                    border=border, columns=['ra', 'mag'])
+
+            testing.assert_equal(gals_store.size, gals_fits.size)
+            self.assertEqual(gals_store.dtype, gals_fits.dtype)
+            for name in gals_fits.dtype.names:
+                testing.assert_equal(gals_store._ndarray[name], gals_fits._ndarray[name])
+
+            # And in blocks from the store
+            chunks = list(GalaxyCatalog.iter_chunks(galfile, chunksize=1000,
+                                                    columns=['ra', 'mag'],
+                                                    region=(nside, hpix, border)))
+            testing.assert_array_less(np.array([chunk.size for chunk in chunks]), 1001)
+            testing.assert_equal(np.concatenate([chunk.mag for chunk in chunks]), gals_fits.mag)
+
+        # The store is renamed into place, with no temporary directory left
+        self.assertEqual([f for f in os.listdir(galpath) if os.path.isdir(os.path.join(galpath, f))],
+                         [os.path.basename(storepath)])
+
+        # Regenerate the galfile with the pixels in reverse order, so the
+        # store no longer matches and the pixel files must be read instead
+        hdr = fitsio.read_header(galfile, ext=1)
+        tab = fitsio.read(galfile, ext=1, upper=True)
+        npix = tab[0]['HPIX'].size
+        for name in tab.dtype.names:
+            if tab[name][0].shape == (npix, ):
+                tab[name][0] = tab[name][0][::-1]
+        fitsio.write(galfile, tab, header=hdr, clobber=True)
+
+        gals_fits = GalaxyCatalog.from_galfile(galfile, use_store=False)
+        gals_store = GalaxyCatalog.from_galfile(galfile)
+        testing.assert_equal(gals_store._ndarray, gals_fits._ndarray)
+        chunks = list(GalaxyCatalog.iter_chunks(galfile, chunksize=1000))
+        testing.assert_equal(np.concatenate([chunk._ndarray for chunk in chunks]), gals_fits._ndarray)
+
+        # And the rewritten store matches again
+        write_columnar_store(galfile, clobber=True)
+        gals_store = GalaxyCatalog.from_galfile(galfile)
+        testing.assert_equal(gals_store._ndarray, gals_fits._ndarray)
+
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir, True)
+
+
+class GalaxyCatalogChunksTestCase(unittest.TestCase):
+    """
+    Test reading galaxy catalogs in blocks
+    """
+    def runTest(self):
+
+        file_path = 'data_for_tests'
+        galfile = os.path.join(file_path, 'pixelized_dr8_test', 'dr8_test_galaxies_master_table.fit')
+
+        test_dir = tempfile.mkdtemp(dir='./', prefix='TestRedmapper-')
+        flatfile = os.path.join(test_dir, 'dr8_test_galaxies.fit')
+        fitsio.write(flatfile, GalaxyCatalog.from_galfile(galfile)._ndarray)
+
+        for nside, hpix, border in [(0, 0, 0.0), (64, 2163, 0.0), (128, 9218, 0.1)]:
+            gals = GalaxyCatalog.from_galfile(galfile, nside=nside, hpix=hpix, border=border)
+
+            # Pixel files are split across blocks
+            chunks = list(GalaxyCatalog.iter_chunks(galfile, chunksize=1000,
+                                                    region=(nside, hpix, border)))
+            testing.assert_array_less(np.array([chunk.size for chunk in chunks]), 1001)
+            testing.assert_equal(np.concatenate([chunk._ndarray for chunk in chunks]), gals._ndarray)
+
+            # And a flat file is trimmed to the same region
+            chunks = list(GalaxyCatalog.iter_chunks(flatfile, chunksize=999,
+                                                    columns=['id', 'refmag'],
+                                                    region=(nside, hpix, border)))
+            testing.assert_array_less(np.array([chunk.size for chunk in chunks]), 1000)
+            ids = np.concatenate([chunk.id for chunk in chunks])
+            testing.assert_equal(np.sort(ids), np.sort(gals.id))
+            testing.assert_equal(np.concatenate([chunk.refmag for chunk in chunks]).size, gals.size)
+
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir, True)
+
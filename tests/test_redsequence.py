@@ -5,6 +5,9 @@ import unittest
 import numpy.testing as testing
 import numpy as np
 import fitsio
+import os
+import tempfile
+import shutil
 
 import redmapper
 
@@ -108,6 +111,9 @@ class RedSequenceColorTestCase(unittest.TestCase):
         testing.assert_almost_equal(zredstr.covmat[0,3,indices],np.array([ -0.000291,  0.000251,  0.000707,  0.000006]),decimal=5)
         testing.assert_almost_equal(zredstr.covmat[3,0,indices],np.array([ -0.000291,  0.000251,  0.000707,  0.000006]),decimal=5)
 
+        # lupcorr is computed on first use
+        self.assertTrue(zredstr._lupcorr is None)
+
         # lupcorr...here we want to test all colors...
         testing.assert_almost_equal(zredstr.lupcorr[800,indices,0],np.array([ -0.026939, -0.060606, -0.127144, -0.510393]),decimal=5)
         testing.assert_almost_equal(zredstr.lupcorr[800,indices,1],np.array([ -0.000332, -0.000689, -0.002615, -0.007729]),decimal=5)
@@ -134,6 +140,74 @@ class RedSequenceColorTestCase(unittest.TestCase):
         testing.assert_almost_equal(zredstr.lumnorm[400,indices],np.array([  3.589124,  0.105102,  0.000006,  0.000000]),decimal=5)
         testing.assert_almost_equal(zredstr.lumnorm[800,indices],np.array([  7.577478,  2.958363,  1.152083,  0.163357]),decimal=5)
 
+        # luminosity filter
+        refmag = np.array([15.0, 17.5, 19.0, 21.0], dtype='f4')
+        for alpha in [zredstr.alpha, -1.2]:
+            zredstr.alpha = alpha
+            mstar = zredstr._mstar[indices]
+            testing.assert_almost_equal(zredstr.calc_lumphi(refmag, indices),
+                                        10.**(0.4*(alpha + 1.0)*(mstar - refmag))*np.exp(-10.**(0.4*(mstar - refmag))))
+
+
+class RedSequenceColorCacheTestCase(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that the on-disk cache of the interpolated red-sequence tables
+        reproduces the tables computed from the parameter file.
+        """
+        file_name = 'test_dr8_pars.fit'
+        file_path = 'data_for_tests'
+
+        zredstr = redmapper.RedSequenceColorPar('%s/%s' % (file_path, file_name), fine=True)
+
+        # the first call writes the cache, the second reads it
+        cached1 = redmapper.RedSequenceColorPar('%s/%s' % (file_path, file_name), fine=True,
+                                                cachepath=self.test_dir)
+        cached2 = redmapper.RedSequenceColorPar('%s/%s' % (file_path, file_name), fine=True,
+                                                cachepath=self.test_dir)
+
+        for zs in [cached1, cached2]:
+            testing.assert_equal(zs.nmag, zredstr.nmag)
+            testing.assert_equal(zs.limmag, zredstr.limmag)
+            testing.assert_array_equal(zs.z, zredstr.z)
+            testing.assert_array_equal(zs.c, zredstr.c)
+            testing.assert_array_equal(zs.slope, zredstr.slope)
+            testing.assert_array_equal(zs.pivotmag, zredstr.pivotmag)
+            testing.assert_array_equal(zs.covmat, zredstr.covmat)
+            testing.assert_array_equal(zs.lumnorm, zredstr.lumnorm)
+            testing.assert_array_equal(zs.lupcorr, zredstr.lupcorr)
+            # and only the tables are cached, not derived state
+            self.assertEqual(sorted(zs.__dict__.keys()), sorted(zredstr.__dict__.keys()))
+            self.assertIsNone(zs._chisq_context)
+            for key in zs._cache_arrays:
+                testing.assert_array_equal(getattr(zs, key), getattr(zredstr, key))
+            for key in zs._cache_scalars:
+                self.assertEqual(getattr(zs, key), getattr(zredstr, key))
+
+        cachefiles = sorted(os.listdir(self.test_dir))
+        testing.assert_equal(len(cachefiles), 2)
+        self.assertTrue(cachefiles[0].endswith('.npz'))
+        self.assertTrue(cachefiles[1].endswith('_lupcorr.npy'))
+
+        # a different redshift range gets its own cache entry
+        redmapper.RedSequenceColorPar('%s/%s' % (file_path, file_name), zrange=[0.1, 0.3],
+                                      cachepath=self.test_dir)
+        testing.assert_equal(len([f for f in os.listdir(self.test_dir) if f.endswith('.npz')]), 2)
+
+        # as do a different minsig and dtype
+        redmapper.RedSequenceColorPar('%s/%s' % (file_path, file_name), fine=True, minsig=0.02,
+                                      cachepath=self.test_dir)
+        testing.assert_equal(len([f for f in os.listdir(self.test_dir) if f.endswith('.npz')]), 3)
+        redmapper.RedSequenceColorPar('%s/%s' % (file_path, file_name), fine=True, dtype='f4',
+                                      cachepath=self.test_dir)
+        testing.assert_equal(len([f for f in os.listdir(self.test_dir) if f.endswith('.npz')]), 4)
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(dir='./', prefix='TestRedmapper-')
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir, True)
 
 
 if __name__=='__main__':
@@ -7,7 +7,12 @@ import numpy as np
 import fitsio
 from numpy import random
 import healpy as hp
+import os
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
 
+import redmapper.galaxy
 from redmapper import Cluster
 from redmapper import ClusterCatalog
 from redmapper import Configuration
@@ -57,5 +62,184 @@ class RuncatTestCase(unittest.TestCase):
         #testing.assert_almost_equal(runcat.cat.z_lambda_e, [ 0.00629484,  0.01389629, -1.0])
         testing.assert_almost_equal(runcat.cat.z_lambda_e, [ 0.00629484,  0.0139078, -1.0])
 
+class RuncatThreadedReadTestCase(unittest.TestCase):
+    """
+    Test that the runner reads the galaxy pixel files with galfile_read_nthreads
+    """
+    def runTest(self):
+
+        file_path = 'data_for_tests'
+        conffile = 'testconfig.yaml'
+        catfile = 'test_cluster_pos.fit'
+
+        config = Configuration(file_path + '/' + conffile)
+        config.catfile = file_path + '/' + catfile
+
+        runcat = RunCatalog(config)
+        runcat.run(do_percolation_masking=False)
+
+        # Record the thread pools used to read the pixel files
+        pools = []
+
+        class _ThreadPool(ThreadPool):
+            def __init__(self, processes=None):
+                pools.append(processes)
+                super(_ThreadPool, self).__init__(processes=processes)
+
+        config.galfile_read_nthreads = 4
+        redmapper.galaxy.ThreadPool = _ThreadPool
+        try:
+            runcat_threads = RunCatalog(config)
+            runcat_threads.run(do_percolation_masking=False)
+        finally:
+            redmapper.galaxy.ThreadPool = ThreadPool
+
+        self.assertEqual(pools, [4])
+        testing.assert_equal(runcat_threads.cat.mem_match_id, runcat.cat.mem_match_id)
+        testing.assert_equal(runcat_threads.cat.Lambda, runcat.cat.Lambda)
+        testing.assert_equal(runcat_threads.members.p, runcat.members.p)
+
+class RuncatTiledTestCase(unittest.TestCase):
+    """
+    Test that a tiled run matches the serial run
+    """
+    def runTest(self):
+
+        file_path = 'data_for_tests'
+        conffile = 'testconfig.yaml'
+        catfile = 'test_cluster_pos.fit'
+
+        config = Configuration(file_path + '/' + conffile)
+        config.catfile = file_path + '/' + catfile
+
+        runcat = RunCatalog(config)
+        runcat.run(do_percolation_masking=False)
+
+        runcat_tiled = RunCatalog(config)
+        runcat_tiled.run_tiled(64, nproc=2, do_percolation_masking=False)
+
+        testing.assert_equal(runcat_tiled.cat.mem_match_id, runcat.cat.mem_match_id)
+        testing.assert_almost_equal(runcat_tiled.cat.Lambda, runcat.cat.Lambda)
+        testing.assert_almost_equal(runcat_tiled.cat.lambda_e, runcat.cat.lambda_e)
+        testing.assert_almost_equal(runcat_tiled.cat.z_lambda, runcat.cat.z_lambda)
+        testing.assert_almost_equal(runcat_tiled.cat.z_lambda_e, runcat.cat.z_lambda_e)
+
+        testing.assert_equal(runcat_tiled.members.mem_match_id, runcat.members.mem_match_id)
+        st = np.lexsort((runcat.members.ra, runcat.members.mem_match_id))
+        st_tiled = np.lexsort((runcat_tiled.members.ra, runcat_tiled.members.mem_match_id))
+        testing.assert_almost_equal(runcat_tiled.members.p[st_tiled], runcat.members.p[st])
+
+        # percolation masking must be run serially
+        runcat_tiled = RunCatalog(config)
+        self.assertRaises(RuntimeError, runcat_tiled.run_tiled, 64, nproc=1,
+                          do_percolation_masking=True)
+
+class RuncatTiledClusterTilesTestCase(unittest.TestCase):
+    """
+    Test that a tiled run keeps clusters in tiles with no galaxy pixels
+    """
+    def runTest(self):
+
+        file_path = 'data_for_tests'
+        conffile = 'testconfig.yaml'
+        catfile = 'test_cluster_pos.fit'
+
+        config = Configuration(file_path + '/' + conffile)
+        config.catfile = file_path + '/' + catfile
+
+        # Remove the galaxy pixels in the tile with the clusters
+        galpath = os.path.join(self.test_dir, 'pixelized_dr8_test')
+        shutil.copytree(os.path.join(file_path, 'pixelized_dr8_test'), galpath)
+        config.galfile = os.path.join(galpath, 'dr8_test_galaxies_master_table.fit')
+
+        tab, hdr = fitsio.read(config.galfile, ext=1, header=True)
+        theta, phi = hp.pix2ang(tab[0]['NSIDE'], tab[0]['HPIX'])
+        keep, = np.where(hp.ang2pix(64, theta, phi) != 2297)
+        perpix = [name for name in tab.dtype.names
+                  if tab.dtype[name].shape == (tab[0]['HPIX'].size, )]
+        dtype = [(name, tab.dtype[name].base, (keep.size, )) if name in perpix
+                 else (name, tab.dtype[name]) for name in tab.dtype.names]
+        newtab = np.zeros(1, dtype=dtype)
+        for name in tab.dtype.names:
+            if name in perpix:
+                newtab[name][0] = tab[name][0][keep]
+            else:
+                newtab[name][0] = tab[name][0]
+        fitsio.write(config.galfile, newtab, header=hdr, clobber=True)
+
+        runcat = RunCatalog(config)
+        runcat.run(do_percolation_masking=False)
+
+        runcat_tiled = RunCatalog(config)
+        runcat_tiled.run_tiled(64, nproc=2, do_percolation_masking=False)
+
+        testing.assert_equal(runcat_tiled.cat.mem_match_id, runcat.cat.mem_match_id)
+        testing.assert_almost_equal(runcat_tiled.cat.Lambda, runcat.cat.Lambda)
+
+        # A cluster with no galaxies within the border cannot be run tiled
+        cat = fitsio.read(config.catfile, ext=1)
+        cat_far = np.zeros(1, dtype=cat.dtype)
+        cat_far['RA'] = 10.0
+        cat_far['DEC'] = 0.0
+        cat_far['Z'] = 0.2
+        config.catfile = os.path.join(self.test_dir, 'test_cluster_pos_far.fit')
+        fitsio.write(config.catfile, np.concatenate([cat, cat_far]))
+
+        runcat_tiled = RunCatalog(config)
+        self.assertRaises(RuntimeError, runcat_tiled.run_tiled, 64, nproc=2,
+                          do_percolation_masking=False)
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(dir='./', prefix='TestRedmapper-')
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir, True)
+
+class RuncatStreamingTestCase(unittest.TestCase):
+    """
+    Test that streaming the output matches the serial run
+    """
+    def runTest(self):
+
+        file_path = 'data_for_tests'
+        conffile = 'testconfig.yaml'
+        catfile = 'test_cluster_pos.fit'
+
+        config = Configuration(file_path + '/' + conffile)
+        config.catfile = file_path + '/' + catfile
+
+        config.outbase = os.path.join(self.test_dir, 'testcat')
+
+        runcat = RunCatalog(config)
+        runcat.run(do_percolation_masking=False)
+
+        runcat_stream = RunCatalog(config)
+        runcat_stream.run_streaming(do_percolation_masking=False, batchsize=2)
+
+        fname_base = config.outbase + '_redmapper_' + config.version + '_lambda_chisq'
+        self.assertFalse(os.path.isfile(fname_base + '.fit.partial'))
+        self.assertIsNone(runcat_stream.members)
+
+        cat = fitsio.read(fname_base + '.fit', ext=1, lower=True)
+        testing.assert_equal(cat['mem_match_id'], runcat.cat.mem_match_id)
+        testing.assert_almost_equal(cat['lambda'], runcat.cat.Lambda)
+        testing.assert_almost_equal(cat['z_lambda'], runcat.cat.z_lambda)
+
+        members = fitsio.read(fname_base + '_members.fit', ext=1, lower=True)
+        testing.assert_equal(members['mem_match_id'], runcat.members.mem_match_id)
+        testing.assert_almost_equal(members['p'], runcat.members.p)
+
+        # The output is not overwritten without clobber
+        runcat_stream = RunCatalog(config)
+        self.assertRaises(IOError, runcat_stream.run_streaming, do_percolation_masking=False)
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(dir='./', prefix='TestRedmapper-')
+
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir, True)
+
 if __name__=='__main__':
     unittest.main()
@@ -52,5 +52,96 @@ class SolverNFWTestCase(unittest.TestCase):
         testing.assert_almost_equal(rlambda,data[0]['R0']*(data[0]['LAMBDA']/100.)**data[0]['BETA'])
         testing.assert_almost_equal(theta_r,data[0]['THETA_R'],6)
 
+        # the bisection evaluates the weights at each midpoint and once at
+        # the low end (the sum at the low end is not recomputed)
+        nstep = int(np.ceil(np.log2((2000.0 - 0.5) / (2 * 1e-2))))
+        testing.assert_equal(solver.niter, nstep + 1)
+
+class SolverNFWLowLambdaTestCase(unittest.TestCase):
+    def runTest(self):
+        """
+        Test low richness clusters, where the sum at the low end of the
+        bisection is clipped for stability, against the outputs of the
+        original bisection solver.
+        """
+        file_name = 'test_solver_lowlambda.fit'
+        file_path = 'data_for_tests'
+
+        data=fitsio.read('%s/%s' % (file_path,file_name),ext=1)
+
+        for d in data:
+            solver = redmapper.Solver(d['R0'], d['BETA'], d['UCOUNTS'], d['BCOUNTS'], d['R'], d['W'],
+                                      cpars=d['CPARS'], rsig=d['RSIG'])
+            lam, p, wt, rlambda, theta_r = solver.solve_nfw()
+
+            testing.assert_equal(lam, d['LAMBDA'])
+            testing.assert_equal(rlambda, d['RLAMBDA'])
+            testing.assert_array_equal(p, d['PVALS'])
+            testing.assert_array_equal(wt, d['WTVALS'])
+            testing.assert_array_equal(theta_r, d['THETA_R'])
+
+        # and the same in one batch
+        ngal = data['UCOUNTS'].shape[1]
+        offsets = np.arange(data.size + 1) * ngal
+        lam, p, wt, rlambda, theta_r, niter = redmapper.solve_nfw_batch(data['R0'], data['BETA'],
+                                                                        data['UCOUNTS'].ravel(),
+                                                                        data['BCOUNTS'].ravel(),
+                                                                        data['R'].ravel(),
+                                                                        data['W'].ravel(),
+                                                                        offsets, cpars=data['CPARS'],
+                                                                        rsig=0.0)
+        use, = np.where(data['RSIG'] == 0.0)
+        testing.assert_array_equal(lam[use], data['LAMBDA'][use])
+        testing.assert_array_equal(p.reshape(data.size, ngal)[use, :], data['PVALS'][use, :])
+        testing.assert_array_equal(theta_r.reshape(data.size, ngal)[use, :], data['THETA_R'][use, :])
+
+class SolverNFWBatchTestCase(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that solving several clusters in one batch gives the same
+        results as solving them one by one.
+        """
+        file_name = 'test_solver_data.fit'
+        file_path = 'data_for_tests'
+
+        data=fitsio.read('%s/%s' % (file_path,file_name),ext=1)
+        data[0]['CPARS'] = data[0]['CPARS'][::-1]
+
+        ngal = data[0]['UCOUNTS'].size
+        half = ngal // 2
+
+        # three clusters: the full test cluster, the first half, and a richer one
+        ucounts = np.concatenate([data[0]['UCOUNTS'], data[0]['UCOUNTS'][: half], data[0]['UCOUNTS'] * 3.0])
+        bcounts = np.concatenate([data[0]['BCOUNTS'], data[0]['BCOUNTS'][: half], data[0]['BCOUNTS']])
+        r = np.concatenate([data[0]['R'], data[0]['R'][: half], data[0]['R']])
+        w = np.concatenate([data[0]['W'], data[0]['W'][: half], data[0]['W']])
+        offsets = np.array([0, ngal, ngal + half, 2*ngal + half])
+        r0 = np.array([data[0]['R0'], data[0]['R0'], data[0]['R0'] * 1.1])
+        beta = np.array([data[0]['BETA']] * 3)
+        cpars = np.array([data[0]['CPARS'], data[0]['CPARS'], np.zeros(4)])
+
+        testing.assert_raises(ValueError, redmapper.solve_nfw_batch, r0, beta, ucounts, bcounts, r, w, offsets[: -1], cpars=cpars, rsig=data[0]['RSIG'])
+        testing.assert_raises(ValueError, redmapper.solve_nfw_batch, r0, beta, ucounts, bcounts[: 10], r, w, offsets, cpars=cpars, rsig=data[0]['RSIG'])
+        testing.assert_raises(ValueError, redmapper.solve_nfw_batch, r0, beta, ucounts, bcounts, r, w, offsets, cpars=cpars[:, 0: 1], rsig=data[0]['RSIG'])
+
+        for nthreads in [1, 2]:
+            lam, p, wt, rlambda, theta_r, niter = redmapper.solve_nfw_batch(r0, beta, ucounts, bcounts, r, w, offsets,
+                                                                            cpars=cpars, rsig=data[0]['RSIG'],
+                                                                            nthreads=nthreads)
+
+            for i in xrange(3):
+                s = slice(offsets[i], offsets[i + 1])
+                solver = redmapper.Solver(r0[i], beta[i], ucounts[s], bcounts[s], r[s], w[s], cpars=cpars[i], rsig=data[0]['RSIG'])
+                lam1, p1, wt1, rlambda1, theta_r1 = solver.solve_nfw()
+
+                testing.assert_equal(lam[i], lam1)
+                testing.assert_equal(rlambda[i], rlambda1)
+                testing.assert_array_equal(p[s], p1)
+                testing.assert_array_equal(wt[s], wt1)
+                testing.assert_array_equal(theta_r[s], theta_r1)
+                testing.assert_equal(niter[i], solver.niter)
+
+            testing.assert_almost_equal(lam[0], data[0]['LAMBDA'])
+
 if __name__=='__main__':
     unittest.main()
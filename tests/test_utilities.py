@@ -4,6 +4,7 @@ from past.builtins import xrange
 import unittest
 import numpy.testing as testing
 import numpy as np
+import scipy.stats
 import fitsio
 
 import redmapper
@@ -56,8 +57,34 @@ class FunctionsTestCase(unittest.TestCase):
         """
         ra,dec = 40.1234, 55.9876
         testing.assert_almost_equal(redmapper.utilities.astro_to_sphere(ra,dec),np.array([ 0.5936,  0.7003]),decimal=4)
-        #Need a test for chisq_pdf
-        #TO DO
+
+        # chisq_pdf, against scipy
+        chisq = np.array([0.01, 0.5, 1.0, 3.0, 10.0, 25.0, 100.0])
+        for k in xrange(2, 9):
+            testing.assert_allclose(redmapper.utilities.chisq_pdf(chisq, k),
+                                    scipy.stats.chi2.pdf(chisq, k), rtol=1e-12)
+
+class NFWSigmaTableTestCase(unittest.TestCase):
+    def runTest(self):
+        """
+        This tests the NFW sigma(x) lookup table against the direct
+        calculation in utilities.nfw_sigma().
+        """
+        rscale, corer, rmax = 0.15, 0.1, 10.0
+
+        table = redmapper.utilities.get_nfw_sigma_table(rscale, corer, rmax)
+        self.assertTrue(table.max_relerr < 1e-5)
+        self.assertTrue(redmapper.utilities.get_nfw_sigma_table(rscale, corer, rmax) is table)
+
+        # inside the core, away from x = 1, and beyond rmax
+        r = np.concatenate([[0.0, 0.01], np.linspace(0.11, 0.149, 100),
+                            np.linspace(0.151, 9.9, 1000), [11.0]])
+        sigx = redmapper.utilities.nfw_sigma(r / rscale, corer / rscale, rmax / rscale)
+        testing.assert_allclose(table(r), sigx, rtol=1e-5)
+        testing.assert_equal(table(np.array([11.0])), 0.0)
+
+        # a coarse table fails the accuracy check
+        self.assertRaises(ValueError, redmapper.utilities.NFWSigmaTable, rscale, corer, rmax, nstep=100)
 
 class CicTestCase(unittest.TestCase):
     def runTest(self):
@@ -81,6 +81,13 @@ class ClusterZlambdaTestCase(unittest.TestCase):
 
         testing.assert_almost_equal(z_lambda_err, 0.006303830)
 
+        # The cached likelihoods must match a direct calculation
+        self.assertTrue(len(zlam._zlambda_lkhd_cache) > 0)
+        for zind in list(zlam._zlambda_lkhd_cache.keys())[0: 5]:
+            testing.assert_array_equal(zlam._zlambda_lkhd_cache[zind],
+                                       cluster.zredstr.calculate_chisq(zlam.cluster.neighbors[zlam._zlambda_in_rad],
+                                                                       zind, calc_lkhd=True, z_is_index=True))
+
         # and test the correction on its own
         corr_filename = 'test_dr8_zlambdacorr.fit'
 